@@ -0,0 +1,9 @@
+from django import VERSION
+from django.contrib import admin
+
+from pcassandra.dj18.auth.admin import CassandraUserAdmin
+from pcassandra.dj18.auth.django_models import DjangoUserProxy
+
+assert VERSION[0] == 1 and VERSION[1] == 8, "Django 1.8 required"
+
+admin.site.register(DjangoUserProxy, CassandraUserAdmin)
@@ -0,0 +1,236 @@
+"""
+Latency budgets and circuit breakers for the Cassandra operations done
+by the session and auth backends.
+
+Example settings:
+
+    PCASSANDRA_LATENCY_BUDGET = {
+        'SESSION_LOAD': 0.2,
+        'AUTH_GET_USER': 0.2,
+        'AUTH_AUTHENTICATE': 0.5,
+    }
+
+    PCASSANDRA_CIRCUIT_BREAKER = {
+        'FAILURE_THRESHOLD': 5,
+        'RECOVERY_TIMEOUT': 30,
+        'FALLBACK_CACHE_SIZE': 10000,
+        'FALLBACK_CACHE_TTL': 300,
+        'AUTHENTICATE_FROM_FALLBACK': False,
+    }
+
+* PCASSANDRA_LATENCY_BUDGET: maximum time (in seconds) to wait for the
+  response of each operation. Operations not listed here use the default
+  timeout of the driver.
+* FAILURE_THRESHOLD: consecutive failures (timeouts, unavailable
+  replicas, etc.) before the breaker opens
+* RECOVERY_TIMEOUT: seconds the breaker stays open before letting a
+  request through to check if Cassandra recovered
+* FALLBACK_CACHE_SIZE / FALLBACK_CACHE_TTL: size and TTL of the local
+  caches the backends use while Cassandra is not available
+* AUTHENTICATE_FROM_FALLBACK: if True, while Cassandra is not available
+  the passwords are checked against the copies of the users in the
+  fallback cache. Keep in mind that a password changed (or a user
+  deactivated) in the last FALLBACK_CACHE_TTL seconds is not seen: the
+  old password is accepted. If False (the default), logins fail while
+  Cassandra is not available (the fallback cache is only used to
+  validate the existing sessions)
+
+"""
+
+import logging
+import threading
+import time
+
+from cassandra import OperationTimedOut, Timeout, Unavailable
+from cassandra.cluster import NoHostAvailable
+from cassandra.cqlengine.query import DoesNotExist, LWTException
+from django.conf import settings
+
+from pcassandra import metrics
+from pcassandra.localcache import LocalCache
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# Values reported in the 'circuit_breaker.<name>.state' gauge
+STATE_GAUGE_VALUES = {
+    CLOSED: 0,
+    HALF_OPEN: 1,
+    OPEN: 2,
+}
+
+# Errors that means Cassandra is slow or unavailable (as opposed to
+#  errors in the query or in the data)
+UNAVAILABLE_ERRORS = (OperationTimedOut, Timeout, Unavailable, NoHostAvailable)
+
+# Errors that are answers of Cassandra (ex: the user doesn't exists): they
+#  mean Cassandra is available
+ANSWER_ERRORS = (DoesNotExist, LWTException)
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RECOVERY_TIMEOUT = 30
+DEFAULT_FALLBACK_CACHE_SIZE = 10000
+DEFAULT_FALLBACK_CACHE_TTL = 300
+
+
+class CircuitOpenError(Exception):
+    """Raised when a request is rejected because the breaker is open"""
+    pass
+
+
+class CircuitBreaker:
+    """
+    Classic circuit breaker: after `failure_threshold` consecutive
+    failures the breaker opens, and all the requests are rejected
+    for `recovery_timeout` seconds. After that, one request is let
+    through (half-open), and the rest are rejected until it finishes:
+    if it works the breaker closes again, if it fails it opens again.
+    """
+
+    def __init__(self, name, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 recovery_timeout=DEFAULT_RECOVERY_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = None
+        # True while the request let through in HALF_OPEN is running
+        self._trial_in_flight = False
+        metrics.set_gauge(self._metric('state'), STATE_GAUGE_VALUES[CLOSED])
+
+    def _metric(self, suffix):
+        return 'circuit_breaker.{}.{}'.format(self.name, suffix)
+
+    def _set_state(self, state):
+        """Must be called with the lock held. Returns the previous state"""
+        previous_state = self._state
+        self._state = state
+        return previous_state
+
+    def _state_changed(self, previous_state, state):
+        """
+        Logs the transition and updates the gauge. Called after releasing the
+        lock: the listeners of the metrics can do I/O (ex: send statsd packets)
+        """
+        if state == previous_state:
+            return
+        logger.warning("CircuitBreaker '%s': %s -> %s", self.name, previous_state, state)
+        if state == OPEN:
+            metrics.incr(self._metric('opened'))
+        # The current state: other thread could have changed it meanwhile
+        metrics.set_gauge(self._metric('state'), STATE_GAUGE_VALUES[self._state])
+
+    @property
+    def state(self):
+        with self._lock:
+            previous_state = state = self._state
+            if state == OPEN and time.time() - self._opened_at >= self.recovery_timeout:
+                state = HALF_OPEN
+                self._set_state(state)
+        self._state_changed(previous_state, state)
+        return state
+
+    def allow_request(self):
+        """
+        Returns True if the request can be sent to Cassandra. In HALF_OPEN,
+        only for the first request (until record_success(), record_failure()
+        or end_trial() is called).
+        """
+        state = self.state
+        with self._lock:
+            if state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+        if state != CLOSED:
+            metrics.incr(self._metric('rejected'))
+            return False
+        return True
+
+    def end_trial(self):
+        """Called when the request let through in HALF_OPEN ended without a result"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        metrics.incr(self._metric('successes'))
+        with self._lock:
+            self._trial_in_flight = False
+            self._consecutive_failures = 0
+            previous_state = self._set_state(CLOSED)
+        self._state_changed(previous_state, CLOSED)
+
+    def record_failure(self):
+        metrics.incr(self._metric('failures'))
+        with self._lock:
+            self._trial_in_flight = False
+            self._consecutive_failures += 1
+            previous_state = state = self._state
+            if state == HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                state = OPEN
+                self._opened_at = time.time()
+                self._set_state(state)
+        self._state_changed(previous_state, state)
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls `func`, recording the result in the breaker (ANSWER_ERRORS
+        count as successes). Raises CircuitOpenError if the breaker is open.
+        """
+        if not self.allow_request():
+            raise CircuitOpenError("Circuit breaker '{}' is open".format(self.name))
+        try:
+            result = func(*args, **kwargs)
+        except UNAVAILABLE_ERRORS:
+            self.record_failure()
+            raise
+        except ANSWER_ERRORS:
+            self.record_success()
+            raise
+        except Exception:
+            # Not an availability error: let the next request be the trial
+            self.end_trial()
+            raise
+        self.record_success()
+        return result
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def _get_breaker_setting(name, default):
+    return getattr(settings, 'PCASSANDRA_CIRCUIT_BREAKER', {}).get(name, default)
+
+
+def get_breaker(name):
+    """Returns the CircuitBreaker identified by `name`, creating it if needed"""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=_get_breaker_setting('FAILURE_THRESHOLD',
+                                                       DEFAULT_FAILURE_THRESHOLD),
+                recovery_timeout=_get_breaker_setting('RECOVERY_TIMEOUT',
+                                                      DEFAULT_RECOVERY_TIMEOUT))
+        return _breakers[name]
+
+
+def get_latency_budget(operation):
+    """Returns the latency budget (in seconds) of `operation`, or None"""
+    return getattr(settings, 'PCASSANDRA_LATENCY_BUDGET', {}).get(operation)
+
+
+def is_fallback_authentication_enabled():
+    return _get_breaker_setting('AUTHENTICATE_FROM_FALLBACK', False)
+
+
+def create_fallback_cache():
+    """Returns a new LocalCache configured with the fallback cache settings"""
+    return LocalCache(
+        max_size=_get_breaker_setting('FALLBACK_CACHE_SIZE', DEFAULT_FALLBACK_CACHE_SIZE),
+        ttl=_get_breaker_setting('FALLBACK_CACHE_TTL', DEFAULT_FALLBACK_CACHE_TTL))
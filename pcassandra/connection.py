@@ -1,7 +1,7 @@
 """
 Setup the connections to Cassandra using the values on Django settings.
 
-Exampmle settings:
+Example settings:
 
     CASSANDRA_CONNECTION = {
         'KEYSPACE': 'my_cassandra_keyspace',
@@ -9,32 +9,131 @@ Exampmle settings:
         'KEYSPACE_REPLICATION': "{'class' : 'SimpleStrategy', 'replication_factor' : 1}",
         'CLUSTER_KWARGS': {
             'protocol_version': 3
-        }
+        },
+        'CONNECTION_CLASS': 'auto',
+        'CONNECTIONS_PER_HOST': {'CORE': 2, 'MAX': 8},
     }
 
 * KEYSPACE: the name of the Cassandra keyspace
 * HOSTS: list of initial hosts to connect to
 * KEYSPACE_REPLICATION: parameters to use when creating the keyspace
 * CLUSTER_KWARGS: parameters to pass to cassandra.cluster.Cluster()
+* CONNECTION_CLASS (optional): the I/O reactor used by the driver: 'gevent',
+  'eventlet', 'libev', 'asyncore', 'twisted', 'asyncio' (only available on
+  newer versions of the driver), the full path of a connection class,
+  or 'auto'. With 'auto', the reactor is selected based on the worker
+  model: GeventConnection / EventletConnection if the sockets were
+  monkey-patched (gevent/eventlet workers of gunicorn, for example),
+  LibevConnection if libev is available, and the driver's default if not.
+  If not set (or None), the driver's default is used.
+* CONNECTIONS_PER_HOST (optional): core and max number of connections to
+  each (local) host. Only used with protocol versions 1 and 2: since
+  protocol version 3, each connection supports thousands of concurrent
+  requests, and the driver uses one connection per host.
 
 """
 
 import logging
+import sys
+import threading
 
+from cassandra.concurrent import execute_concurrent_with_args
 from cassandra.cqlengine import connection
+from cassandra.policies import HostDistance
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from pcassandra import exporters
+from pcassandra import querylog
 
 logger = logging.getLogger(__name__)
 
+_prepared_statements = {}
+_prepared_statements_lock = threading.Lock()
+
+CONNECTION_CLASSES = {
+    'gevent': 'cassandra.io.geventreactor.GeventConnection',
+    'eventlet': 'cassandra.io.eventletreactor.EventletConnection',
+    'libev': 'cassandra.io.libevreactor.LibevConnection',
+    'asyncore': 'cassandra.io.asyncorereactor.AsyncoreConnection',
+    'twisted': 'cassandra.io.twistedreactor.TwistedConnection',
+    'asyncio': 'cassandra.io.asyncioreactor.AsyncioConnection',
+}
+
+
+def detect_reactor():
+    """
+    Returns the name of the reactor matching the worker model of the
+    current process, or None to use the driver's default.
+    """
+    if 'gevent.monkey' in sys.modules:
+        if sys.modules['gevent.monkey'].is_module_patched('socket'):
+            return 'gevent'
+    if 'eventlet.patcher' in sys.modules:
+        if sys.modules['eventlet.patcher'].is_monkey_patched('socket'):
+            return 'eventlet'
+    try:
+        import_string(CONNECTION_CLASSES['libev'])
+        return 'libev'
+    except Exception:
+        # ImportError, or the driver's DependencyException if
+        #  the libev extension wasn't compiled
+        pass
+    return None
+
+
+def get_connection_class():
+    """
+    Returns the driver's connection class configured in
+    CASSANDRA_CONNECTION['CONNECTION_CLASS'], or None
+    """
+    name = settings.CASSANDRA_CONNECTION.get('CONNECTION_CLASS')
+    if name == 'auto':
+        name = detect_reactor()
+        logger.info("get_connection_class(): detected reactor: %s", name or "driver's default")
+    if not name:
+        return None
+    path = CONNECTION_CLASSES.get(name, name)
+    try:
+        return import_string(path)
+    except Exception as e:
+        raise ImproperlyConfigured("Couldn't load the connection class '{}' ({}): {}".format(
+            name, path, e))
+
+
+def _setup_connections_per_host(cluster):
+    connections_per_host = settings.CASSANDRA_CONNECTION.get('CONNECTIONS_PER_HOST')
+    if not connections_per_host:
+        return
+    if cluster.protocol_version >= 3:
+        logger.info("CONNECTIONS_PER_HOST ignored: not used with protocol version >= 3")
+        return
+    if 'MAX' in connections_per_host:
+        cluster.set_max_connections_per_host(HostDistance.LOCAL, connections_per_host['MAX'])
+    if 'CORE' in connections_per_host:
+        cluster.set_core_connections_per_host(HostDistance.LOCAL, connections_per_host['CORE'])
+
 
 def setup_connection(set_default_keyspace=True):
     """Set 'cqlengine' connection settings"""
     if connection.session is not None:
         logger.warn("setup_connection(): connection already configured. "
                     "Will overwrite old settings")
+    with _prepared_statements_lock:
+        _prepared_statements.clear()
+    cluster_kwargs = dict(settings.CASSANDRA_CONNECTION['CLUSTER_KWARGS'])
+    if 'connection_class' not in cluster_kwargs:
+        connection_class = get_connection_class()
+        if connection_class is not None:
+            cluster_kwargs['connection_class'] = connection_class
     connection.setup(settings.CASSANDRA_CONNECTION['HOSTS'],
                      default_keyspace=settings.CASSANDRA_CONNECTION['KEYSPACE'],
-                     **settings.CASSANDRA_CONNECTION['CLUSTER_KWARGS'])
+                     **cluster_kwargs)
+    _setup_connections_per_host(connection.get_cluster())
+    # Measure the queries if PCASSANDRA_SLOW_QUERY_LOG is set (see querylog.py)
+    connection.session = querylog.instrument_session(connection.session)
+    exporters.setup_statsd()
     if set_default_keyspace:
         # Management commands that creates keyspaces requires a way to
         #  create connections when the keyspaces doesn't exists yet
@@ -52,6 +151,11 @@ def create_keyspace():
     ))
 
 
+def keyspace_exists():
+    """Returns True if the configured keyspace exists"""
+    return settings.CASSANDRA_CONNECTION['KEYSPACE'] in get_cluster().metadata.keyspaces
+
+
 def set_session_default_keyspace():
     connection.session.set_keyspace(settings.CASSANDRA_CONNECTION['KEYSPACE'])
 
@@ -63,8 +167,84 @@ def setup_connection_if_unset(**kwargs):
         setup_connection(**kwargs)
 
 
+def get_cluster():
+    """Returns the driver's Cluster used by cqlengine"""
+    return connection.get_cluster()
+
+
+def get_session():
+    """Returns the driver's Session used by cqlengine"""
+    return connection.get_session()
+
+
+def prepare(query):
+    """Returns the prepared statement for `query`, preparing it only once"""
+    try:
+        return _prepared_statements[query]
+    except KeyError:
+        pass
+    with _prepared_statements_lock:
+        if query not in _prepared_statements:
+            _prepared_statements[query] = get_session().prepare(query)
+        return _prepared_statements[query]
+
+
+def _get_select_query(model_class, columns, filter_names):
+    return "SELECT {} FROM {} WHERE {} LIMIT 1".format(
+        ', '.join(columns) if columns else '*',
+        model_class.column_family_name(),
+        ' AND '.join('{} = ?'.format(name) for name in filter_names))
+
+
+def fetch_row(model_class, columns=None, timeout=None, **filters):
+    """
+    Returns the first row of `model_class` matching `filters` (as a dict),
+    or None if not found. The query is sent as a prepared statement,
+    and `timeout` (in seconds) is the maximum time to wait for it.
+    If `columns` is None, all the columns are returned.
+
+    The keys of `filters` and `columns` are the names of the columns in
+    the database.
+    """
+    filter_names = sorted(filters)
+    query = _get_select_query(model_class, columns, filter_names)
+    params = [filters[name] for name in filter_names]
+    kwargs = {}
+    if timeout is not None:
+        kwargs['timeout'] = timeout
+    rows = get_session().execute(prepare(query), params, **kwargs)
+    for row in rows:
+        return row
+    return None
+
+
+def fetch_rows(model_class, key_name, keys, columns=None, concurrency=100):
+    """
+    Returns a dict {key: row} with the rows of `model_class` where the column
+    `key_name` is equal to each of the values of `keys`. Missing rows are
+    not included in the returned dict.
+
+    One query is sent for each key, with up to `concurrency` queries in
+    flight at the same time, so reading N rows costs (roughly) the time
+    of the slowest query instead of the sum of N queries.
+    """
+    keys = list(keys)
+    statement = prepare(_get_select_query(model_class, columns, [key_name]))
+    results = execute_concurrent_with_args(get_session(), statement,
+                                           [[key] for key in keys],
+                                           concurrency=concurrency)
+    rows_by_key = {}
+    for key, (success, result) in zip(keys, results):
+        if not success:
+            raise result
+        for row in result:
+            rows_by_key[key] = row
+            break
+    return rows_by_key
+
+
 def test_connection(verbose=False):
-    response = connection.execute("SELECT now() AS response FROM system.schema_columns LIMIT 1;")
+    response = connection.execute("SELECT now() AS response FROM system.local;")
     if verbose:
         print("--- Connection to Cassandra OK: {}".format(response[0]['response']))
 
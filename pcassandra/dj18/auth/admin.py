@@ -0,0 +1,92 @@
+"""
+Admin of the users, with the list and search of the users read from
+Cassandra (see search.py) instead of the database of the proxies.
+
+The list shows a page of users at a time, with a link to the next page.
+Searches by username, email or last name (by prefix) require
+PCASSANDRA_USER_SEARCH_INDEX = True.
+"""
+import logging
+
+from django import VERSION
+from django.contrib import admin
+from django.template.response import TemplateResponse
+from django.utils.http import urlencode
+
+from pcassandra import utils
+from pcassandra.dj18.auth import search
+
+logger = logging.getLogger(__name__)
+
+assert VERSION[0] == 1 and VERSION[1] == 8, "Django 1.8 required"
+
+PAGE_SIZE = 50
+
+
+class CassandraUserAdmin(admin.ModelAdmin):
+    change_list_template = 'admin/pcassandra/cassandrauser_changelist.html'
+
+    def get_object(self, request, object_id, from_field=None):
+        """
+        Returns the proxy of the user. If the user exists only in Cassandra,
+        the proxy is created when the user is modified (POST): viewing the
+        user returns an unsaved proxy.
+        """
+        obj = super(CassandraUserAdmin, self).get_object(request, object_id, from_field)
+        if obj is None and utils.get_users([object_id]).get(object_id) is not None:
+            if request.method == 'POST':
+                obj, _ = self.model.objects.get_or_create(username=object_id)
+            else:
+                obj = self.model(username=object_id)
+        return obj
+
+    def changelist_view(self, request, extra_context=None):
+        if not self.has_change_permission(request, None):
+            return super(CassandraUserAdmin, self).changelist_view(request, extra_context)
+
+        MODEL = utils.get_cassandra_user_model()
+        field = request.GET.get('field', 'username')
+        if field not in search.SEARCH_FIELDS:
+            field = 'username'
+        query = request.GET.get('q', '').strip()
+        error = None
+        next_params = None
+
+        if query and not search.is_enabled():
+            error = 'The search index is not enabled (PCASSANDRA_USER_SEARCH_INDEX)'
+            users = []
+        elif query:
+            after = None
+            if 'after_username' in request.GET:
+                after = (request.GET.get('after_value', ''), request.GET['after_username'])
+            try:
+                results = search.search(field, query, after=after, limit=PAGE_SIZE)
+            except ValueError as e:
+                error = str(e)
+                results = []
+            users = search.get_users(MODEL, [username for _, username in results])
+            if len(results) == PAGE_SIZE:
+                next_params = {'field': field, 'q': query,
+                               'after_value': results[-1][0],
+                               'after_username': results[-1][1]}
+        else:
+            users = search.list_users(MODEL, after=request.GET.get('after_username'),
+                                      limit=PAGE_SIZE)
+            if len(users) == PAGE_SIZE:
+                next_params = {'after_username': users[-1]['username']}
+
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            title='Select user to change',
+            users=users,
+            columns=search.LIST_COLUMNS,
+            search_fields=search.SEARCH_FIELDS,
+            field=field,
+            query=query,
+            error=error,
+            next_url='?' + urlencode(next_params) if next_params else None,
+            has_add_permission=self.has_add_permission(request),
+        )
+        context.update(extra_context or {})
+        return TemplateResponse(request, self.change_list_template, context)
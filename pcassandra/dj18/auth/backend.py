@@ -2,7 +2,16 @@ import logging
 
 from django import VERSION
 
+from pcassandra.dj18.auth import credential_cache
+from pcassandra.dj18.auth import session_hash
+from pcassandra.dj18.auth import snapshot
+from pcassandra.dj18.auth import throttle
 from pcassandra.dj18.auth.django_models import DjangoUserProxy
+from pcassandra.dj18.auth.snapshot import CassandraUserSnapshot
+from pcassandra import circuitbreaker
+from pcassandra import identitymap
+from pcassandra import metrics
+from pcassandra import singleflight
 from pcassandra import utils
 
 assert VERSION[0] == 1 and VERSION[1] == 8, "Django 1.8 required"
@@ -10,6 +19,24 @@ assert VERSION[0] == 1 and VERSION[1] == 8, "Django 1.8 required"
 
 logger = logging.getLogger(__name__)
 
+# Snapshots of recently loaded users, used while Cassandra is not available
+_fallback_cache = None
+
+
+def _get_fallback_cache():
+    global _fallback_cache
+    if _fallback_cache is None:
+        _fallback_cache = circuitbreaker.create_fallback_cache()
+    return _fallback_cache
+
+
+class AuthenticationUnavailable(Exception):
+    """
+    Raised by _authenticate() when the user can't be read from Cassandra
+    (see AUTHENTICATE_FROM_FALLBACK in circuitbreaker.py)
+    """
+    pass
+
 
 class ModelBackend:
     """Auth backend, lookup user instances in Cassandra"""
@@ -22,10 +49,10 @@ class ModelBackend:
             cls._CASSANDRA_USER_MODEL = utils.get_cassandra_user_model()
         return cls._CASSANDRA_USER_MODEL
 
-    def _get_django_user_proxy(self, cassandra_user):
+    def _get_django_user_proxy(self, user_snapshot):
         """Returns the instance of DjangoUserProxy, with the required reference
-        to CassandraUser. If the instance of DjangoUserProxy does not exists,
-        the instance is created.
+        to the snapshot of the CassandraUser. If the instance of DjangoUserProxy
+        does not exists, the instance is created.
 
         This is implemented this way following the Django's doc sugestion:
 
@@ -41,31 +68,167 @@ class ModelBackend:
 
         See https://docs.djangoproject.com/en/1.8/topics/auth/customizing/
         """
-        assert isinstance(cassandra_user, self._get_cassandra_user_model())
+        assert isinstance(user_snapshot, CassandraUserSnapshot)
+        dj_user = identitymap.get('django_user_proxy', user_snapshot.username,
+                                  lambda: self._get_or_create_django_user_proxy(
+                                      user_snapshot.username))
+        if not dj_user.is_hydrated():
+            dj_user.user_snapshot = user_snapshot
+        return dj_user
+
+    def _get_or_create_django_user_proxy(self, username):
         try:
-            dj_user = DjangoUserProxy.objects.get(username=cassandra_user.username)
+            return DjangoUserProxy.objects.get(username=username)
         except DjangoUserProxy.DoesNotExist:
-            dj_user = DjangoUserProxy.objects.create(username=cassandra_user.username)
-            logger.info("Django user for '%s' was created", cassandra_user.username)
-        dj_user.cassandra_user = cassandra_user
-        return dj_user
+            logger.info("Django user for '%s' was created", username)
+            metrics.incr('auth.proxy.created')
+            return DjangoUserProxy.objects.create(username=username)
+
+    def _get_user_snapshot(self, username, operation):
+        """
+        Returns the snapshot of the user, waiting at most the latency budget
+        of `operation`. Raises MODEL.DoesNotExist if the user doesn't exists.
+        """
+        MODEL = self._get_cassandra_user_model()
+        if operation == 'AUTH_AUTHENTICATE':
+            # The password is never checked against a copy: not even the
+            # copy loaded by get_user() earlier in the same request
+            user_snapshot = self._load_user_snapshot(username, operation)
+            identitymap.put('user_snapshot', username, user_snapshot)
+        else:
+            user_snapshot = identitymap.get(
+                'user_snapshot', username,
+                lambda: self._load_user_snapshot(username, operation))
+        if user_snapshot is None:
+            raise MODEL.DoesNotExist()
+        _get_fallback_cache().set(username, user_snapshot)
+        return user_snapshot
+
+    def _load_user_snapshot(self, username, operation):
+        """
+        Reads the snapshot from Cassandra. When the shared memory cache is
+        configured (see pcassandra.shmcache), get_user() uses the snapshots
+        read by the other processes of the host, and the snapshots read by
+        this process are stored there. authenticate() always reads
+        Cassandra (see _get_user_snapshot()).
+
+        Concurrent reads of the same user by other threads are collapsed
+        into one query (see pcassandra.singleflight).
+        """
+        MODEL = self._get_cassandra_user_model()
+        if operation == 'AUTH_GET_USER':
+            user_snapshot = snapshot.get_shared_snapshot(MODEL, username)
+            if user_snapshot is not None:
+                return user_snapshot
+
+        timeout = circuitbreaker.get_latency_budget(operation)
+        user_snapshot = singleflight.do(
+            'user_snapshot', username,
+            lambda: circuitbreaker.get_breaker('auth').call(
+                CassandraUserSnapshot.fetch,
+                MODEL,
+                username,
+                timeout=timeout),
+            timeout=timeout)
+        if user_snapshot is not None:
+            snapshot.set_shared_snapshot(user_snapshot)
+        return user_snapshot
+
+    def _get_user_snapshot_degraded(self, username, error):
+        """Returns the snapshot of the user from the local fallback cache, or None"""
+        logger.warning("Cassandra not available, looking up '%s' in fallback cache: %s",
+                       username, error)
+        metrics.incr('auth.degraded')
+        user_snapshot = _get_fallback_cache().get(username)
+        if user_snapshot is not None:
+            metrics.incr('auth.fallback_hits')
+        return user_snapshot
 
     def authenticate(self, username=None, password=None, **kwargs):
         assert username is not None, "No username provided"
+        login_throttle = throttle.get_login_throttle()
+        client_ip = throttle.get_client_ip()
+        if login_throttle is not None and login_throttle.is_denied(username, client_ip):
+            # Rejected before hashing the password or reading Cassandra
+            return None
+
+        try:
+            with metrics.timed('auth.authenticate'):
+                user = self._authenticate(username, password)
+        except AuthenticationUnavailable as e:
+            # Not the user's fault: not counted as a failed attempt
+            logger.warning("authenticate(): Cassandra not available, login of '%s' "
+                           "rejected: %s", username, e)
+            metrics.incr('auth.authenticate.unavailable')
+            return None
+        if user is None:
+            metrics.incr('auth.authenticate.failure')
+            if login_throttle is not None:
+                login_throttle.record_failure(username, client_ip)
+        else:
+            metrics.incr('auth.authenticate.success')
+        return user
+
+    def _authenticate(self, username, password):
+        verified_credentials = credential_cache.get_credential_cache()
+        if verified_credentials is not None:
+            user_snapshot = verified_credentials.get(username, password)
+            if user_snapshot is not None:
+                # Verified recently: no Cassandra read, no hashing
+                return self._get_django_user_proxy(user_snapshot)
+
         MODEL = self._get_cassandra_user_model()
         try:
-            cassandra_user = MODEL.get(username=username)
-            if cassandra_user.check_password(password):
-                return self._get_django_user_proxy(cassandra_user)
+            user_snapshot = self._get_user_snapshot(username, 'AUTH_AUTHENTICATE')
         except MODEL.DoesNotExist:
             # Run the default password hasher once to reduce the timing
             # difference between an existing and a non-existing user (#20760).
             MODEL().set_password(password)
+            return None
+        except (circuitbreaker.CircuitOpenError, circuitbreaker.UNAVAILABLE_ERRORS) as e:
+            if not circuitbreaker.is_fallback_authentication_enabled():
+                # The copy in the fallback cache could have an old password
+                raise AuthenticationUnavailable(e) from e
+            user_snapshot = self._get_user_snapshot_degraded(username, e)
+            if user_snapshot is None:
+                MODEL().set_password(password)
+                return None
+
+        if user_snapshot.check_password(password):
+            session_hash.remember_session_auth_hash(username, user_snapshot.password)
+            if verified_credentials is not None:
+                verified_credentials.set(username, password, user_snapshot)
+            return self._get_django_user_proxy(user_snapshot)
 
     def get_user(self, user_id):
+        with metrics.timed('auth.get_user'):
+            return self._get_user(user_id)
+
+    def _get_user(self, user_id):
+        if session_hash.is_lazy_user_enabled():
+            # The user is loaded from Cassandra only if its attributes are accessed
+            #  (see session_hash.py)
+            try:
+                dj_user = identitymap.get('django_user_proxy', user_id,
+                                          lambda: DjangoUserProxy.objects.get(username=user_id))
+            except DjangoUserProxy.DoesNotExist:
+                pass
+            else:
+                try:
+                    # Resolved (and cached) now, for auth.get_user()
+                    dj_user.get_session_auth_hash()
+                except session_hash.SessionAuthHashUnavailable:
+                    # Anonymous for this request, without flushing the session
+                    return None
+                return dj_user
+
         MODEL = self._get_cassandra_user_model()
         try:
-            cassandra_user = MODEL.get(username=user_id)
-            return self._get_django_user_proxy(cassandra_user)
+            user_snapshot = self._get_user_snapshot(user_id, 'AUTH_GET_USER')
         except MODEL.DoesNotExist:
             return None
+        except (circuitbreaker.CircuitOpenError, circuitbreaker.UNAVAILABLE_ERRORS) as e:
+            user_snapshot = self._get_user_snapshot_degraded(user_id, e)
+            if user_snapshot is None:
+                return None
+        return self._get_django_user_proxy(user_snapshot)
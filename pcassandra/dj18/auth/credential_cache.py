@@ -0,0 +1,136 @@
+"""
+Cache of the recently verified credentials, for API clients that send
+the username and password on every request (ex: HTTP basic auth).
+
+Each call to ModelBackend.authenticate() reads the user from Cassandra
+and hashes the password (PBKDF2 by default, tens of milliseconds of CPU).
+When PCASSANDRA_AUTH_CREDENTIAL_CACHE is set, after a successful
+authentication the backend stores, for TTL seconds, the snapshot of
+the user and an HMAC of (username, password, password hash, is_active).
+Repeated authentications with the same password are answered from the
+cache, without reading Cassandra and without hashing.
+
+Example settings:
+
+    PCASSANDRA_AUTH_CREDENTIAL_CACHE = {
+        'TTL': 30,
+        'MAX_SIZE': 10000,
+    }
+
+The passwords are never stored: only the HMAC (keyed with SECRET_KEY).
+
+The entry of a user is discarded when its password or `is_active` is
+changed by this process. If a newer copy of the user is found in the
+identity map of the request or in the shared memory cache (see
+pcassandra.shmcache), the HMAC is checked against its password hash and
+`is_active`, so the changes done by the other processes of the host are
+seen as soon as they reach those caches. Changes done in other hosts
+are seen after (at most) TTL seconds: keep it short.
+"""
+import logging
+import threading
+
+from django import VERSION
+from django.conf import settings
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from pcassandra import identitymap
+from pcassandra import metrics
+from pcassandra.dj18.auth import snapshot
+from pcassandra.localcache import LocalCache
+
+logger = logging.getLogger(__name__)
+
+assert VERSION[0] == 1 and VERSION[1] == 8, "Django 1.8 required"
+
+DEFAULT_TTL = 30
+DEFAULT_MAX_SIZE = 10000
+
+KEY_SALT = 'pcassandra.dj18.auth.credential_cache'
+
+_credential_cache = None
+_credential_cache_configured = False
+_credential_cache_lock = threading.Lock()
+
+
+def get_credential_digest(username, password, user_snapshot):
+    """HMAC of the credential, tied to the current password hash and `is_active`"""
+    value = '\x00'.join([username, password, user_snapshot.password or '',
+                         '1' if user_snapshot.is_active else '0'])
+    return salted_hmac(KEY_SALT, value).hexdigest()
+
+
+def _get_newer_snapshot(username):
+    """Returns the copy of the user in the identity map or the shared cache, or None"""
+    user_snapshot = identitymap.peek('user_snapshot', username)
+    if user_snapshot is None:
+        # Only the password and `is_active` are used: no need to load the rest
+        user_snapshot = snapshot.get_shared_snapshot(None, username)
+    return user_snapshot
+
+
+class CredentialCache:
+    """Snapshots of the users whose credentials were verified recently"""
+
+    def __init__(self, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        self._cache = LocalCache(max_size=max_size, ttl=ttl)
+
+    def get(self, username, password):
+        """
+        Returns the snapshot of the user if `password` was verified in the
+        last TTL seconds (and the user wasn't modified), or None
+        """
+        entry = self._cache.get(username)
+        if entry is None:
+            metrics.incr('auth.credential_cache.misses')
+            return None
+        digest, user_snapshot = entry
+
+        newer_snapshot = _get_newer_snapshot(username)
+        if newer_snapshot is not None and (
+                newer_snapshot.password != user_snapshot.password or
+                newer_snapshot.is_active != user_snapshot.is_active):
+            metrics.incr('auth.credential_cache.invalidated')
+            self._cache.delete(username)
+            return None
+
+        if not constant_time_compare(digest, get_credential_digest(username, password,
+                                                                   user_snapshot)):
+            metrics.incr('auth.credential_cache.misses')
+            return None
+        metrics.incr('auth.credential_cache.hits')
+        return user_snapshot
+
+    def set(self, username, password, user_snapshot):
+        """Must be called only after `password` was checked against `user_snapshot`"""
+        self._cache.set(username, (get_credential_digest(username, password, user_snapshot),
+                                   user_snapshot))
+
+    def delete(self, username):
+        self._cache.delete(username)
+
+    def clear(self):
+        self._cache.clear()
+
+
+def get_credential_cache():
+    """Returns the CredentialCache configured with PCASSANDRA_AUTH_CREDENTIAL_CACHE, or None"""
+    global _credential_cache, _credential_cache_configured
+    if not _credential_cache_configured:
+        # Two instances could miss the invalidation done through the other one
+        with _credential_cache_lock:
+            if not _credential_cache_configured:
+                config = getattr(settings, 'PCASSANDRA_AUTH_CREDENTIAL_CACHE', None)
+                if config:
+                    _credential_cache = CredentialCache(
+                        ttl=config.get('TTL', DEFAULT_TTL),
+                        max_size=config.get('MAX_SIZE', DEFAULT_MAX_SIZE))
+                _credential_cache_configured = True
+    return _credential_cache
+
+
+def forget_credentials(username):
+    """Must be called when the password or `is_active` of the user is changed"""
+    credential_cache = get_credential_cache()
+    if credential_cache is not None:
+        credential_cache.delete(username)
@@ -23,14 +23,22 @@ the recommended way to handle this situation:
 The first time the user is authenticated, the 'DjangoUserProxy' instance
 is created if not exists.
 
+The auth backend populates the proxy with a CassandraUserSnapshot (see
+snapshot.py), and all the read-only attributes are taken from it. The
+full cqlengine model is loaded only when the user is modified (for
+example, by set_password()).
+
 """
 import logging
 
 from django import VERSION
 from django.db import models
-from django.utils.crypto import salted_hmac
 
+from pcassandra import circuitbreaker
+from pcassandra import utils
+from pcassandra.dj18.auth import session_hash
 from pcassandra.dj18.auth.models import CassandraAbstractUser
+from pcassandra.dj18.auth.snapshot import CassandraUserSnapshot
 
 logger = logging.getLogger(__name__)
 
@@ -38,14 +46,71 @@ logger = logging.getLogger(__name__)
 assert VERSION[0] == 1 and VERSION[1] == 8, "Django 1.8 required"
 
 
+def hydrate_django_user_proxies(dj_users):
+    """
+    Populates the DjangoUserProxy instances of `dj_users` that don't have
+    the data of the user yet, reading all the users concurrently.
+    """
+    pending = [dj_user for dj_user in dj_users
+               if isinstance(dj_user, DjangoUserProxy) and not dj_user.is_hydrated()]
+    if not pending:
+        return
+    user_snapshots = utils.get_users([dj_user.username for dj_user in pending])
+    for dj_user in pending:
+        user_snapshot = user_snapshots.get(dj_user.username)
+        if user_snapshot is None:
+            logger.warning("hydrate_django_user_proxies(): user '%s' doesn't exists "
+                           "in Cassandra", dj_user.username)
+        else:
+            dj_user.user_snapshot = user_snapshot
+
+
+class DjangoUserProxyQuerySet(models.QuerySet):
+    """
+    QuerySet with support for populating all the instances with
+    the data from Cassandra, like `prefetch_related()` does:
+
+        DjangoUserProxy.objects.all().with_cassandra_users()[:100]
+
+    reads the 100 users concurrently, when the queryset is evaluated.
+    """
+
+    _with_cassandra_users = False
+
+    def with_cassandra_users(self):
+        clone = self._clone()
+        clone._with_cassandra_users = True
+        return clone
+
+    def _clone(self, *args, **kwargs):
+        clone = super(DjangoUserProxyQuerySet, self)._clone(*args, **kwargs)
+        clone._with_cassandra_users = self._with_cassandra_users
+        return clone
+
+    def _fetch_all(self):
+        must_hydrate = self._result_cache is None and self._with_cassandra_users
+        super(DjangoUserProxyQuerySet, self)._fetch_all()
+        if must_hydrate:
+            hydrate_django_user_proxies(self._result_cache)
+
+
 class DjangoUserProxy(models.Model):
 
+    objects = DjangoUserProxyQuerySet.as_manager()
+
     def __init__(self, *args, **kwargs):
         super(DjangoUserProxy, self).__init__(*args, **kwargs)
         self._cassandra_user = None
+        self._user_snapshot = None
 
     @property
     def cassandra_user(self):
+        """
+        Returns the instance of the cqlengine model. If the proxy was populated
+        with a snapshot, the full model is loaded from Cassandra.
+        """
+        if self._cassandra_user is None and self.username:
+            self._cassandra_user = utils.get_cassandra_user_model().get(username=self.username)
         return self._cassandra_user
 
     @cassandra_user.setter
@@ -56,6 +121,47 @@ class DjangoUserProxy(models.Model):
         assert self._cassandra_user is None
         self._cassandra_user = cassandra_user
 
+    @property
+    def user_snapshot(self):
+        return self._user_snapshot
+
+    @user_snapshot.setter
+    def user_snapshot(self, user_snapshot):
+        assert isinstance(user_snapshot, CassandraUserSnapshot)
+        assert self.username == user_snapshot.username
+        assert self._user_snapshot is None
+        self._user_snapshot = user_snapshot
+
+    def is_hydrated(self):
+        """Returns True if the data of the user was already loaded from Cassandra"""
+        return self._cassandra_user is not None or self._user_snapshot is not None
+
+    @property
+    def _user_data(self):
+        """
+        Returns the object to read the attributes from: the full model if
+        it was loaded (it's the most up to date), or the snapshot.
+
+        Instances created by the ORM (querysets, foreign keys, etc.) doesn't
+        have any data: the snapshot is loaded on first access (through the
+        'auth' circuit breaker, waiting at most the AUTH_GET_USER latency
+        budget). To avoid one query for each instance, use
+        `with_cassandra_users()`.
+        """
+        if self._cassandra_user is not None:
+            return self._cassandra_user
+        if self._user_snapshot is None:
+            user_snapshot = circuitbreaker.get_breaker('auth').call(
+                CassandraUserSnapshot.fetch,
+                utils.get_cassandra_user_model(),
+                self.username,
+                timeout=circuitbreaker.get_latency_budget('AUTH_GET_USER'))
+            if user_snapshot is None:
+                raise utils.get_cassandra_user_model().DoesNotExist(
+                    "User '{}' doesn't exists in Cassandra".format(self.username))
+            self._user_snapshot = user_snapshot
+        return self._user_snapshot
+
     # ----- AbstractBaseUser || Fake attributes
 
     # password = models.CharField(_('password'), max_length=128)
@@ -63,11 +169,11 @@ class DjangoUserProxy(models.Model):
 
     @property
     def password(self):
-        return self._cassandra_user.password
+        return self._user_data.password
 
     @property
     def last_login(self):
-        return self._cassandra_user.last_login
+        return self._user_data.last_login
 
     @last_login.setter
     def last_login(self, new_value):
@@ -90,41 +196,43 @@ class DjangoUserProxy(models.Model):
         return True
 
     def set_password(self, raw_password):
-        return self._cassandra_user.set_password(raw_password)
+        session_hash.forget_session_auth_hash(self.username)
+        return self.cassandra_user.set_password(raw_password)
 
     def check_password(self, raw_password):
-        return self._cassandra_user.check_password(raw_password)
+        return self._user_data.check_password(raw_password)
 
     def set_unusable_password(self):
-        return self._cassandra_user.set_unusable_password()
+        session_hash.forget_session_auth_hash(self.username)
+        return self.cassandra_user.set_unusable_password()
 
     def has_usable_password(self):
-        return self._cassandra_user.has_usable_password()
-
-    def get_session_auth_hash(self):
-        return self._cassandra_user.get_session_auth_hash()
+        return self._user_data.has_usable_password()
 
     def get_full_name(self):
-        return self._cassandra_user.get_full_name()
+        return self._user_data.get_full_name()
 
     def get_short_name(self):
-        return self._cassandra_user.get_short_name()
+        return self._user_data.get_short_name()
 
     def email_user(self, subject, message, from_email=None, **kwargs):
-        return self._cassandra_user.email_user(subject, message, from_email, **kwargs)
+        return self._user_data.email_user(subject, message, from_email, **kwargs)
 
     def __str__(self):
         return self.get_username()
 
     def get_session_auth_hash(self):
-        key_salt = "django.contrib.auth.models.AbstractBaseUser.get_session_auth_hash"
-        return salted_hmac(key_salt, self._cassandra_user.password).hexdigest()
+        if not self.is_hydrated():
+            # Avoid loading the user just to validate the session
+            return session_hash.get_session_auth_hash(utils.get_cassandra_user_model(),
+                                                      self.username)
+        return session_hash.compute_session_auth_hash(self._user_data.password)
 
     # ----- PermissionsMixin || Fake attributes
 
     @property
     def is_superuser(self):
-        return self._cassandra_user.is_superuser
+        return self._user_data.is_superuser
 
     @property
     def groups(self):
@@ -145,7 +253,7 @@ class DjangoUserProxy(models.Model):
         return set()
 
     def has_perm(self, perm, obj=None):
-        if self._cassandra_user.is_active and self._cassandra_user.is_superuser:
+        if self._user_data.is_active and self._user_data.is_superuser:
             return True
         return False
 
@@ -156,7 +264,7 @@ class DjangoUserProxy(models.Model):
         return True
 
     def has_module_perms(self, app_label):
-        if self._cassandra_user.is_active and self._cassandra_user.is_superuser:
+        if self._user_data.is_active and self._user_data.is_superuser:
             return True
         return False
 
@@ -176,27 +284,27 @@ class DjangoUserProxy(models.Model):
 
     @property
     def first_name(self):
-        return self._cassandra_user.first_name
+        return self._user_data.first_name
 
     @property
     def last_name(self):
-        return self._cassandra_user.last_name
+        return self._user_data.last_name
 
     @property
     def email(self):
-        return self._cassandra_user.email
+        return self._user_data.email
 
     @property
     def is_staff(self):
-        return self._cassandra_user.is_staff
+        return self._user_data.is_staff
 
     @property
     def is_active(self):
-        return self._cassandra_user.is_active
+        return self._user_data.is_active
 
     @property
     def date_joined(self):
-        return self._cassandra_user.date_joined
+        return self._user_data.date_joined
 
     # ----- AbstractUser || Fake methods
 
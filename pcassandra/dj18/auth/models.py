@@ -10,6 +10,14 @@ from django.utils.crypto import salted_hmac
 
 from cassandra.cqlengine import columns as cassandra_columns
 from cassandra.cqlengine import models as cassandra_models
+from cassandra.cqlengine.query import LWTException
+
+from pcassandra import identitymap
+from pcassandra import metrics
+from pcassandra import shmcache
+from pcassandra.dj18.auth import credential_cache
+from pcassandra.dj18.auth import search
+from pcassandra.dj18.auth import session_hash
 
 logger = logging.getLogger(__name__)
 
@@ -174,10 +182,89 @@ class CassandraAbstractUser(EmulatedAbstractUser, CassandraPermissionsMixin):
     """
     If you need a custom model for your user, just use
     CassandraAbstractUser as the superclass.
+
+    New users are inserted with `IF NOT EXISTS` (a lightweight transaction),
+    to ensure 'unique' usernames. Saving a user that was read from Cassandra
+    (or already saved) sends a plain UPDATE of the modified columns. The
+    username of a saved user can't be changed: it's the primary key, and
+    the old row would be left behind (with its entries in the search index).
+
+    If PCASSANDRA_USER_SEARCH_INDEX is True, the search index of the
+    admin (see search.py) is updated on save() and delete().
     """
-    _if_not_exists = True  # required by cqlengine to ensure 'unique' usernames
     __abstract__ = True
 
+    @classmethod
+    def get(cls, *args, **kwargs):
+        """
+        Like cqlengine's get(), but lookups by username are done only
+        once per request (see pcassandra.identitymap)
+        """
+        if args or list(kwargs) != ['username']:
+            return super(CassandraAbstractUser, cls).get(*args, **kwargs)
+        return identitymap.get('cassandra_user', kwargs['username'],
+                               lambda: super(CassandraAbstractUser, cls).get(**kwargs))
+
+    def save(self):
+        if self._is_persisted and self._values['username'].changed:
+            raise ValueError("The username of user '{}' can't be changed".format(
+                self._values['username'].previous_value))
+        if self._can_update():
+            return self._save_update()
+        return self._save_create()
+
+    def _save_create(self):
+        """Inserts the user, failing (LWTException) if the username already exists"""
+        self.if_not_exists(True)
+        try:
+            result = super(CassandraAbstractUser, self).save()
+        except LWTException:
+            metrics.incr('auth.user.create.conflicts')
+            raise
+        self._invalidate_cached_copies(password_changed=False)
+        if search.is_enabled():
+            search.update_index(self.username, {}, self._get_search_values())
+        return result
+
+    def _save_update(self):
+        """Updates the changed columns. Nothing is sent if no column was modified"""
+        changed_columns = self.get_changed_columns()
+        if not changed_columns:
+            return self
+        old_search_values = self._get_search_values(previous=True)
+        self.if_not_exists(False)
+        result = self.update()
+        self._invalidate_cached_copies(
+            password_changed='password' in changed_columns,
+            active_changed='is_active' in changed_columns)
+        if search.is_enabled():
+            search.update_index(self.username, old_search_values, self._get_search_values())
+        return result
+
+    def delete(self):
+        result = super(CassandraAbstractUser, self).delete()
+        self._invalidate_cached_copies(password_changed=True, active_changed=True)
+        if search.is_enabled():
+            search.update_index(self.username, self._get_search_values(previous=True), {})
+        return result
+
+    def _get_search_values(self, previous=False):
+        """Returns the values of the indexed fields (the saved ones if `previous`)"""
+        if previous:
+            return dict((name, self._values[name].previous_value)
+                        for name in search.SEARCH_FIELDS)
+        return dict((name, getattr(self, name)) for name in search.SEARCH_FIELDS)
+
+    def _invalidate_cached_copies(self, password_changed, active_changed=False):
+        identitymap.discard('user_snapshot', self.username)
+        user_cache = shmcache.get_user_cache()
+        if user_cache is not None:
+            user_cache.delete(self.username)
+        if password_changed:
+            session_hash.forget_session_auth_hash(self.username)
+        if password_changed or active_changed:
+            credential_cache.forget_credentials(self.username)
+
 
 class CassandraUser(CassandraAbstractUser):
     pass
@@ -0,0 +1,197 @@
+"""
+Paging and prefix search of the Cassandra users, for the Django admin
+(see dj18/auth/admin.py).
+
+Cassandra can't search by a column that is not part of the primary key
+(without a full scan), so the users are searched by prefix with an index
+table, maintained by CassandraAbstractUser.save() and delete() when
+PCASSANDRA_USER_SEARCH_INDEX is True:
+
+    PCASSANDRA_USER_SEARCH_INDEX = True
+
+For each user, and each field of SEARCH_FIELDS, the index has a row
+in the partition (field, first PREFIX_LENGTH characters of the value),
+sorted by the value. A search for 'john' reads the partition
+('username', 'joh') from the value 'john' on, until the values stop
+starting with 'john'. Searches must have at least PREFIX_LENGTH
+characters. The values are indexed lowercased.
+
+To index the existing users (and remove the entries of the users that
+no longer exist, or whose values changed), run
+`pcassandra_rebuild_search_index`.
+
+The list of all the users is paged by token (the users are listed in
+the order of the partitioner, not alphabetically), since the driver
+doesn't allow resuming a query from a saved paging state.
+"""
+import logging
+
+from django import VERSION
+from django.conf import settings
+
+from cassandra.cqlengine import columns as cassandra_columns
+from cassandra.cqlengine import models as cassandra_models
+from cassandra.query import SimpleStatement
+
+from pcassandra import connection
+
+logger = logging.getLogger(__name__)
+
+assert VERSION[0] == 1 and VERSION[1] == 8, "Django 1.8 required"
+
+SEARCH_FIELDS = ('username', 'email', 'last_name')
+
+PREFIX_LENGTH = 3
+
+# Columns shown in the admin
+LIST_COLUMNS = ('username', 'email', 'first_name', 'last_name', 'is_staff', 'is_active')
+
+
+class CassandraUserSearchIndex(cassandra_models.Model):
+    """Prefix index of the users (see search.py)"""
+    field = cassandra_columns.Text(partition_key=True)
+    prefix = cassandra_columns.Text(partition_key=True)
+    value = cassandra_columns.Text(primary_key=True)
+    username = cassandra_columns.Text(primary_key=True)
+
+
+def is_enabled():
+    return getattr(settings, 'PCASSANDRA_USER_SEARCH_INDEX', False)
+
+
+def normalize(value):
+    return (value or '').strip().lower()
+
+
+def get_index_entries(values):
+    """
+    Returns the set of (field, prefix, value) of the index entries for
+    `values` (a dict {field: value} of the fields of SEARCH_FIELDS)
+    """
+    entries = set()
+    for field in SEARCH_FIELDS:
+        value = normalize(values.get(field))
+        if value:
+            entries.add((field, value[:PREFIX_LENGTH], value))
+    return entries
+
+
+def _prepare(query):
+    return connection.prepare(query.format(table=CassandraUserSearchIndex.column_family_name()))
+
+
+def update_index(username, old_values, new_values):
+    """
+    Updates the index entries of the user: removes the entries of
+    `old_values` and adds the entries of `new_values` (dicts {field: value})
+    """
+    old_entries = get_index_entries(old_values)
+    new_entries = get_index_entries(new_values)
+    insert = _prepare("INSERT INTO {table} (field, prefix, value, username) "
+                      "VALUES (?, ?, ?, ?)")
+    delete = _prepare("DELETE FROM {table} "
+                      "WHERE field = ? AND prefix = ? AND value = ? AND username = ?")
+    session = connection.get_session()
+    futures = [session.execute_async(delete, list(entry) + [username])
+               for entry in old_entries - new_entries]
+    futures.extend(session.execute_async(insert, list(entry) + [username])
+                   for entry in new_entries - old_entries)
+    for future in futures:
+        future.result()
+
+
+def iter_index_entries(page_size=500):
+    """Yields all the entries of the index, as (field, prefix, value, username)"""
+    statement = SimpleStatement(
+        "SELECT field, prefix, value, username FROM {}".format(
+            CassandraUserSearchIndex.column_family_name()),
+        fetch_size=page_size)
+    # The driver reads the next page as the rows are consumed
+    for row in connection.get_session().execute(statement):
+        yield row['field'], row['prefix'], row['value'], row['username']
+
+
+def get_stale_entries(model_class, entries):
+    """
+    Returns the entries of `entries` (tuples (field, prefix, value, username))
+    that don't match the current values of the users
+    """
+    columns = [model_class._columns[name].db_field_name for name in SEARCH_FIELDS]
+    rows = connection.fetch_rows(model_class, model_class._columns['username'].db_field_name,
+                                 set(entry[3] for entry in entries), columns=columns)
+    current_entries = {}
+    for username, row in rows.items():
+        current_entries[username] = get_index_entries(
+            dict((name, row[column]) for name, column in zip(SEARCH_FIELDS, columns)))
+    return [entry for entry in entries
+            if entry[:3] not in current_entries.get(entry[3], ())]
+
+
+def delete_entries(entries):
+    """Deletes the entries (tuples (field, prefix, value, username)) from the index"""
+    delete = _prepare("DELETE FROM {table} "
+                      "WHERE field = ? AND prefix = ? AND value = ? AND username = ?")
+    session = connection.get_session()
+    futures = [session.execute_async(delete, list(entry)) for entry in entries]
+    for future in futures:
+        future.result()
+
+
+def search(field, query, after=None, limit=50):
+    """
+    Returns a list of (value, username), of up to `limit` users whose `field`
+    starts with `query`, sorted by value. `after` is the (value, username)
+    of the last user of the previous page.
+    """
+    assert field in SEARCH_FIELDS
+    query = normalize(query)
+    if len(query) < PREFIX_LENGTH:
+        raise ValueError("The search requires at least {} characters".format(PREFIX_LENGTH))
+    prefix = query[:PREFIX_LENGTH]
+    if after is None:
+        # No username is '', so this is the first value >= query
+        after = (query, '')
+    rows = connection.get_session().execute(
+        _prepare("SELECT value, username FROM {table} "
+                 "WHERE field = ? AND prefix = ? AND (value, username) > (?, ?) LIMIT ?"),
+        [field, prefix, after[0], after[1], limit])
+    results = []
+    for row in rows:
+        if not row['value'].startswith(query):
+            # Sorted by value: the next rows doesn't match either
+            break
+        results.append((row['value'], row['username']))
+    return results
+
+
+def list_users(model_class, after=None, limit=50):
+    """
+    Returns a page of users (as dicts with the columns of LIST_COLUMNS),
+    in token order. `after` is the username of the last user of the
+    previous page.
+    """
+    columns = [model_class._columns[name].db_field_name for name in LIST_COLUMNS]
+    username_column = model_class._columns['username'].db_field_name
+    query = "SELECT {} FROM {}".format(', '.join(columns), model_class.column_family_name())
+    if after is None:
+        rows = connection.get_session().execute(connection.prepare(query + " LIMIT ?"),
+                                                [limit])
+    else:
+        rows = connection.get_session().execute(
+            connection.prepare(query + " WHERE token({col}) > token(?) LIMIT ?".format(
+                col=username_column)),
+            [after, limit])
+    return [_to_field_names(model_class, row) for row in rows]
+
+
+def get_users(model_class, usernames):
+    """Returns the users (as dicts with the LIST_COLUMNS), in the order of `usernames`"""
+    columns = [model_class._columns[name].db_field_name for name in LIST_COLUMNS]
+    rows = connection.fetch_rows(model_class, model_class._columns['username'].db_field_name,
+                                 usernames, columns=columns)
+    return [_to_field_names(model_class, rows[username])
+            for username in usernames if username in rows]
+
+
+def _to_field_names(model_class, row):
+    return dict((name, row[model_class._columns[name].db_field_name]) for name in LIST_COLUMNS)
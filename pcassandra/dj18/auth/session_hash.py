@@ -0,0 +1,124 @@
+"""
+Validation of sessions without loading the user.
+
+On each request, Django's `auth.get_user()` calls the backend's
+`get_user()` and compares the hash stored in the session (at login)
+with `user.get_session_auth_hash()`, an HMAC of the password hash.
+
+When PCASSANDRA_AUTH_LAZY_USER is True, ModelBackend.get_user() returns
+a DjangoUserProxy without reading the user from Cassandra, and
+`get_session_auth_hash()` is resolved here:
+
+* from a local cache of the hashes (PCASSANDRA_SESSION_AUTH_HASH_CACHE_TTL
+  seconds, 60 by default), so most of the requests need no user read at all
+* or reading just the password column of the user
+
+The rest of the user is loaded only if the view accesses its attributes.
+
+Keep in mind that a password changed by another process is detected
+after (at most) PCASSANDRA_SESSION_AUTH_HASH_CACHE_TTL seconds.
+
+If Cassandra is not available and the hash is not in the caches,
+SessionAuthHashUnavailable is raised: returning a hash that doesn't
+match would make Django flush the session of the user. In that case
+ModelBackend.get_user() returns None, so the request is anonymous but
+the session is kept.
+"""
+import logging
+
+from django.conf import settings
+from django.utils.crypto import salted_hmac
+
+from pcassandra import circuitbreaker
+from pcassandra import connection
+from pcassandra import metrics
+from pcassandra.localcache import LocalCache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_TTL = 60
+DEFAULT_CACHE_SIZE = 10000
+
+
+class SessionAuthHashUnavailable(Exception):
+    """Raised when the hash can't be read from Cassandra and is not cached"""
+    pass
+
+
+_hash_cache = None
+_fallback_cache = None
+
+
+def is_lazy_user_enabled():
+    return getattr(settings, 'PCASSANDRA_AUTH_LAZY_USER', False)
+
+
+def _get_hash_cache():
+    global _hash_cache
+    if _hash_cache is None:
+        _hash_cache = LocalCache(
+            max_size=DEFAULT_CACHE_SIZE,
+            ttl=getattr(settings, 'PCASSANDRA_SESSION_AUTH_HASH_CACHE_TTL', DEFAULT_CACHE_TTL))
+    return _hash_cache
+
+
+def _get_fallback_cache():
+    global _fallback_cache
+    if _fallback_cache is None:
+        _fallback_cache = circuitbreaker.create_fallback_cache()
+    return _fallback_cache
+
+
+def compute_session_auth_hash(password):
+    """Like Django's AbstractBaseUser.get_session_auth_hash()"""
+    key_salt = "django.contrib.auth.models.AbstractBaseUser.get_session_auth_hash"
+    return salted_hmac(key_salt, password).hexdigest()
+
+
+def remember_session_auth_hash(username, password):
+    """Stores the hash of the user, to avoid reading it again from Cassandra"""
+    session_auth_hash = compute_session_auth_hash(password)
+    _get_hash_cache().set(username, session_auth_hash)
+    _get_fallback_cache().set(username, session_auth_hash)
+    return session_auth_hash
+
+
+def forget_session_auth_hash(username):
+    """Must be called when the password of the user is changed"""
+    _get_hash_cache().delete(username)
+    _get_fallback_cache().delete(username)
+
+
+def get_session_auth_hash(model_class, username):
+    """
+    Returns the session auth hash of the user, or '' if the user doesn't exists
+    (so the session is not valid anymore). Raises SessionAuthHashUnavailable
+    if Cassandra is not available and the hash is not in the fallback cache.
+    """
+    session_auth_hash = _get_hash_cache().get(username)
+    if session_auth_hash is not None:
+        metrics.incr('auth.session_hash.cache_hits')
+        return session_auth_hash
+
+    metrics.incr('auth.session_hash.cache_misses')
+    password_column = model_class._columns['password'].db_field_name
+    try:
+        row = circuitbreaker.get_breaker('auth').call(
+            connection.fetch_row,
+            model_class,
+            columns=[password_column],
+            timeout=circuitbreaker.get_latency_budget('AUTH_GET_USER'),
+            username=username)
+    except (circuitbreaker.CircuitOpenError, circuitbreaker.UNAVAILABLE_ERRORS) as e:
+        logger.warning("get_session_auth_hash(): Cassandra not available, "
+                       "using fallback cache for '%s': %s", username, e)
+        session_auth_hash = _get_fallback_cache().get(username)
+        if session_auth_hash is None:
+            metrics.incr('auth.session_hash.unavailable')
+            raise SessionAuthHashUnavailable(
+                "Session auth hash of '{}' not available".format(username)) from e
+        return session_auth_hash
+
+    if row is None:
+        return ''
+    return remember_session_auth_hash(username, row[password_column])
@@ -0,0 +1,352 @@
+"""
+Compact, immutable copy of the user, used in the read path of
+authentication (ModelBackend.authenticate() and get_user()).
+
+An instance of a cqlengine model carries the column descriptors, the
+value managers used to track changes, the Set columns for groups and
+permissions, etc. A CassandraUserSnapshot holds just the columns used
+by DjangoUserProxy, in a `__slots__` based object built from a row tuple.
+
+When the snapshot is read from Cassandra (`fetch()` and `fetch_many()`)
+only the columns needed to authenticate the user and validate the
+session are selected: AUTH_FIELDS, plus the columns declared in the
+PCASSANDRA_AUTH_EXTRA_COLUMNS setting. The other columns (first_name,
+email, etc., and the columns added by subclasses of CassandraAbstractUser)
+are read from Cassandra, all at once, the first time one of them is
+accessed.
+
+The snapshots are shared between threads (identity map, fallback and
+shared caches), so they are never modified: the lazily read columns are
+kept in a new dict, published with a single assignment. The read goes
+through the 'auth' circuit breaker, waiting at most the AUTH_GET_USER
+latency budget (see pcassandra.circuitbreaker): while Cassandra is not
+available, accessing a not-loaded column raises CircuitOpenError (or
+OperationTimedOut) instead of blocking the request.
+
+Example settings:
+
+    PCASSANDRA_AUTH_EXTRA_COLUMNS = ['email']
+
+The full cqlengine model is only required to modify the user.
+"""
+from django import VERSION
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, is_password_usable
+from django.core.mail import send_mail
+from django.utils.crypto import salted_hmac
+
+from pcassandra import circuitbreaker
+from pcassandra import connection
+from pcassandra import metrics
+from pcassandra import shmcache
+from pcassandra import singleflight
+
+assert VERSION[0] == 1 and VERSION[1] == 8, "Django 1.8 required"
+
+
+def get_auth_extra_columns():
+    """Returns the names of the columns to read in the auth path, besides AUTH_FIELDS"""
+    return tuple(getattr(settings, 'PCASSANDRA_AUTH_EXTRA_COLUMNS', ()))
+
+
+class CassandraUserSnapshot:
+    """Read-only copy of the columns of the user required by the auth path"""
+
+    FIELDS = (
+        'username',
+        'password',
+        'last_login',
+        'first_name',
+        'last_name',
+        'email',
+        'is_staff',
+        'is_active',
+        'is_superuser',
+        'date_joined',
+    )
+
+    # Columns selected by fetch() and fetch_many()
+    AUTH_FIELDS = (
+        'username',
+        'password',
+        'is_active',
+        'is_staff',
+        'is_superuser',
+    )
+
+    # `_extra` holds the loaded columns that are not in FIELDS, `_model_class`
+    # is used to load the not-loaded columns, and `_lazy_values` holds them
+    # once loaded (None until then)
+    __slots__ = FIELDS + ('_extra', '_model_class', '_lazy_values')
+
+    USERNAME_FIELD = 'username'
+
+    def __init__(self, *values):
+        if len(values) != len(self.FIELDS):
+            raise ValueError("CassandraUserSnapshot requires {} values, got {}".format(
+                len(self.FIELDS), len(values)))
+        self._init(zip(self.FIELDS, values))
+
+    def _init(self, items, model_class=None):
+        object.__setattr__(self, '_extra', {})
+        object.__setattr__(self, '_model_class', model_class)
+        object.__setattr__(self, '_lazy_values', None)
+        self._set_values(items)
+
+    def _set_values(self, items):
+        for name, value in items:
+            if name in self.FIELDS:
+                object.__setattr__(self, name, value)
+            else:
+                self._extra[name] = value
+
+    def __getattr__(self, name):
+        # Called only for the attributes not found: the not-loaded slots,
+        # and the columns not in FIELDS
+        if name in ('_extra', '_model_class', '_lazy_values'):
+            raise AttributeError(name)
+        if name in self._extra:
+            return self._extra[name]
+        lazy_values = self._lazy_values
+        if lazy_values is None:
+            model_class = self._model_class
+            if model_class is not None and (name in self.FIELDS or
+                                            name in model_class._columns):
+                lazy_values = self._load_remaining()
+        if lazy_values is None or name not in lazy_values:
+            raise AttributeError("'CassandraUserSnapshot' object has no attribute '{}'".format(
+                name))
+        return lazy_values[name]
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CassandraUserSnapshot is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("CassandraUserSnapshot is immutable")
+
+    def __getstate__(self):
+        return list(self.get_loaded_values().items()), self._model_class
+
+    def __setstate__(self, state):
+        items, model_class = state
+        self._init(items, model_class=model_class)
+
+    def __eq__(self, other):
+        # Like the Django models, compared by primary key: comparing the other
+        # columns could read them from Cassandra
+        return isinstance(other, CassandraUserSnapshot) and self.username == other.username
+
+    def __hash__(self):
+        return hash(self.username)
+
+    def __repr__(self):
+        return '<CassandraUserSnapshot: {}>'.format(self.username)
+
+    def __str__(self):
+        return self.get_username()
+
+    def _is_loaded(self, name):
+        try:
+            object.__getattribute__(self, name)
+        except AttributeError:
+            return name in self._extra or (self._lazy_values is not None and
+                                           name in self._lazy_values)
+        return True
+
+    def _load_remaining(self):
+        """
+        Reads from Cassandra all the columns of the user that were not loaded,
+        and returns them in a dict (also stored in `_lazy_values`)
+        """
+        model_class = self._model_class
+        names = [name for name in model_class._columns if not self._is_loaded(name)]
+        columns = [model_class._columns[name].db_field_name for name in names]
+        timeout = circuitbreaker.get_latency_budget('AUTH_GET_USER')
+
+        def load():
+            metrics.incr('auth.snapshot.lazy_loads')
+            return circuitbreaker.get_breaker('auth').call(
+                connection.fetch_row, model_class, columns=columns, timeout=timeout,
+                **{model_class._columns['username'].db_field_name: self.username})
+
+        # Threads sharing the snapshot (or holding copies of it) read it once
+        row = singleflight.do('user_snapshot_columns', (self.username, tuple(columns)), load,
+                              timeout=timeout)
+        if row is None:
+            raise model_class.DoesNotExist(
+                "User '{}' doesn't exists in Cassandra".format(self.username))
+        lazy_values = dict((name, row[column]) for name, column in zip(names, columns))
+        object.__setattr__(self, '_lazy_values', lazy_values)
+        return lazy_values
+
+    def get_loaded_values(self):
+        """Returns a dict {name: value} of the loaded columns"""
+        values = dict((name, getattr(self, name)) for name in self.FIELDS
+                      if self._is_loaded(name))
+        values.update(self._extra)
+        if self._lazy_values is not None:
+            values.update(self._lazy_values)
+        return values
+
+    def as_tuple(self):
+        """
+        Returns the values of FIELDS. Raises ValueError if any of them is not
+        loaded: it never reads Cassandra.
+        """
+        values = self.get_loaded_values()
+        missing = [name for name in self.FIELDS if name not in values]
+        if missing:
+            raise ValueError("Fields not loaded: {}".format(', '.join(missing)))
+        return tuple(values[name] for name in self.FIELDS)
+
+    @classmethod
+    def from_row(cls, row):
+        """Creates the snapshot from a tuple with the values of FIELDS"""
+        return cls(*row)
+
+    @classmethod
+    def from_cassandra_user(cls, cassandra_user):
+        """Creates the snapshot from an instance of the cqlengine model"""
+        snapshot = cls(*[getattr(cassandra_user, name) for name in cls.FIELDS])
+        snapshot._set_values((name, getattr(cassandra_user, name))
+                             for name in get_auth_extra_columns())
+        return snapshot
+
+    @classmethod
+    def _from_projection(cls, model_class, names, columns, row):
+        snapshot = cls.__new__(cls)
+        snapshot._init(((name, row[column]) for name, column in zip(names, columns)),
+                       model_class=model_class)
+        return snapshot
+
+    @classmethod
+    def from_loaded_values(cls, model_class, values):
+        """
+        Creates the snapshot from the dict returned by get_loaded_values().
+        The missing columns are read from Cassandra when accessed.
+        """
+        snapshot = cls.__new__(cls)
+        snapshot._init(values.items(), model_class=model_class)
+        return snapshot
+
+    @classmethod
+    def get_auth_fields(cls):
+        """Returns the names of the fields selected by fetch() and fetch_many()"""
+        fields = list(cls.AUTH_FIELDS)
+        fields.extend(name for name in get_auth_extra_columns() if name not in fields)
+        return fields
+
+    @classmethod
+    def get_db_columns(cls, model_class, fields=None):
+        """
+        Returns the name of the database columns of `fields` (by default,
+        the fields returned by get_auth_fields()) for `model_class`
+        """
+        if fields is None:
+            fields = cls.get_auth_fields()
+        return [model_class._columns[name].db_field_name for name in fields]
+
+    @classmethod
+    def fetch(cls, model_class, username, timeout=None):
+        """
+        Reads the auth columns of the user, and returns the snapshot.
+        Returns None if the user doesn't exists.
+        """
+        names = cls.get_auth_fields()
+        columns = cls.get_db_columns(model_class, names)
+        row = connection.fetch_row(model_class, columns=columns, timeout=timeout,
+                                   username=username)
+        if row is None:
+            return None
+        return cls._from_projection(model_class, names, columns, row)
+
+    @classmethod
+    def fetch_many(cls, model_class, usernames):
+        """
+        Reads the auth columns of the users concurrently, and returns a dict
+        {username: snapshot}. Users that don't exist are not included in the
+        returned dict.
+        """
+        names = cls.get_auth_fields()
+        columns = cls.get_db_columns(model_class, names)
+        rows = connection.fetch_rows(model_class, model_class._columns['username'].db_field_name,
+                                     set(usernames), columns=columns)
+        return dict((username, cls._from_projection(model_class, names, columns, row))
+                    for username, row in rows.items())
+
+    # ----- AbstractBaseUser
+
+    def get_username(self):
+        return self.username
+
+    def natural_key(self):
+        return (self.username,)
+
+    def is_anonymous(self):
+        return False
+
+    def is_authenticated(self):
+        return True
+
+    def check_password(self, raw_password):
+        return check_password(raw_password, self.password)
+
+    def has_usable_password(self):
+        return is_password_usable(self.password)
+
+    def get_session_auth_hash(self):
+        key_salt = "django.contrib.auth.models.AbstractBaseUser.get_session_auth_hash"
+        return salted_hmac(key_salt, self.password).hexdigest()
+
+    # ----- AbstractUser
+
+    def get_full_name(self):
+        full_name = '%s %s' % (self.first_name, self.last_name)
+        return full_name.strip()
+
+    def get_short_name(self):
+        return self.first_name
+
+    def email_user(self, subject, message, from_email=None, **kwargs):
+        send_mail(subject, message, from_email, [self.email], **kwargs)
+
+    # ----- PermissionsMixin
+
+    def get_group_permissions(self, obj=None):
+        return set()
+
+    def get_all_permissions(self, obj=None):
+        return set()
+
+    def has_perm(self, perm, obj=None):
+        return bool(self.is_active and self.is_superuser)
+
+    def has_perms(self, perm_list, obj=None):
+        for perm in perm_list:
+            if not self.has_perm(perm, obj):
+                return False
+        return True
+
+    def has_module_perms(self, app_label):
+        return bool(self.is_active and self.is_superuser)
+
+
+def get_shared_snapshot(model_class, username):
+    """Returns the snapshot of the user in the shared memory cache, or None"""
+    user_cache = shmcache.get_user_cache()
+    if user_cache is None:
+        return None
+    values = user_cache.get(username)
+    if values is None:
+        return None
+    return CassandraUserSnapshot.from_loaded_values(model_class, values)
+
+
+def set_shared_snapshot(user_snapshot):
+    """
+    Stores the snapshot in the shared memory cache (see pcassandra.shmcache),
+    if configured. Only the loaded columns are stored, as JSON.
+    """
+    user_cache = shmcache.get_user_cache()
+    if user_cache is not None:
+        user_cache.set(user_snapshot.username, user_snapshot.get_loaded_values())
@@ -0,0 +1,212 @@
+"""
+Throttling of the failed login attempts, per username and per client IP.
+
+Each call to ModelBackend.authenticate() hashes the password (even for
+users that don't exist), so the attempts must be rejected *before*
+hashing, or an attacker can use all the CPU of the servers.
+
+Example settings:
+
+    PCASSANDRA_LOGIN_THROTTLE = {
+        'WINDOW': 300,
+        'MAX_ATTEMPTS_PER_USERNAME': 10,
+        'MAX_ATTEMPTS_PER_IP': 100,
+        'FLUSH_INTERVAL': 5,
+        'DENY_LIST_SIZE': 10000,
+    }
+
+* WINDOW: the failed attempts are counted in windows of WINDOW seconds
+* MAX_ATTEMPTS_PER_USERNAME / MAX_ATTEMPTS_PER_IP: when the failed
+  attempts of a window reach the limit, the username (or IP) is rejected
+  until the window ends
+* FLUSH_INTERVAL: seconds between the writes of the counters to Cassandra
+* DENY_LIST_SIZE: maximum number of usernames and IPs in the local deny-list
+
+The failed attempts are counted in a Cassandra counter table, shared by
+all the processes, but the increments are first aggregated in the process
+and written (with execute_async()) at most every FLUSH_INTERVAL seconds.
+After each write, the totals are read back, and the usernames and IPs
+over the limit are added to a local deny-list. Rejected attempts are
+answered from the deny-list, without hashing and without any Cassandra
+read.
+
+The client IP is taken from REMOTE_ADDR by LoginThrottleMiddleware (see
+pcassandra.dj18.middleware), which must be enabled to throttle by IP.
+"""
+import collections
+import logging
+import threading
+import time
+
+from django import VERSION
+from django.conf import settings
+
+from cassandra.cqlengine import columns as cassandra_columns
+from cassandra.cqlengine import models as cassandra_models
+
+from pcassandra import connection
+from pcassandra import metrics
+from pcassandra.localcache import LocalCache
+
+logger = logging.getLogger(__name__)
+
+assert VERSION[0] == 1 and VERSION[1] == 8, "Django 1.8 required"
+
+DEFAULT_WINDOW = 300
+DEFAULT_MAX_ATTEMPTS_PER_USERNAME = 10
+DEFAULT_MAX_ATTEMPTS_PER_IP = 100
+DEFAULT_FLUSH_INTERVAL = 5
+DEFAULT_DENY_LIST_SIZE = 10000
+
+_local = threading.local()
+
+_login_throttle = None
+_login_throttle_configured = False
+_login_throttle_lock = threading.Lock()
+
+
+class LoginAttemptCounter(cassandra_models.Model):
+    """
+    Failed login attempts of a username or IP (`scope_key` is 'username:<name>'
+    or 'ip:<address>') in a window of time. Counters can't expire, but the
+    rows of past windows are never read again.
+    """
+    scope_key = cassandra_columns.Text(partition_key=True)
+    window = cassandra_columns.BigInt(partition_key=True)
+    attempts = cassandra_columns.Counter()
+
+
+def set_client_ip(ip):
+    _local.client_ip = ip
+
+
+def get_client_ip():
+    return getattr(_local, 'client_ip', None)
+
+
+class LoginThrottle:
+
+    def __init__(self, window=DEFAULT_WINDOW,
+                 max_attempts_per_username=DEFAULT_MAX_ATTEMPTS_PER_USERNAME,
+                 max_attempts_per_ip=DEFAULT_MAX_ATTEMPTS_PER_IP,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 deny_list_size=DEFAULT_DENY_LIST_SIZE):
+        self.window = window
+        self.max_attempts_per_username = max_attempts_per_username
+        self.max_attempts_per_ip = max_attempts_per_ip
+        self.flush_interval = flush_interval
+        self._deny_list = LocalCache(max_size=deny_list_size, ttl=window)
+        self._lock = threading.Lock()
+        # {(scope_key, window): increments not yet written to Cassandra}
+        self._pending = collections.Counter()
+        # {(scope_key, window): total read from Cassandra after the last flush}
+        self._totals = {}
+        self._last_flush = time.time()
+
+    def _get_window(self, now):
+        return int(now // self.window)
+
+    def _get_scope_keys(self, username, ip):
+        scope_keys = [('username:' + username, self.max_attempts_per_username)]
+        if ip:
+            scope_keys.append(('ip:' + ip, self.max_attempts_per_ip))
+        return scope_keys
+
+    def _deny(self, scope_key, window):
+        # Until the end of the window
+        self._deny_list.set(scope_key, True, ttl=(window + 1) * self.window - time.time())
+
+    def is_denied(self, username, ip=None):
+        """Returns True if the attempt must be rejected (only the local deny-list is checked)"""
+        self.flush_if_needed()
+        for scope_key, _ in self._get_scope_keys(username, ip):
+            if self._deny_list.get(scope_key):
+                metrics.incr('auth.throttle.denied')
+                return True
+        return False
+
+    def record_failure(self, username, ip=None):
+        """Counts a failed attempt of `username` from `ip`"""
+        window = self._get_window(time.time())
+        with self._lock:
+            for scope_key, max_attempts in self._get_scope_keys(username, ip):
+                key = (scope_key, window)
+                self._pending[key] += 1
+                if self._totals.get(key, 0) + self._pending[key] >= max_attempts:
+                    self._deny(scope_key, window)
+        self.flush_if_needed()
+
+    def flush_if_needed(self):
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Writes the pending increments to Cassandra, without waiting for the responses"""
+        with self._lock:
+            pending, self._pending = self._pending, collections.Counter()
+            self._last_flush = time.time()
+            current_window = self._get_window(self._last_flush)
+            self._totals = dict((key, total) for key, total in self._totals.items()
+                                if key[1] >= current_window)
+        if not pending:
+            return
+        metrics.incr('auth.throttle.flushes')
+
+        table = LoginAttemptCounter.column_family_name()
+        update = connection.prepare("UPDATE {} SET attempts = attempts + ? "
+                                    "WHERE scope_key = ? AND window = ?".format(table))
+        select = connection.prepare("SELECT attempts FROM {} "
+                                    "WHERE scope_key = ? AND window = ?".format(table))
+        session = connection.get_session()
+        for (scope_key, window), increment in pending.items():
+            future = session.execute_async(update, [increment, scope_key, window])
+            future.add_callbacks(callback=self._on_flushed,
+                                 callback_args=(session, select, scope_key, window),
+                                 errback=self._on_flush_error,
+                                 errback_args=(scope_key, increment))
+
+    def _on_flushed(self, result, session, select, scope_key, window):
+        future = session.execute_async(select, [scope_key, window])
+        future.add_callbacks(callback=self._on_total_read, callback_args=(scope_key, window),
+                             errback=self._on_flush_error, errback_args=(scope_key, 0))
+
+    def _on_total_read(self, rows, scope_key, window):
+        for row in rows:
+            total = row['attempts']
+            max_attempts = self.max_attempts_per_username \
+                if scope_key.startswith('username:') else self.max_attempts_per_ip
+            with self._lock:
+                self._totals[(scope_key, window)] = total
+            if total >= max_attempts:
+                self._deny(scope_key, window)
+
+    def _on_flush_error(self, error, scope_key, increment):
+        # The increments are not retried: counter updates are not idempotent
+        metrics.incr('auth.throttle.flush_errors')
+        logger.warning("Couldn't update login attempts of '%s' (%s attempts lost): %s",
+                       scope_key, increment, error)
+
+
+def get_login_throttle():
+    """Returns the LoginThrottle configured with PCASSANDRA_LOGIN_THROTTLE, or None"""
+    global _login_throttle, _login_throttle_configured
+    if not _login_throttle_configured:
+        # Two instances would split the pending counts of the failed attempts
+        with _login_throttle_lock:
+            if not _login_throttle_configured:
+                _login_throttle = _create_login_throttle()
+                _login_throttle_configured = True
+    return _login_throttle
+
+
+def _create_login_throttle():
+    config = getattr(settings, 'PCASSANDRA_LOGIN_THROTTLE', None)
+    if not config:
+        return None
+    return LoginThrottle(
+        window=config.get('WINDOW', DEFAULT_WINDOW),
+        max_attempts_per_username=config.get('MAX_ATTEMPTS_PER_USERNAME',
+                                             DEFAULT_MAX_ATTEMPTS_PER_USERNAME),
+        max_attempts_per_ip=config.get('MAX_ATTEMPTS_PER_IP', DEFAULT_MAX_ATTEMPTS_PER_IP),
+        flush_interval=config.get('FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL),
+        deny_list_size=config.get('DENY_LIST_SIZE', DEFAULT_DENY_LIST_SIZE))
@@ -0,0 +1,230 @@
+"""
+Django cache backend, storing the values in a Cassandra table.
+
+To use it, add to your settings:
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'pcassandra.dj18.cache.CassandraCache',
+            'TIMEOUT': 300,
+            'KEY_PREFIX': 'myapp',
+            'VERSION': 1,
+            'OPTIONS': {
+                'COMPRESS_MIN_LENGTH': 1024,
+                'MAX_LWT_RETRIES': 10,
+                'CONCURRENCY': 100,
+            }
+        }
+    }
+
+and sync the table with `pcassandra_sync_tables`.
+
+* the expiration is implemented with Cassandra's TTL
+* get_many(), set_many() and delete_many() send the requests
+  concurrently, with at most CONCURRENCY requests in flight
+* add() uses an `INSERT ... IF NOT EXISTS` and incr()/decr() use
+  `UPDATE ... IF value = <old value>` (lightweight transactions)
+* values are serialized with pickle, and compressed with zlib
+  when the serialized value is bigger than COMPRESS_MIN_LENGTH
+"""
+import logging
+import math
+import pickle
+import zlib
+
+from django import VERSION
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+from cassandra.concurrent import execute_concurrent_with_args
+from cassandra.cqlengine import columns as cassandra_columns
+from cassandra.cqlengine import models as cassandra_models
+
+from pcassandra import connection
+
+logger = logging.getLogger(__name__)
+
+assert VERSION[0] == 1 and VERSION[1] == 8, "Django 1.8 required"
+
+# Maximum TTL accepted by Cassandra (20 years)
+MAX_TTL = 20 * 365 * 24 * 60 * 60
+
+FLAG_PICKLE = b'p'
+FLAG_PICKLE_ZLIB = b'z'
+
+
+class CassandraCacheEntry(cassandra_models.Model):
+    cache_key = cassandra_columns.Text(primary_key=True)
+    value = cassandra_columns.Bytes()
+
+
+class CassandraCache(BaseCache):
+
+    def __init__(self, location, params):
+        super(CassandraCache, self).__init__(params)
+        options = params.get('OPTIONS', {})
+        self._compress_min_length = int(options.get('COMPRESS_MIN_LENGTH', 1024))
+        self._max_lwt_retries = int(options.get('MAX_LWT_RETRIES', 10))
+        self._concurrency = int(options.get('CONCURRENCY', 100))
+
+    # ----- Serialization
+
+    def _serialize(self, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) >= self._compress_min_length:
+            return FLAG_PICKLE_ZLIB + zlib.compress(data)
+        return FLAG_PICKLE + data
+
+    def _deserialize(self, data):
+        flag, data = data[:1], data[1:]
+        if flag == FLAG_PICKLE_ZLIB:
+            data = zlib.decompress(data)
+        return pickle.loads(data)
+
+    # ----- Cassandra
+
+    def _get_ttl(self, timeout=DEFAULT_TIMEOUT):
+        """
+        Returns the TTL for the timeout (0 means 'never expires'),
+        or None if the value must not be stored
+        """
+        if timeout == DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        if timeout is None:
+            return 0
+        if timeout <= 0:
+            return None
+        return min(int(math.ceil(timeout)), MAX_TTL)
+
+    def _prepare(self, query):
+        return connection.prepare(query.format(table=CassandraCacheEntry.column_family_name()))
+
+    def _select_statement(self):
+        return self._prepare("SELECT value FROM {table} WHERE cache_key = ?")
+
+    def _insert_statement(self, if_not_exists=False):
+        return self._prepare(
+            "INSERT INTO {table} (cache_key, value) VALUES (?, ?)" +
+            (" IF NOT EXISTS" if if_not_exists else "") +
+            " USING TTL ?")
+
+    def _delete_statement(self):
+        return self._prepare("DELETE FROM {table} WHERE cache_key = ?")
+
+    def _execute_concurrently(self, statement, params_list):
+        """
+        Sends one request for each element of `params_list`, with at most
+        CONCURRENCY requests in flight (so big batches don't exhaust the
+        connection pool). Returns the list of results, in the same order
+        of `params_list`. Raises the first error.
+        """
+        results = execute_concurrent_with_args(connection.get_session(), statement,
+                                               params_list, concurrency=self._concurrency)
+        return [result for _, result in results]
+
+    # ----- Django's cache API
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        ttl = self._get_ttl(timeout)
+        if ttl is None:
+            return False
+        rows = connection.get_session().execute(self._insert_statement(if_not_exists=True),
+                                                [key, self._serialize(value), ttl])
+        return bool(rows[0]['[applied]'])
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        rows = connection.get_session().execute(self._select_statement(), [key])
+        if not rows:
+            return default
+        return self._deserialize(rows[0]['value'])
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        ttl = self._get_ttl(timeout)
+        if ttl is None:
+            connection.get_session().execute(self._delete_statement(), [key])
+        else:
+            connection.get_session().execute(self._insert_statement(),
+                                             [key, self._serialize(value), ttl])
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        connection.get_session().execute(self._delete_statement(), [key])
+
+    def get_many(self, keys, version=None):
+        keys_map = {}
+        for key in keys:
+            cache_key = self.make_key(key, version=version)
+            self.validate_key(cache_key)
+            keys_map[cache_key] = key
+        cache_keys = list(keys_map)
+        results = self._execute_concurrently(self._select_statement(),
+                                             [[cache_key] for cache_key in cache_keys])
+        values = {}
+        for cache_key, rows in zip(cache_keys, results):
+            if rows:
+                values[keys_map[cache_key]] = self._deserialize(rows[0]['value'])
+        return values
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        rows = connection.get_session().execute(
+            self._prepare("SELECT cache_key FROM {table} WHERE cache_key = ?"), [key])
+        return bool(rows)
+
+    def incr(self, key, delta=1, version=None):
+        """
+        Increments the value with a compare-and-set (LWT), keeping
+        the remaining TTL of the value.
+        """
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        session = connection.get_session()
+        select = self._prepare("SELECT value, TTL(value) AS ttl FROM {table} WHERE cache_key = ?")
+        update = self._prepare("UPDATE {table} USING TTL ? SET value = ? "
+                               "WHERE cache_key = ? IF value = ?")
+        for _ in range(self._max_lwt_retries):
+            rows = session.execute(select, [key])
+            if not rows:
+                raise ValueError("Key '%s' not found" % key)
+            old_data = rows[0]['value']
+            new_value = self._deserialize(old_data) + delta
+            result = session.execute(update, [rows[0]['ttl'] or 0, self._serialize(new_value),
+                                              key, old_data])
+            if result[0]['[applied]']:
+                return new_value
+            logger.debug("incr(): LWT for '%s' not applied, retrying", key)
+        raise ValueError("Couldn't increment '%s': too many concurrent updates" % key)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        ttl = self._get_ttl(timeout)
+        params_list = []
+        for key, value in data.items():
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+            if ttl is None:
+                params_list.append([key])
+            else:
+                params_list.append([key, self._serialize(value), ttl])
+        if ttl is None:
+            self._execute_concurrently(self._delete_statement(), params_list)
+        else:
+            self._execute_concurrently(self._insert_statement(), params_list)
+
+    def delete_many(self, keys, version=None):
+        params_list = []
+        for key in keys:
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+            params_list.append([key])
+        self._execute_concurrently(self._delete_statement(), params_list)
+
+    def clear(self):
+        connection.get_session().execute(
+            "TRUNCATE {}".format(CassandraCacheEntry.column_family_name()))
@@ -0,0 +1,25 @@
+import logging
+import uuid
+
+from django import VERSION
+from cassandra.cqlengine import columns as cassandra_columns
+from cassandra.cqlengine import models as cassandra_models
+
+logger = logging.getLogger(__name__)
+
+assert VERSION[0] == 1 and VERSION[1] == 8, "Django 1.8 required"
+
+
+class CassandraMessage(cassandra_models.Model):
+    """
+    Pending messages of `django.contrib.messages`. All the messages of a
+    session live in the same partition, ordered by creation time. The
+    partition key is an id stored in the session (see storage.py), not the
+    session key: it changes on login, and on every save of the sessions
+    stored in the cookie.
+    """
+    storage_key = cassandra_columns.Text(primary_key=True, max_length=40)
+    message_id = cassandra_columns.TimeUUID(primary_key=True, default=uuid.uuid1)
+    level = cassandra_columns.Integer()
+    message = cassandra_columns.Text()
+    extra_tags = cassandra_columns.Text()
@@ -0,0 +1,137 @@
+"""
+Storage for `django.contrib.messages`, that saves the messages in
+their own Cassandra table.
+
+Using Django's SessionStorage, each message modifies the session, and
+the whole session is written again. With this storage, adding a
+message is an INSERT in the partition of the session, and reading and
+removing the messages are single-partition operations.
+
+The partition is identified by a random id stored in the session (under
+STORAGE_KEY_SESSION_KEY) the first time a message is added, not by the
+session key: the id is kept by `cycle_key()` (ex: on login) and by the
+sessions stored in the cookie (see hybrid_backend.py), whose key changes
+on every save.
+
+The queries go through the 'session' circuit breaker, waiting at most
+the SESSION_LOAD latency budget. While Cassandra is not available the
+pending messages are not shown (nor deleted), and the new ones are lost.
+
+To use it, add to your settings:
+
+    MESSAGE_STORAGE = 'pcassandra.dj18.messages.storage.CassandraStorage'
+
+and sync the table with `pcassandra_sync_tables`.
+
+* PCASSANDRA_MESSAGES_TTL: seconds before not read messages expire
+  (default: 3600)
+"""
+import logging
+import time
+import uuid
+
+from cassandra.query import BatchStatement, BatchType
+from django.conf import settings
+from django.contrib.messages.storage.base import BaseStorage, Message
+
+from pcassandra import circuitbreaker
+from pcassandra import connection
+from pcassandra import metrics
+from pcassandra.dj18.messages.models import CassandraMessage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MESSAGES_TTL = 3600
+
+# Key of the session that holds the partition key of the messages
+STORAGE_KEY_SESSION_KEY = '_messages_storage_key'
+
+
+class CassandraStorage(BaseStorage):
+
+    def __init__(self, request, *args, **kwargs):
+        assert hasattr(request, 'session'), "The Cassandra messages storage requires " \
+            "session middleware to be installed. (Insert " \
+            "'django.contrib.sessions.middleware.SessionMiddleware' " \
+            "before 'django.contrib.messages.middleware.MessageMiddleware')"
+        super(CassandraStorage, self).__init__(request, *args, **kwargs)
+        # True if the messages couldn't be read: they must not be deleted
+        self._not_loaded = False
+
+    def _prepare(self, query):
+        return connection.prepare(query.format(table=CassandraMessage.column_family_name()))
+
+    def _execute(self, statement, params=None):
+        return circuitbreaker.get_breaker('session').call(
+            connection.get_session().execute, statement, params,
+            timeout=circuitbreaker.get_latency_budget('SESSION_LOAD'))
+
+    def _get_storage_key(self, create=False):
+        """Returns the partition key of the messages of the session (or None)"""
+        storage_key = self.request.session.get(STORAGE_KEY_SESSION_KEY)
+        if storage_key is None and create:
+            # Saved with the session by the session middleware
+            storage_key = self.request.session[STORAGE_KEY_SESSION_KEY] = uuid.uuid4().hex
+        return storage_key
+
+    def _get(self, *args, **kwargs):
+        storage_key = self._get_storage_key()
+        if storage_key is None:
+            return [], True
+        try:
+            rows = self._execute(
+                self._prepare("SELECT level, message, extra_tags FROM {table} "
+                              "WHERE storage_key = ?"),
+                [storage_key])
+        except (circuitbreaker.CircuitOpenError, circuitbreaker.UNAVAILABLE_ERRORS) as e:
+            logger.warning("Messages of the session not loaded: %s", e)
+            metrics.incr('messages.get.errors')
+            self._not_loaded = True
+            return [], True
+        messages = [Message(row['level'], row['message'], extra_tags=row['extra_tags'])
+                    for row in rows]
+        return messages, True
+
+    def _store(self, messages, response, *args, **kwargs):
+        """
+        Stores the messages. If the loaded messages were used, the partition
+        is deleted and the not-used messages are inserted again; if not, only
+        the new messages are inserted.
+        """
+        must_delete = self.used and not self._not_loaded
+        if self.used:
+            new_messages = messages
+            if not new_messages and not getattr(self, '_loaded_data', None):
+                # Nothing was stored, nothing to delete
+                return []
+        else:
+            new_messages = self._queued_messages
+            if not new_messages:
+                return []
+        if not new_messages and not must_delete:
+            return []
+        storage_key = self._get_storage_key(create=bool(new_messages))
+        if storage_key is None:
+            return []
+
+        # The DELETE and the INSERTs must have different timestamps, or the
+        # tombstone would hide the inserted messages
+        timestamp = int(time.time() * 1000000)
+        ttl = getattr(settings, 'PCASSANDRA_MESSAGES_TTL', DEFAULT_MESSAGES_TTL)
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        if must_delete:
+            batch.add(self._prepare("DELETE FROM {table} USING TIMESTAMP ? "
+                                    "WHERE storage_key = ?"),
+                      [timestamp, storage_key])
+        insert = self._prepare("INSERT INTO {table} "
+                               "(storage_key, message_id, level, message, extra_tags) "
+                               "VALUES (?, ?, ?, ?, ?) USING TTL ? AND TIMESTAMP ?")
+        for message in new_messages:
+            batch.add(insert, [storage_key, uuid.uuid1(), message.level,
+                               message.message, message.extra_tags, ttl, timestamp + 1])
+        try:
+            self._execute(batch)
+        except (circuitbreaker.CircuitOpenError, circuitbreaker.UNAVAILABLE_ERRORS) as e:
+            logger.warning("Messages of the session not stored: %s", e)
+            metrics.incr('messages.store.errors')
+        return []
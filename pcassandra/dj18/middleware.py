@@ -0,0 +1,41 @@
+from pcassandra import identitymap
+from pcassandra.dj18.auth import throttle
+
+
+class IdentityMapMiddleware:
+    """Django middleware, enables the request-scoped identity map (see identitymap.py)
+
+    To use it, add it to `MIDDLEWARE_CLASSES`, *before* the session and
+    auth middlewares:
+
+        MIDDLEWARE_CLASSES = (
+            'pcassandra.dj18.middleware.IdentityMapMiddleware',
+            'django.contrib.sessions.middleware.SessionMiddleware',
+            ...
+        )
+
+    """
+
+    def process_request(self, request):
+        identitymap.begin()
+
+    def process_response(self, request, response):
+        identitymap.end()
+        return response
+
+
+class LoginThrottleMiddleware:
+    """Django middleware, saves the IP of the client for the login throttling (see
+    dj18/auth/throttle.py)
+
+    The IP is taken from REMOTE_ADDR: if the application runs behind a
+    proxy or load balancer, it must be set (ex: from X-Forwarded-For) by
+    a previous middleware.
+    """
+
+    def process_request(self, request):
+        throttle.set_client_ip(request.META.get('REMOTE_ADDR'))
+
+    def process_response(self, request, response):
+        throttle.set_client_ip(None)
+        return response
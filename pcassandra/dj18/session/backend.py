@@ -1,13 +1,78 @@
 import logging
+import threading
 
+from django.conf import settings
 from django.contrib.sessions.backends.base import CreateError
 from django.contrib.sessions.backends.base import SessionBase as DjangoSessionBase
 from django.core.exceptions import SuspiciousOperation
 from django.utils import timezone
+from django.utils.crypto import salted_hmac
 from django.utils.encoding import force_text
 
 from cassandra.cqlengine.query import LWTException
 
+from pcassandra import circuitbreaker
+from pcassandra import connection
+from pcassandra import identitymap
+from pcassandra import metrics
+from pcassandra import singleflight
+
+logger = logging.getLogger(__name__)
+
+# Raw data of the recently loaded sessions, used while Cassandra is not available
+_fallback_cache = None
+
+
+def _get_fallback_cache():
+    global _fallback_cache
+    if _fallback_cache is None:
+        _fallback_cache = circuitbreaker.create_fallback_cache()
+    return _fallback_cache
+
+
+# ------------------------------------------------------------
+# pcassandra: asynchronous writes
+# ------------------------------------------------------------
+# When PCASSANDRA_SESSION_ASYNC_WRITES is True, the updates of
+# existing sessions are sent with `execute_async()` and save()
+# returns without waiting for the response. The errors are only
+# logged (and counted in 'session.save.async.errors'), so a write
+# can be lost.
+#
+# At most PCASSANDRA_SESSION_ASYNC_MAX_IN_FLIGHT writes are
+# pending at any time: when the limit is reached, the writes
+# are done synchronously.
+#
+# The creation of sessions is always synchronous, since it
+# requires the LWT to ensure the key is unique.
+# ------------------------------------------------------------
+
+DEFAULT_ASYNC_MAX_IN_FLIGHT = 100
+
+_async_writes_semaphore = None
+_async_writes_semaphore_lock = threading.Lock()
+
+
+def _get_async_writes_semaphore():
+    global _async_writes_semaphore
+    with _async_writes_semaphore_lock:
+        if _async_writes_semaphore is None:
+            _async_writes_semaphore = threading.BoundedSemaphore(
+                getattr(settings, 'PCASSANDRA_SESSION_ASYNC_MAX_IN_FLIGHT',
+                        DEFAULT_ASYNC_MAX_IN_FLIGHT))
+        return _async_writes_semaphore
+
+
+def _async_write_done(result, semaphore, session_key):
+    semaphore.release()
+    metrics.incr('session.save.async.completed')
+
+
+def _async_write_failed(error, semaphore, session_key):
+    semaphore.release()
+    metrics.incr('session.save.async.errors')
+    logger.error("Asynchronous save of session '%s...' failed: %s", session_key[:8], error)
+
 
 class SessionExpiredHack(Exception):
     """
@@ -19,15 +84,65 @@ class SessionExpiredHack(Exception):
 
 class CassandraSessionStore(DjangoSessionBase):
 
+    # Django salts the HMAC of the session data with the name of the class:
+    # fixed here, so the subclasses (dual-read, hybrid) read the sessions
+    # written by this class, and the other way around
+    HASH_KEY_SALT = "django.contrib.sessions" + "CassandraSessionStore"
+
     def __init__(self, session_key=None):
         super(CassandraSessionStore, self).__init__(session_key)
+        self.read_only = False
+
+    def _hash(self, value):
+        return salted_hmac(self.HASH_KEY_SALT, value).hexdigest()
+
+    def _get_session_row(self, session_key):
+        """
+        Returns the session row, waiting at most the 'SESSION_LOAD' latency budget.
+        Raises CassandraSession.DoesNotExist if the session doesn't exists.
+        Concurrent reads of the same session are collapsed into one query
+        (see pcassandra.singleflight).
+        """
+        timeout = circuitbreaker.get_latency_budget('SESSION_LOAD')
+        row = identitymap.get(
+            'session', session_key,
+            lambda: singleflight.do(
+                'session', session_key,
+                lambda: circuitbreaker.get_breaker('session').call(
+                    connection.fetch_row,
+                    models.CassandraSession,
+                    columns=['expire_date', 'session_data'],
+                    timeout=timeout,
+                    session_key=session_key),
+                timeout=timeout))
+        if row is None:
+            raise models.CassandraSession.DoesNotExist()
+        return row
+
+    def _load_degraded(self):
+        """
+        Called when Cassandra is not available. Returns the session data
+        from the local fallback cache, or an empty session. In both cases
+        the session is marked as read-only, to avoid overwriting the
+        real session with stale or empty data.
+        """
+        self.read_only = True
+        metrics.incr('session.load.degraded')
+        cached = _get_fallback_cache().get(self.session_key)
+        if cached is not None:
+            metrics.incr('session.load.fallback_hits')
+            expire_date, session_data = cached
+            if timezone.make_aware(expire_date) >= timezone.now():
+                return self.decode(session_data)
+        return {}
 
     def load(self):
+        with metrics.timed('session.load'):
+            return self._load()
+
+    def _load(self):
         try:
-            s = models.CassandraSession.get(
-                session_key=self.session_key,
-                # expire_date__gt=timezone.now()
-            )
+            s = self._get_session_row(self.session_key)
             # ------------------------------------------------------------
             # pcassandra: note on `expire_date__gt`
             # ------------------------------------------------------------
@@ -36,19 +151,27 @@ class CassandraSessionStore(DjangoSessionBase):
             # when the session is expired
             # ------------------------------------------------------------
 
-            tz_aware_expire_date = timezone.make_aware(s.expire_date)
+            tz_aware_expire_date = timezone.make_aware(s['expire_date'])
             if tz_aware_expire_date < timezone.now():
+                metrics.incr('session.load.expired')
                 raise SessionExpiredHack()
-            return self.decode(s.session_data)
+            session_dict = self.decode(s['session_data'])
+            _get_fallback_cache().set(self.session_key,
+                                      (s['expire_date'], s['session_data']))
+            return session_dict
         except (models.CassandraSession.DoesNotExist,
                 SuspiciousOperation,
                 SessionExpiredHack) as e:
             if isinstance(e, SuspiciousOperation):
-                logger = logging.getLogger('django.security.%s' %
+                security_logger = logging.getLogger('django.security.%s' %
                         e.__class__.__name__)
-                logger.warning(force_text(e))
+                security_logger.warning(force_text(e))
             self._session_key = None
             return {}
+        except (circuitbreaker.CircuitOpenError,
+                circuitbreaker.UNAVAILABLE_ERRORS) as e:
+            logger.warning("load(): Cassandra not available, using degraded session: %s", e)
+            return self._load_degraded()
 
     def exists(self, session_key):
         # ------------------------------------------------------------
@@ -67,6 +190,10 @@ class CassandraSessionStore(DjangoSessionBase):
             return False
 
     def create(self):
+        with metrics.timed('session.create'):
+            self._create()
+
+    def _create(self):
         while True:
             self._session_key = self._get_new_session_key()
             try:
@@ -75,6 +202,7 @@ class CassandraSessionStore(DjangoSessionBase):
                 self.save(must_create=True)
             except CreateError:
                 # Key wasn't unique. Try again.
+                metrics.incr('session.create.conflicts')
                 continue
             self.modified = True
             return
@@ -86,15 +214,29 @@ class CassandraSessionStore(DjangoSessionBase):
         create a *new* entry (as opposed to possibly updating an existing
         entry).
         """
+        if self.read_only:
+            logger.warning("save(): ignoring save() of read-only (degraded) session")
+            return
+
         if self.session_key is None:
             return self.create()
 
+        with metrics.timed('session.save'):
+            self._save(must_create)
+
+    def _save(self, must_create):
+        identitymap.discard('session', self.session_key)
         obj = models.CassandraSession(
             session_key=self._get_or_create_session_key(),
             session_data=self.encode(self._get_session(no_load=must_create)),
             expire_date=self.get_expiry_date(),
         )
 
+        if not must_create and getattr(settings, 'PCASSANDRA_SESSION_ASYNC_WRITES', False):
+            if self._save_async(obj):
+                return
+            metrics.incr('session.save.async.fallback_sync')
+
         try:
             # obj.save(force_insert=must_create)
             if must_create:
@@ -128,12 +270,35 @@ class CassandraSessionStore(DjangoSessionBase):
                 raise CreateError
             raise
 
+    def _save_async(self, obj):
+        """
+        Sends the INSERT without waiting for the response. Returns False
+        if there are too many writes in flight (the caller should
+        save synchronously).
+        """
+        semaphore = _get_async_writes_semaphore()
+        if not semaphore.acquire(False):
+            return False
+        try:
+            future = connection.get_session().execute_async(
+                models.get_insert_statement(),
+                [obj.session_key, obj.expire_date, obj.session_data])
+        except Exception:
+            semaphore.release()
+            raise
+        metrics.incr('session.save.async.sent')
+        future.add_callbacks(
+            callback=_async_write_done, callback_args=(semaphore, obj.session_key),
+            errback=_async_write_failed, errback_args=(semaphore, obj.session_key))
+        return True
+
     def delete(self, session_key=None):
         if session_key is None:
             if self.session_key is None:
                 return
             session_key = self.session_key
 
+        identitymap.discard('session', session_key)
         try:
             models.CassandraSession.get(session_key=session_key).delete()
         except models.CassandraSession.DoesNotExist:
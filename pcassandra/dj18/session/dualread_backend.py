@@ -0,0 +1,95 @@
+"""
+Session engine to migrate the sessions from Django's database backend
+to Cassandra, without logging out the users.
+
+Sessions are read from Cassandra first. If the session doesn't exists
+in Cassandra, it's read from the `django_session` table, and copied to
+Cassandra (with a TTL based on its `expire_date`). All the writes go to
+Cassandra, and delete() (logout) removes the session from both.
+
+The copy is best-effort: it goes through the 'session' circuit breaker and
+waits at most the SESSION_LOAD latency budget (COPY_TIMEOUT seconds if not
+set). If it fails, the session is still returned (counted in
+'session.dualread.copy_errors'), and copied on a later request.
+
+The data of the sessions is signed with a salt that depends on the
+session engine, so it's decoded with Django's database engine, and
+encoded again for Cassandra (with the salt of CassandraSessionStore,
+shared by this class).
+
+To use it, set:
+
+    SESSION_ENGINE = 'pcassandra.dj18.session.dualread_backend'
+
+(keep `django.contrib.sessions` in INSTALLED_APPS), and copy the existing
+sessions with the `pcassandra_copy_sessions` management command. Once
+the copy is done, switch to `pcassandra.dj18.session.backend`.
+"""
+import logging
+
+from django.contrib.sessions.backends.db import SessionStore as DjangoSessionStore
+from django.contrib.sessions.models import Session
+from django.utils import timezone
+
+from pcassandra import circuitbreaker
+from pcassandra import connection
+from pcassandra import metrics
+from pcassandra.dj18.session import models
+from pcassandra.dj18.session.backend import CassandraSessionStore
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the copy of a session, if there is no SESSION_LOAD budget
+COPY_TIMEOUT = 0.5
+
+
+class DualReadSessionStore(CassandraSessionStore):
+
+    def load(self):
+        session_key = self.session_key
+        session_dict = super(DualReadSessionStore, self).load()
+        if self.read_only or self._session_key is not None:
+            # Found in Cassandra, or Cassandra is not available
+            return session_dict
+
+        try:
+            s = Session.objects.get(session_key=session_key,
+                                    expire_date__gt=timezone.now())
+        except Session.DoesNotExist:
+            return session_dict
+
+        metrics.incr('session.dualread.sql_hits')
+        session_dict = DjangoSessionStore().decode(s.session_data)
+        self._session_key = session_key
+        ttl = models.get_ttl(s.expire_date)
+        if ttl > 0:
+            self._copy_session(s, session_dict, ttl)
+        return session_dict
+
+    def _copy_session(self, s, session_dict, ttl):
+        """Copies the session read from the database to Cassandra, if available"""
+        timeout = circuitbreaker.get_latency_budget('SESSION_LOAD') or COPY_TIMEOUT
+        try:
+            circuitbreaker.get_breaker('session').call(
+                connection.get_session().execute,
+                models.get_insert_statement(ttl=True, if_not_exists=True),
+                [s.session_key, s.expire_date, self.encode(session_dict), ttl],
+                timeout=timeout)
+        except (circuitbreaker.CircuitOpenError, circuitbreaker.UNAVAILABLE_ERRORS) as e:
+            metrics.incr('session.dualread.copy_errors')
+            logger.warning("Session '%s...' not copied to Cassandra: %s",
+                           s.session_key[:8], e)
+        else:
+            logger.debug("Session '%s...' copied to Cassandra", s.session_key[:8])
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        super(DualReadSessionStore, self).delete(session_key)
+        # Otherwise the next load() would copy it again from the database
+        Session.objects.filter(session_key=session_key).delete()
+
+
+SessionStore = DualReadSessionStore
@@ -0,0 +1,118 @@
+"""
+Session engine that keeps small sessions in the cookie, and only the
+big ones in Cassandra.
+
+Sessions whose serialized data (signed and compressed) is smaller than
+PCASSANDRA_SESSION_COOKIE_MAX_SIZE bytes (default: 2048) are stored in
+the cookie, like Django's `signed_cookies` engine: loading and saving
+them doesn't access Cassandra. Bigger sessions are stored in Cassandra,
+like `pcassandra.dj18.session.backend`, and the cookie holds the session
+key. When a session is saved, it's moved to the other tier if its size
+crossed the threshold.
+
+To use it, set:
+
+    SESSION_ENGINE = 'pcassandra.dj18.session.hybrid_backend'
+
+Keep in mind that, as with `signed_cookies`, the data of the small
+sessions can be read (but not modified) by the client, and that a
+session stored in the cookie can't be invalidated in the server.
+
+Signed cookies contain ':', and the session keys of Cassandra don't,
+so the tier of each session is known from the cookie.
+
+The sessions in Cassandra are signed like those of
+`pcassandra.dj18.session.backend` (same salt), so switching between
+both engines doesn't log out the users.
+"""
+import logging
+
+from django.conf import settings
+from django.core import signing
+
+from pcassandra import metrics
+from pcassandra.dj18.session.backend import CassandraSessionStore
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COOKIE_MAX_SIZE = 2048
+
+SALT = 'pcassandra.dj18.session.hybrid_backend'
+
+
+def is_cookie_session_key(session_key):
+    return bool(session_key) and ':' in session_key
+
+
+def is_cassandra_session_key(session_key):
+    return bool(session_key) and ':' not in session_key
+
+
+class HybridSessionStore(CassandraSessionStore):
+
+    # Not the default (the name of the class): the sessions in Cassandra
+    # must be readable by CassandraSessionStore, and the other way around
+    HASH_KEY_SALT = CassandraSessionStore.HASH_KEY_SALT
+
+    def _get_cookie_max_size(self):
+        return getattr(settings, 'PCASSANDRA_SESSION_COOKIE_MAX_SIZE', DEFAULT_COOKIE_MAX_SIZE)
+
+    def _dumps(self, session_dict):
+        return signing.dumps(session_dict, compress=True, salt=SALT, serializer=self.serializer)
+
+    def load(self):
+        if not is_cookie_session_key(self.session_key):
+            return super(HybridSessionStore, self).load()
+        try:
+            return signing.loads(self.session_key, serializer=self.serializer,
+                                 max_age=settings.SESSION_COOKIE_AGE, salt=SALT)
+        except Exception:
+            # BadSignature, expired, or invalid data: start a new session
+            self._session_key = None
+            return {}
+
+    def exists(self, session_key=None):
+        if is_cookie_session_key(session_key):
+            return False
+        return super(HybridSessionStore, self).exists(session_key)
+
+    def create(self):
+        """The key is assigned on save(), when the tier of the session is known"""
+        self._session_key = None
+        self.modified = True
+
+    def _create_in_cassandra(self):
+        """Creates the session in Cassandra, with a new (unique) session key"""
+        super(HybridSessionStore, self).create()
+
+    def save(self, must_create=False):
+        if self.read_only:
+            return super(HybridSessionStore, self).save(must_create)
+
+        data = self._dumps(self._get_session(no_load=must_create))
+        if len(data) <= self._get_cookie_max_size():
+            if is_cassandra_session_key(self.session_key):
+                # Shrank: move it to the cookie
+                metrics.incr('session.hybrid.to_cookie')
+                super(HybridSessionStore, self).delete(self.session_key)
+            self._session_key = data
+            return
+
+        if is_cassandra_session_key(self.session_key):
+            return super(HybridSessionStore, self).save(must_create)
+
+        if self.session_key is not None:
+            # Grew: move it to Cassandra
+            metrics.incr('session.hybrid.to_cassandra')
+        self._session_key = None
+        self._create_in_cassandra()
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            session_key = self.session_key
+        # Sessions stored in the cookie have nothing stored in the server
+        if is_cassandra_session_key(session_key):
+            super(HybridSessionStore, self).delete(session_key)
+
+
+SessionStore = HybridSessionStore
@@ -1,9 +1,14 @@
 import logging
 
+import math
+
 from django import VERSION
+from django.utils import timezone
 from cassandra.cqlengine import columns as cassandra_columns
 from cassandra.cqlengine import models as cassandra_models
 
+from pcassandra import connection
+
 logger = logging.getLogger(__name__)
 
 assert VERSION[0] == 1 and VERSION[1] == 8, "Django 1.8 required"
@@ -46,5 +51,23 @@ class CassandraSession(cassandra_models.Model):
     #     return DjangoSessionStore().decode(self.session_data)
 
 
+def get_insert_statement(ttl=False, if_not_exists=False):
+    """
+    Returns the prepared statement to insert a session. The parameters
+    are (session_key, expire_date, session_data), plus the TTL (in
+    seconds) if `ttl` is True.
+    """
+    return connection.prepare(
+        "INSERT INTO {} (session_key, expire_date, session_data) VALUES (?, ?, ?){}{}".format(
+            CassandraSession.column_family_name(),
+            " IF NOT EXISTS" if if_not_exists else "",
+            " USING TTL ?" if ttl else ""))
+
+
+def get_ttl(expire_date):
+    """Returns the seconds until `expire_date` (timezone aware), or 0 if it's expired"""
+    return max(int(math.ceil((expire_date - timezone.now()).total_seconds())), 0)
+
+
 # At bottom to avoid circular import
 from django.contrib.sessions.backends.db import SessionStore as DjangoSessionStore  # isort:skip
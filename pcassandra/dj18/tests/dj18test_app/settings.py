@@ -65,6 +65,8 @@ INSTALLED_APPS = (
     'dj18test_app',
 )
 MIDDLEWARE_CLASSES = (
+    'pcassandra.dj18.middleware.IdentityMapMiddleware',
+    'pcassandra.dj18.middleware.LoginThrottleMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -0,0 +1,20 @@
+from django import VERSION
+from django.http import HttpResponse
+
+from cassandra.cqlengine import CQLEngineException
+
+from pcassandra import connection
+from pcassandra import exporters
+
+assert VERSION[0] == 1 and VERSION[1] == 8, "Django 1.8 required"
+
+
+def prometheus_metrics(request):
+    """Metrics of pcassandra and of the driver, in Prometheus text format (see exporters.py)"""
+    try:
+        cluster = connection.get_cluster()
+    except CQLEngineException:
+        # The connection is not configured yet
+        cluster = None
+    return HttpResponse(exporters.render_prometheus(cluster),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,138 @@
+"""
+Exporters of the metrics of pcassandra (see metrics.py) and of the driver.
+
+Prometheus: add the view to your urls.py (and don't expose it to the
+internet):
+
+    url(r'^metrics$', 'pcassandra.dj18.views.prometheus_metrics'),
+
+The metrics of the driver are included if 'metrics_enabled': True is in
+the CLUSTER_KWARGS of CASSANDRA_CONNECTION.
+
+statsd: each update of the metrics is sent to statsd (UDP), when the
+setting is present:
+
+Example settings:
+
+    PCASSANDRA_METRICS_STATSD = {
+        'HOST': 'localhost',
+        'PORT': 8125,
+        'PREFIX': 'pcassandra',
+    }
+
+The emitter is registered by `connection.setup_connection()`.
+"""
+
+import logging
+import re
+import socket
+
+from django.conf import settings
+
+from pcassandra import metrics
+
+logger = logging.getLogger(__name__)
+
+PROMETHEUS_PREFIX = 'pcassandra_'
+
+DRIVER_METRICS = ('request_timer', 'connection_errors', 'write_timeouts', 'read_timeouts',
+                  'unavailables', 'other_errors', 'retries', 'ignores', 'known_hosts',
+                  'connected_to', 'open_connections')
+
+_statsd_emitter = None
+
+
+def get_driver_metrics(cluster):
+    """Returns the metrics of the driver (requires `metrics_enabled` in CLUSTER_KWARGS)"""
+    if not getattr(cluster, 'metrics', None):
+        return None
+    driver_metrics = {}
+    for name in DRIVER_METRICS:
+        value = getattr(cluster.metrics, name, None)
+        if isinstance(value, dict):
+            value = dict(value)
+        driver_metrics[name] = value
+    return driver_metrics
+
+
+def _prometheus_name(name):
+    return PROMETHEUS_PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def render_prometheus(cluster=None):
+    """
+    Returns the metrics, and the metrics of the driver of `cluster`,
+    in the Prometheus text format
+    """
+    lines = []
+    for name, value in sorted(metrics.get_counters().items()):
+        prometheus_name = _prometheus_name(name)
+        lines.append('# TYPE {} counter'.format(prometheus_name))
+        lines.append('{} {}'.format(prometheus_name, value))
+
+    for name, value in sorted(metrics.get_gauges().items()):
+        prometheus_name = _prometheus_name(name)
+        lines.append('# TYPE {} gauge'.format(prometheus_name))
+        lines.append('{} {}'.format(prometheus_name, value))
+
+    for name, (buckets, total, count) in sorted(metrics.get_histograms().items()):
+        prometheus_name = _prometheus_name(name + '_seconds')
+        lines.append('# TYPE {} histogram'.format(prometheus_name))
+        for bound, cumulative in buckets:
+            lines.append('{}_bucket{{le="{}"}} {}'.format(prometheus_name, bound, cumulative))
+        lines.append('{}_sum {}'.format(prometheus_name, total))
+        lines.append('{}_count {}'.format(prometheus_name, count))
+
+    driver_metrics = get_driver_metrics(cluster) if cluster is not None else None
+    for name, value in sorted((driver_metrics or {}).items()):
+        prometheus_name = _prometheus_name('driver.' + name)
+        if isinstance(value, dict):
+            lines.append('# TYPE {} gauge'.format(prometheus_name))
+            for stat, stat_value in sorted(value.items()):
+                if _is_number(stat_value):
+                    lines.append('{}{{stat="{}"}} {}'.format(prometheus_name, stat, stat_value))
+        elif _is_number(value):
+            lines.append('# TYPE {} gauge'.format(prometheus_name))
+            lines.append('{} {}'.format(prometheus_name, value))
+
+    return '\n'.join(lines) + '\n'
+
+
+class StatsdEmitter:
+    """Metrics listener that sends each update to statsd"""
+
+    def __init__(self, host='localhost', port=8125, prefix='pcassandra'):
+        self.address = (socket.gethostbyname(host), port)
+        self.prefix = prefix + '.' if prefix else ''
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def format(self, kind, name, value):
+        if kind == 'counter':
+            return '{}{}:{}|c'.format(self.prefix, name, value)
+        if kind == 'gauge':
+            return '{}{}:{}|g'.format(self.prefix, name, value)
+        return '{}{}:{:.3f}|ms'.format(self.prefix, name, value * 1000.0)
+
+    def __call__(self, kind, name, value):
+        try:
+            self._socket.sendto(self.format(kind, name, value).encode('utf-8'), self.address)
+        except socket.error as e:
+            logger.debug("Couldn't send metric '%s' to statsd: %s", name, e)
+
+
+def setup_statsd():
+    """Registers the statsd emitter, if PCASSANDRA_METRICS_STATSD is set"""
+    global _statsd_emitter
+    config = getattr(settings, 'PCASSANDRA_METRICS_STATSD', None)
+    if not config or _statsd_emitter is not None:
+        return
+    _statsd_emitter = StatsdEmitter(host=config.get('HOST', 'localhost'),
+                                    port=config.get('PORT', 8125),
+                                    prefix=config.get('PREFIX', 'pcassandra'))
+    metrics.add_listener(_statsd_emitter)
+    logger.info("Sending metrics to statsd at %s:%s", *_statsd_emitter.address)
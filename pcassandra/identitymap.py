@@ -0,0 +1,80 @@
+"""
+Request-scoped identity map: each user or session row is read from
+Cassandra at most once per request, and then reused.
+
+The identity map is active only between the calls to `begin()` and
+`end()`, done by `pcassandra.dj18.middleware.IdentityMapMiddleware`.
+Outside of a request, all the lookups go to Cassandra.
+
+The number of reads avoided is counted in the 'identity_map.<kind>.hits'
+metric (and the reads done in 'identity_map.<kind>.misses').
+"""
+
+import threading
+
+from pcassandra import metrics
+
+_local = threading.local()
+
+# Marker for lookups that returned None (ex: user not found)
+_NONE = object()
+
+
+def begin():
+    """Starts a new (empty) identity map for the current thread"""
+    _local.identity_map = {}
+
+
+def end():
+    """Discards the identity map of the current thread"""
+    _local.identity_map = None
+
+
+def is_active():
+    return getattr(_local, 'identity_map', None) is not None
+
+
+def get(kind, key, loader):
+    """
+    Returns the object of type `kind` identified by `key`. If it wasn't
+    loaded in the current request, `loader()` is called to load it.
+    """
+    identity_map = getattr(_local, 'identity_map', None)
+    if identity_map is None:
+        return loader()
+
+    try:
+        value = identity_map[(kind, key)]
+    except KeyError:
+        pass
+    else:
+        metrics.incr('identity_map.{}.hits'.format(kind))
+        return None if value is _NONE else value
+
+    metrics.incr('identity_map.{}.misses'.format(kind))
+    value = loader()
+    identity_map[(kind, key)] = _NONE if value is None else value
+    return value
+
+
+def put(kind, key, value):
+    """Stores the object in the identity map, replacing the loaded one (if any)"""
+    identity_map = getattr(_local, 'identity_map', None)
+    if identity_map is not None:
+        identity_map[(kind, key)] = _NONE if value is None else value
+
+
+def peek(kind, key):
+    """Returns the object if it was already loaded in the current request, or None"""
+    identity_map = getattr(_local, 'identity_map', None)
+    if identity_map is None:
+        return None
+    value = identity_map.get((kind, key))
+    return None if value is _NONE else value
+
+
+def discard(kind, key):
+    """Removes the object from the identity map (ex: because it was modified)"""
+    identity_map = getattr(_local, 'identity_map', None)
+    if identity_map is not None:
+        identity_map.pop((kind, key), None)
@@ -0,0 +1,123 @@
+import os
+import time
+
+from cassandra.concurrent import execute_concurrent_with_args
+from django.contrib.sessions.backends.db import SessionStore as DjangoSessionStore
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from pcassandra import connection
+from pcassandra.dj18.session import models as session_models
+from pcassandra.dj18.session.backend import CassandraSessionStore
+
+
+class Command(BaseCommand):
+    help = ("Copy the (not expired) sessions from Django's database "
+            "backend (django_session) to Cassandra")
+
+    def convert(self, session_data):
+        """Returns the data signed by Django's database engine, signed for Cassandra"""
+        return self.cassandra_store.encode(self.django_store.decode(session_data))
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, dest='chunk_size',
+                            help='Number of sessions read from the database on each query')
+        parser.add_argument('--concurrency', type=int, default=50, dest='concurrency',
+                            help='Maximum number of concurrent inserts to Cassandra')
+        parser.add_argument('--max-rate', type=float, default=0, dest='max_rate',
+                            help='Maximum number of sessions copied per second (0: no limit)')
+        parser.add_argument('--state-file', default=None, dest='state_file',
+                            help='File where the last copied session key is saved, '
+                                 'to resume the copy if interrupted')
+        parser.add_argument('--resume-from', default='', dest='resume_from',
+                            help='Copy the sessions after this session key')
+        parser.add_argument('--overwrite', action='store_true', default=False,
+                            dest='overwrite',
+                            help="Overwrite sessions that already exists in Cassandra "
+                                 "(by default, they're not modified)")
+
+    def read_state(self, state_file):
+        if state_file and os.path.exists(state_file):
+            with open(state_file) as f:
+                return f.read().strip()
+        return ''
+
+    def write_state(self, state_file, last_key):
+        if state_file:
+            with open(state_file + '.tmp', 'w') as f:
+                f.write(last_key)
+            os.rename(state_file + '.tmp', state_file)
+
+    def handle(self, *args, **options):
+        connection.setup_connection_if_unset()
+        state_file = options['state_file']
+        last_key = options['resume_from'] or self.read_state(state_file)
+        if last_key:
+            self.stdout.write("Resuming after session key '{}...'".format(last_key[:8]))
+
+        self.django_store = DjangoSessionStore()
+        self.cassandra_store = CassandraSessionStore()
+        statement = session_models.get_insert_statement(ttl=True,
+                                                        if_not_exists=not options['overwrite'])
+        copied = existing = 0
+        start = time.time()
+
+        while True:
+            # Sessions are read in chunks, ordered by primary key
+            chunk = list(Session.objects.filter(
+                session_key__gt=last_key,
+                expire_date__gt=timezone.now(),
+            ).order_by('session_key').values_list(
+                'session_key', 'session_data', 'expire_date')[:options['chunk_size']])
+            if not chunk:
+                break
+
+            params = []
+            # Position in `chunk` of each insert
+            positions = []
+            for position, (session_key, session_data, expire_date) in enumerate(chunk):
+                ttl = session_models.get_ttl(expire_date)
+                if ttl > 0:
+                    params.append([session_key, expire_date, self.convert(session_data), ttl])
+                    positions.append(position)
+
+            results = execute_concurrent_with_args(
+                connection.get_session(), statement, params,
+                concurrency=options['concurrency'], raise_on_first_error=False)
+            first_error = None
+            for (success, result), param, position in zip(results, params, positions):
+                if not success:
+                    self.stderr.write("Error copying session '{}...': {}".format(
+                        param[0][:8], result))
+                    if first_error is None:
+                        first_error = position
+                elif result and not result[0].get('[applied]', True):
+                    # IF NOT EXISTS: the session was already in Cassandra
+                    existing += 1
+                else:
+                    copied += 1
+
+            if first_error is not None:
+                # The state is saved before the first failed session: the
+                # next run copies it (and the rest of the chunk) again
+                if first_error > 0:
+                    self.write_state(state_file, chunk[first_error - 1][0])
+                raise CommandError("Errors copying the sessions: {} sessions copied, "
+                                   "{} already in Cassandra. Run it again to resume "
+                                   "the copy".format(copied, existing))
+
+            last_key = chunk[-1][0]
+            self.write_state(state_file, last_key)
+            self.stdout.write('{} sessions copied, {} already in Cassandra'.format(
+                copied, existing))
+
+            if options['max_rate']:
+                # Throttle: wait until the average rate is below the limit
+                expected_elapsed = (copied + existing) / options['max_rate']
+                elapsed = time.time() - start
+                if expected_elapsed > elapsed:
+                    time.sleep(expected_elapsed - elapsed)
+
+        self.stdout.write('Done: {} sessions copied, {} already in Cassandra, '
+                          'in {:.1f} seconds'.format(copied, existing, time.time() - start))
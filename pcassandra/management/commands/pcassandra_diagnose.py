@@ -0,0 +1,245 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cassandra.cluster import Cluster
+from cassandra.policies import HostDistance, LoadBalancingPolicy
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from pcassandra import connection
+from pcassandra import exporters
+from pcassandra import metrics
+
+PROBE_QUERY = "SELECT now() FROM system.local"
+
+PERCENTS = (50, 90, 99)
+
+
+class SingleHostPolicy(LoadBalancingPolicy):
+    """Load balancing policy that sends all the queries to one host"""
+
+    def __init__(self, address):
+        super(SingleHostPolicy, self).__init__()
+        self.address = address
+        self._hosts = []
+
+    def populate(self, cluster, hosts):
+        self._hosts = [host for host in hosts if host.address == self.address]
+
+    def distance(self, host):
+        if host.address == self.address:
+            return HostDistance.LOCAL
+        return HostDistance.IGNORED
+
+    def make_query_plan(self, working_keyspace=None, query=None):
+        return iter(self._hosts)
+
+    def on_up(self, host):
+        if host.address == self.address and host not in self._hosts:
+            self._hosts.append(host)
+
+    def on_down(self, host):
+        pass
+
+    def on_add(self, host):
+        self.on_up(host)
+
+    def on_remove(self, host):
+        if host in self._hosts:
+            self._hosts.remove(host)
+
+
+def _milliseconds(seconds):
+    return round(seconds * 1000.0, 3)
+
+
+def probe_host(address, probes, timeout):
+    """
+    Sends `probes` queries concurrently to the host, and returns a
+    tuple (latencies, errors), where latencies is the list of the
+    round-trip times (in seconds) of the successful queries.
+    """
+    cluster_kwargs = dict(settings.CASSANDRA_CONNECTION['CLUSTER_KWARGS'])
+    cluster_kwargs['load_balancing_policy'] = SingleHostPolicy(address)
+    if 'connection_class' not in cluster_kwargs:
+        connection_class = connection.get_connection_class()
+        if connection_class is not None:
+            cluster_kwargs['connection_class'] = connection_class
+    cluster = Cluster([address], **cluster_kwargs)
+    latencies = []
+    errors = []
+    done = threading.Event()
+    lock = threading.Lock()
+    # Set when the results are returned: the responses received after that
+    #  (ex: after the timeout) are ignored
+    finished = threading.Event()
+
+    def on_finish():
+        if len(latencies) + len(errors) == probes:
+            done.set()
+
+    def on_success(result, start):
+        with lock:
+            if not finished.is_set():
+                latencies.append(time.time() - start)
+                on_finish()
+
+    def on_error(error, start):
+        with lock:
+            if not finished.is_set():
+                errors.append(str(error))
+                on_finish()
+
+    try:
+        session = cluster.connect()
+        for _ in range(probes):
+            start = time.time()
+            future = session.execute_async(PROBE_QUERY)
+            future.add_callbacks(callback=on_success, callback_args=(start,),
+                                 errback=on_error, errback_args=(start,))
+        if not done.wait(timeout):
+            with lock:
+                errors.append('timeout waiting for the responses')
+    except Exception as e:
+        with lock:
+            errors.append(str(e))
+    finally:
+        with lock:
+            finished.set()
+            results = (list(latencies), list(errors))
+        cluster.shutdown()
+    return results
+
+
+def get_pool_stats(session):
+    """
+    Returns a dict {address: stats} with the size and the in-flight requests
+    of the connection pools of `session`.
+
+    The driver doesn't provide a public API for this, so this is
+    based on the internal attributes of the pools.
+    """
+    stats = {}
+    for host, pool in list(getattr(session, '_pools', {}).items()):
+        if hasattr(pool, '_connections'):
+            connections = list(pool._connections)
+        else:
+            connections = [pool._connection] if getattr(pool, '_connection', None) else []
+        stats[host.address] = {
+            'connections': len(connections),
+            'in_flight': sum(getattr(conn, 'in_flight', 0) for conn in connections),
+        }
+    return stats
+
+
+def get_schema_versions(session):
+    """Returns a dict {address: schema_version} of all the nodes, as seen by the coordinator"""
+    versions = {}
+    for row in session.execute("SELECT listen_address, schema_version FROM system.local"):
+        versions[str(row['listen_address'])] = str(row['schema_version'])
+    for row in session.execute("SELECT peer, schema_version FROM system.peers"):
+        versions[str(row['peer'])] = str(row['schema_version'])
+    return versions
+
+
+class Command(BaseCommand):
+    help = 'Report latency of each Cassandra host, connection pools and schema agreement'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--probes', type=int, default=20, dest='probes',
+                            help='Number of probe queries sent to each host')
+        parser.add_argument('--timeout', type=float, default=10.0, dest='timeout',
+                            help='Seconds to wait for the responses of each host')
+        parser.add_argument('--json', action='store_true', default=False, dest='json',
+                            help='Output in JSON format')
+
+    def handle(self, *args, **options):
+        connection.setup_connection_if_unset(set_default_keyspace=False)
+        session = connection.get_session()
+        cluster = connection.get_cluster()
+        hosts = list(cluster.metadata.all_hosts())
+        if not hosts:
+            raise CommandError("No hosts found")
+
+        with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+            futures = dict((host, executor.submit(probe_host, host.address,
+                                                  options['probes'], options['timeout']))
+                           for host in hosts)
+
+        report = {
+            'hosts': {},
+            'datacenters': {},
+            'pools': get_pool_stats(session),
+            'driver_metrics': exporters.get_driver_metrics(cluster),
+        }
+
+        latencies_by_dc = {}
+        for host, future in futures.items():
+            latencies, errors = future.result()
+            latencies_by_dc.setdefault(host.datacenter, []).extend(latencies)
+            report['hosts'][host.address] = {
+                'datacenter': host.datacenter,
+                'rack': host.rack,
+                'is_up': host.is_up,
+                'probes': len(latencies),
+                'errors': errors,
+                'rtt_ms': dict((p, _milliseconds(v))
+                               for p, v in metrics.percentiles(latencies, PERCENTS).items()),
+            }
+
+        for datacenter, latencies in latencies_by_dc.items():
+            report['datacenters'][datacenter] = {
+                'probes': len(latencies),
+                'rtt_ms': dict((p, _milliseconds(v))
+                               for p, v in metrics.percentiles(latencies, PERCENTS).items()),
+            }
+
+        schema_versions = get_schema_versions(session)
+        report['schema'] = {
+            'versions': schema_versions,
+            'agreement': len(set(schema_versions.values())) == 1,
+        }
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True, default=str))
+        else:
+            self.write_text_report(report)
+
+    def write_text_report(self, report):
+        def format_rtt(rtt):
+            if not rtt:
+                return '-'
+            return ' '.join('p{}={}ms'.format(p, rtt[p]) for p in PERCENTS)
+
+        self.stdout.write('--- Hosts')
+        for address, host in sorted(report['hosts'].items()):
+            self.stdout.write('{} (dc={}, rack={}, up={}): {} probes, {} errors, {}'.format(
+                address, host['datacenter'], host['rack'], host['is_up'],
+                host['probes'], len(host['errors']), format_rtt(host['rtt_ms'])))
+            for error in host['errors'][:3]:
+                self.stdout.write('    error: {}'.format(error))
+
+        self.stdout.write('--- Datacenters')
+        for datacenter, dc in sorted(report['datacenters'].items()):
+            self.stdout.write('{}: {} probes, {}'.format(datacenter, dc['probes'],
+                                                         format_rtt(dc['rtt_ms'])))
+
+        self.stdout.write('--- Connection pools')
+        for address, pool in sorted(report['pools'].items()):
+            self.stdout.write('{}: {} connections, {} in-flight requests'.format(
+                address, pool['connections'], pool['in_flight']))
+
+        self.stdout.write('--- Driver metrics')
+        if report['driver_metrics'] is None:
+            self.stdout.write("not available (add 'metrics_enabled': True to CLUSTER_KWARGS)")
+        else:
+            for name, value in sorted(report['driver_metrics'].items()):
+                self.stdout.write('{}: {}'.format(name, value))
+
+        self.stdout.write('--- Schema')
+        for address, version in sorted(report['schema']['versions'].items()):
+            self.stdout.write('{}: {}'.format(address, version))
+        self.stdout.write('agreement: {}'.format(
+            'OK' if report['schema']['agreement'] else 'DISAGREEMENT'))
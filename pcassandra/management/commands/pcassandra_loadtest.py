@@ -0,0 +1,347 @@
+import json
+import random
+import threading
+import time
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.crypto import get_random_string
+
+from cassandra.cqlengine import models as cassandra_models
+from cassandra.cqlengine.query import LWTException
+
+from pcassandra import connection
+from pcassandra import identitymap
+from pcassandra import metrics
+from pcassandra import schema
+from pcassandra import utils
+from pcassandra.dj18.auth.backend import ModelBackend
+from pcassandra.dj18.auth.django_models import DjangoUserProxy
+from pcassandra.dj18.session import models as session_models
+
+OPERATIONS = ('anonymous', 'page_view', 'login', 'logout')
+
+DEFAULT_MIX = 'anonymous=20,page_view=70,login=7,logout=3'
+
+PERCENTS = (50, 90, 99)
+
+
+def parse_mix(mix):
+    """Parses 'op1=weight1,op2=weight2' and returns a list of (operation, weight)"""
+    weights = []
+    for item in mix.split(','):
+        try:
+            operation, weight = item.split('=')
+            weight = float(weight)
+        except ValueError:
+            raise CommandError("Invalid mix '{}': expected 'operation=weight,...'".format(mix))
+        if operation not in OPERATIONS:
+            raise CommandError("Invalid operation '{}': valid operations are {}".format(
+                operation, ', '.join(OPERATIONS)))
+        weights.append((operation, weight))
+    if not sum(weight for _, weight in weights) > 0:
+        raise CommandError("Invalid mix '{}': all the weights are 0".format(mix))
+    return weights
+
+
+def choose(weights):
+    value = random.uniform(0, sum(weight for _, weight in weights))
+    for operation, weight in weights:
+        value -= weight
+        if value <= 0:
+            return operation
+    return weights[-1][0]
+
+
+class Results:
+    """Latencies and errors of each operation (thread-safe)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = dict((operation, []) for operation in OPERATIONS)
+        self.errors = dict((operation, {}) for operation in OPERATIONS)
+
+    def add_success(self, operation, latency):
+        with self._lock:
+            self.latencies[operation].append(latency)
+
+    def add_error(self, operation, error):
+        key = '{}: {}'.format(type(error).__name__, error)[:200]
+        with self._lock:
+            self.errors[operation][key] = self.errors[operation].get(key, 0) + 1
+
+    def get_report(self, elapsed):
+        report = {}
+        for operation in OPERATIONS:
+            latencies = self.latencies[operation]
+            errors = sum(self.errors[operation].values())
+            total = len(latencies) + errors
+            if not total:
+                continue
+            report[operation] = {
+                'requests': total,
+                'throughput': round(total / elapsed, 2),
+                'errors': errors,
+                'error_rate': round(float(errors) / total, 4),
+                'latency_ms': dict((p, round(v * 1000.0, 3)) for p, v in
+                                   metrics.percentiles(latencies, PERCENTS).items()),
+                'error_messages': self.errors[operation],
+            }
+        return report
+
+
+class VirtualClient:
+    """
+    A browser: has a session (anonymous or authenticated), and executes
+    the operations like the session and auth middlewares would do.
+
+    The keys of the sessions it creates are kept in `session_keys` until
+    they are deleted, so delete_sessions() can remove the rest at the end
+    of the test.
+    """
+
+    def __init__(self, session_store_class, backend, usernames, password):
+        self.session_store_class = session_store_class
+        self.backend = backend
+        self.usernames = usernames
+        self.password = password
+        self.session_key = None
+        self.username = None
+        self.session_keys = set()
+
+    def _load_session(self):
+        session = self.session_store_class(self.session_key)
+        session.load()
+        return session
+
+    def _save_session(self, session):
+        session.save()
+        # The key changes with some engines (ex: the hybrid sessions)
+        self.session_key = session.session_key
+        self.session_keys.add(self.session_key)
+
+    def _delete_session(self):
+        if self.session_key is not None:
+            self._load_session().delete()
+            self.session_keys.discard(self.session_key)
+        self.session_key = None
+
+    def delete_sessions(self):
+        """Deletes the sessions created by the client that still exist"""
+        for session_key in list(self.session_keys):
+            self.session_store_class(session_key).delete()
+            self.session_keys.discard(session_key)
+
+    def anonymous(self):
+        """A new visitor: the session is created"""
+        session = self.session_store_class()
+        session['visits'] = 1
+        self._save_session(session)
+        self.username = None
+
+    def page_view(self):
+        """A page view of an authenticated user: get_user() and session load/save"""
+        if self.username is None:
+            return self.login()
+        session = self._load_session()
+        user = self.backend.get_user(session.get(SESSION_KEY))
+        if user is None or session.get(HASH_SESSION_KEY) != user.get_session_auth_hash():
+            raise Exception("Session of '{}' is not valid".format(self.username))
+        session['visits'] = session.get('visits', 0) + 1
+        self._save_session(session)
+
+    def login(self):
+        """Authenticates and creates a new (authenticated) session"""
+        username = random.choice(self.usernames)
+        user = self.backend.authenticate(username=username, password=self.password)
+        if user is None:
+            raise Exception("Authentication of '{}' failed".format(username))
+        self._delete_session()
+        session = self.session_store_class()
+        session[SESSION_KEY] = user.username
+        session[BACKEND_SESSION_KEY] = 'pcassandra.dj18.auth.backend.ModelBackend'
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        self._save_session(session)
+        self.username = username
+
+    def logout(self):
+        """Deletes the session"""
+        self._delete_session()
+        self.username = None
+
+
+class Command(BaseCommand):
+    help = ('Generate load with a mix of session and auth operations, and report '
+            'throughput, errors and latency percentiles of each operation')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mix', default=DEFAULT_MIX, dest='mix',
+                            help="Weight of each operation ({}), default: '{}'".format(
+                                ', '.join(OPERATIONS), DEFAULT_MIX))
+        parser.add_argument('--clients', type=int, default=20, dest='clients',
+                            help='Number of concurrent virtual clients')
+        parser.add_argument('--rate', type=float, default=0, dest='rate',
+                            help='Target number of operations per second (0: no limit)')
+        parser.add_argument('--duration', type=float, default=30, dest='duration',
+                            help='Duration of the test, in seconds')
+        parser.add_argument('--users', type=int, default=100, dest='users',
+                            help='Number of users used to login. They are created with a '
+                                 'random password, and deleted at the end of the test')
+        parser.add_argument('--user-prefix', default=None, dest='user_prefix',
+                            help="Prefix of the usernames of the users (default: "
+                                 "'loadtest-<random>-')")
+        parser.add_argument('--hosts', default=None, dest='hosts',
+                            help='Comma separated list of Cassandra hosts, instead of the '
+                                 'HOSTS of CASSANDRA_CONNECTION (ex: a local stand-in)')
+        parser.add_argument('--keyspace', default=None, dest='keyspace',
+                            help='Keyspace to use instead of the KEYSPACE of '
+                                 'CASSANDRA_CONNECTION. The keyspace and the tables are '
+                                 'created if they not exists')
+        parser.add_argument('--json', action='store_true', default=False, dest='json',
+                            help='Output in JSON format')
+
+    def setup_connection(self, hosts, keyspace):
+        if hosts or keyspace:
+            cassandra_connection = dict(settings.CASSANDRA_CONNECTION)
+            if hosts:
+                cassandra_connection['HOSTS'] = hosts.split(',')
+            if keyspace:
+                cassandra_connection['KEYSPACE'] = keyspace
+                cassandra_models.DEFAULT_KEYSPACE = keyspace
+            settings.CASSANDRA_CONNECTION = cassandra_connection
+            connection.setup_connection(set_default_keyspace=False)
+        else:
+            connection.setup_connection_if_unset(set_default_keyspace=False)
+
+        if keyspace:
+            if not connection.keyspace_exists():
+                connection.create_keyspace()
+            connection.set_session_default_keyspace()
+            schema.sync_tables([utils.get_cassandra_user_model(),
+                                session_models.CassandraSession])
+        else:
+            connection.set_session_default_keyspace()
+
+    def create_users(self, count, prefix, password):
+        """
+        Creates the users, with the password of this run. Existing users are
+        never modified: they could be real accounts.
+        """
+        MODEL = utils.get_cassandra_user_model()
+        password_hash = make_password(password)
+        usernames = []
+        try:
+            for number in range(count):
+                username = '{}{}'.format(prefix, number)
+                try:
+                    MODEL.create(username=username, password=password_hash,
+                                 email='{}@example.com'.format(username))
+                except LWTException:
+                    raise CommandError("User '{}' already exists: use another "
+                                       "--user-prefix".format(username))
+                usernames.append(username)
+        except Exception:
+            self.delete_users(usernames)
+            raise
+        return usernames
+
+    def delete_users(self, usernames):
+        """Deletes the users created by this run (and their proxies)"""
+        MODEL = utils.get_cassandra_user_model()
+        for username in usernames:
+            try:
+                MODEL.get(username=username).delete()
+            except MODEL.DoesNotExist:
+                pass
+        DjangoUserProxy.objects.filter(username__in=usernames).delete()
+
+    def run_client(self, client, weights, results, start, deadline, interval):
+        next_time = start + random.uniform(0, interval)
+        while True:
+            if interval:
+                now = time.time()
+                if next_time > now:
+                    time.sleep(next_time - now)
+                next_time += interval
+            if time.time() >= deadline:
+                return
+
+            operation = choose(weights)
+            operation_start = time.time()
+            # Each operation is a request
+            identitymap.begin()
+            try:
+                getattr(client, operation)()
+            except Exception as e:
+                results.add_error(operation, e)
+            else:
+                results.add_success(operation, time.time() - operation_start)
+            finally:
+                identitymap.end()
+
+    def handle(self, *args, **options):
+        weights = parse_mix(options['mix'])
+        if options['clients'] < 1:
+            raise CommandError('At least one client is required')
+        self.setup_connection(options['hosts'], options['keyspace'])
+
+        # The password is random (and never shown), so the users can't be
+        #  used by anyone else while they exist
+        password = get_random_string(32)
+        prefix = options['user_prefix'] or 'loadtest-{}-'.format(get_random_string(8).lower())
+        usernames = self.create_users(options['users'], prefix, password)
+        try:
+            results, elapsed = self.run_clients(usernames, password, weights, options)
+        finally:
+            self.delete_users(usernames)
+
+        report = results.get_report(elapsed)
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+        else:
+            self.write_text_report(report, elapsed, options)
+
+    def run_clients(self, usernames, password, weights, options):
+        """Runs the virtual clients until the end of the test, returns (results, elapsed)"""
+        session_store_class = import_module(settings.SESSION_ENGINE).SessionStore
+        backend = ModelBackend()
+
+        # Each client waits `interval` seconds between operations
+        interval = options['clients'] / options['rate'] if options['rate'] else 0
+        results = Results()
+        start = time.time()
+        deadline = start + options['duration']
+        clients = [VirtualClient(session_store_class, backend, usernames, password)
+                   for _ in range(options['clients'])]
+        threads = [threading.Thread(target=self.run_client,
+                                    args=(client, weights, results, start, deadline, interval))
+                   for client in clients]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        # The sessions have no TTL in Cassandra: they would be left behind
+        for client in clients:
+            client.delete_sessions()
+        return results, elapsed
+
+    def write_text_report(self, report, elapsed, options):
+        self.stdout.write('{} clients, {:.1f} seconds, target rate: {}'.format(
+            options['clients'], elapsed,
+            '{}/s'.format(options['rate']) if options['rate'] else 'no limit'))
+        for operation in OPERATIONS:
+            if operation not in report:
+                continue
+            result = report[operation]
+            self.stdout.write('{:>10}: {} requests, {}/s, {} errors ({:.2%}), {}'.format(
+                operation, result['requests'], result['throughput'], result['errors'],
+                result['error_rate'],
+                ' '.join('p{}={}ms'.format(p, result['latency_ms'][p])
+                         for p in PERCENTS if p in result['latency_ms'])))
+            for message, count in sorted(result['error_messages'].items())[:3]:
+                self.stdout.write('            {} x {}'.format(count, message))
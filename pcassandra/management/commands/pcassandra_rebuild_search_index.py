@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+
+from pcassandra import connection
+from pcassandra import utils
+from pcassandra.dj18.auth import search
+
+
+class Command(BaseCommand):
+    help = ('Index all the users in the search index of the admin, and remove the '
+            'entries that no user references (see pcassandra/dj18/auth/search.py)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size',
+                            type=int,
+                            dest='page_size',
+                            default=500,
+                            help='Number of users read on each query')
+
+    def handle(self, *args, **options):
+        connection.setup_connection_if_unset()
+        MODEL = utils.get_cassandra_user_model()
+        count = 0
+        after = None
+        while True:
+            users = search.list_users(MODEL, after=after, limit=options['page_size'])
+            if not users:
+                break
+            for user in users:
+                # Missing entries are inserted, existing ones are overwritten
+                search.update_index(user['username'], {}, user)
+            count += len(users)
+            after = users[-1]['username']
+        self.stdout.write('{} users indexed'.format(count))
+
+        removed = 0
+        page = []
+        for entry in search.iter_index_entries(page_size=options['page_size']):
+            page.append(entry)
+            if len(page) == options['page_size']:
+                removed += self.remove_stale_entries(MODEL, page)
+                page = []
+        if page:
+            removed += self.remove_stale_entries(MODEL, page)
+        self.stdout.write('{} stale entries removed'.format(removed))
+
+    def remove_stale_entries(self, model_class, entries):
+        """
+        Removes the entries of users that don't exist, or whose value
+        changed (ex: saved while the index was not enabled)
+        """
+        stale_entries = search.get_stale_entries(model_class, entries)
+        search.delete_entries(stale_entries)
+        return len(stale_entries)
@@ -1,20 +1,90 @@
-from django.core.management.base import BaseCommand
-from cassandra.cqlengine import management
+from django.core.management.base import BaseCommand, CommandError
 
 from pcassandra import connection
-from pcassandra import utils
-from pcassandra.dj18.session import models as session_models
+from pcassandra import registry
+from pcassandra import schema
 
 
 class Command(BaseCommand):
-    help = 'Sync Cassandra tables'
+    help = ('Sync Cassandra tables of the models of the registry (see registry.py), '
+            'and the table options declared in PCASSANDRA_TABLE_OPTIONS')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run',
+                            action='store_true',
+                            dest='dry_run',
+                            default=False,
+                            help="Show the changes, but don't modify the schema")
+        parser.add_argument('--check',
+                            action='store_true',
+                            dest='check',
+                            default=False,
+                            help="Don't modify the schema, exit with error if it differs "
+                                 "from the models")
+        parser.add_argument('--workers',
+                            type=int,
+                            dest='workers',
+                            default=1,
+                            help='Number of tables synced concurrently (default: 1). With '
+                                 'more than 1, schema agreement is checked only at the end '
+                                 '(see pcassandra/schema.py)')
+
+    def get_models(self):
+        return registry.get_models()
 
     def handle(self, *args, **options):
-        connection.setup_connection_if_unset()
-        connection.create_keyspace()
-        ConfiguredCassandraUserModelClass = utils.get_cassandra_user_model()
-        self.stdout.write('Sync-ing "{}"'.format(ConfiguredCassandraUserModelClass))
-        management.sync_table(ConfiguredCassandraUserModelClass)
-
-        self.stdout.write('Sync-ing "{}"'.format(session_models.CassandraSession))
-        management.sync_table(session_models.CassandraSession)
+        connection.setup_connection_if_unset(set_default_keyspace=False)
+        if options['check']:
+            return self.check()
+
+        dry_run = options['dry_run']
+        if not connection.keyspace_exists():
+            if dry_run:
+                self.stdout.write('Keyspace does not exists, would be created')
+                return
+            connection.create_keyspace()
+        connection.set_session_default_keyspace()
+
+        models = self.get_models()
+        if dry_run:
+            for model_class in models:
+                self.show_changes(model_class)
+            return
+
+        for model_class in models:
+            self.stdout.write('Sync-ing "{}"'.format(model_class))
+        results = schema.sync_tables(models, max_workers=options['workers'])
+        for model_class, diff in results.items():
+            for name, current, desired in diff:
+                self.stdout.write('Table options of "{}" changed: {}: {!r} -> {!r}'.format(
+                    model_class, name, current, desired))
+
+    def show_changes(self, model_class):
+        if schema.get_table_metadata(model_class) is None:
+            self.stdout.write('Table of "{}" does not exists, would be created'.format(
+                model_class))
+            return
+
+        diff = schema.diff_table_options(model_class)
+        if not diff:
+            return
+
+        self.stdout.write('Table options of "{}" differ:'.format(model_class))
+        for name, current, desired in diff:
+            self.stdout.write('  {}: {!r} -> {!r}'.format(name, current, desired))
+        self.stdout.write('  would run: {}'.format(
+            schema.get_alter_table_statement(
+                model_class, dict((name, desired) for name, _, desired in diff))))
+
+    def check(self):
+        if not connection.keyspace_exists():
+            raise CommandError('Keyspace does not exists')
+
+        drift_found = False
+        for model_class in self.get_models():
+            for drift in schema.get_schema_drift(model_class):
+                self.stdout.write('"{}": {}'.format(model_class, drift))
+                drift_found = True
+        if drift_found:
+            raise CommandError('The schema differs from the models')
+        self.stdout.write('The schema is up to date')
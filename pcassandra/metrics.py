@@ -0,0 +1,159 @@
+"""
+In-process counters, gauges and latency histograms describing what
+pcassandra is doing.
+
+Metrics are identified by dotted names, like
+'circuit_breaker.session.failures'. The values are per process.
+
+    from pcassandra import metrics
+
+    metrics.incr('session.load.degraded')
+    metrics.set_gauge('circuit_breaker.session.state', 1)
+    with metrics.timed('session.load'):
+        ...
+    metrics.snapshot()
+
+The metrics are exported in the Prometheus text format and/or sent to
+statsd, see exporters.py.
+"""
+
+import contextlib
+import math
+import threading
+import time
+
+# Upper bounds (in seconds) of the buckets of the histograms
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+# {name: [counts of each bucket (+ the count of values over the last bucket), sum, count]}
+_histograms = {}
+# Functions called with (kind, name, value) on each update (see exporters.StatsdEmitter)
+_listeners = []
+
+
+def _notify(kind, name, value):
+    for listener in _listeners:
+        listener(kind, name, value)
+
+
+def add_listener(listener):
+    """Registers `listener`, called with (kind, name, value) on each update"""
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+
+def remove_listener(listener):
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def incr(name, value=1):
+    """Increments the counter `name` by `value`"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+    _notify('counter', name, value)
+
+
+def set_gauge(name, value):
+    """Sets the gauge `name` to `value`"""
+    with _lock:
+        _gauges[name] = value
+    _notify('gauge', name, value)
+
+
+def observe(name, value):
+    """Adds `value` (a duration, in seconds) to the histogram `name`"""
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = [[0] * (len(DEFAULT_BUCKETS) + 1), 0.0, 0]
+        index = 0
+        while index < len(DEFAULT_BUCKETS) and value > DEFAULT_BUCKETS[index]:
+            index += 1
+        histogram[0][index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+    _notify('histogram', name, value)
+
+
+@contextlib.contextmanager
+def timed(name):
+    """
+    Context manager (or decorator) that adds the duration of the
+    block to the histogram `name`
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start)
+
+
+def get_histograms():
+    """
+    Returns a dict {name: (buckets, sum, count)}, where buckets is a
+    list of (upper bound, cumulative count), ending with ('+Inf', count)
+    """
+    with _lock:
+        histograms = dict((name, (list(h[0]), h[1], h[2])) for name, h in _histograms.items())
+    result = {}
+    for name, (counts, total, count) in histograms.items():
+        buckets = []
+        cumulative = 0
+        for bound, bucket_count in zip(DEFAULT_BUCKETS + ('+Inf',), counts):
+            cumulative += bucket_count
+            buckets.append((bound, cumulative))
+        result[name] = (buckets, total, count)
+    return result
+
+
+def get(name, default=0):
+    """Returns the current value of the counter or gauge `name`"""
+    with _lock:
+        if name in _counters:
+            return _counters[name]
+        return _gauges.get(name, default)
+
+
+def snapshot():
+    """Returns a dict with the current value of all the counters and gauges"""
+    with _lock:
+        values = dict(_counters)
+        values.update(_gauges)
+        return values
+
+
+def get_counters():
+    with _lock:
+        return dict(_counters)
+
+
+def get_gauges():
+    with _lock:
+        return dict(_gauges)
+
+
+def percentiles(values, percents=(50, 90, 99)):
+    """
+    Returns a dict {percent: value} with the percentiles of `values`
+    (nearest-rank method). Returns an empty dict if `values` is empty.
+    """
+    values = sorted(values)
+    if not values:
+        return {}
+    result = {}
+    for percent in percents:
+        rank = int(math.ceil(percent / 100.0 * len(values)))
+        result[percent] = values[max(rank, 1) - 1]
+    return result
+
+
+def reset():
+    """Clears all the counters, gauges and histograms (useful for tests)"""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
@@ -0,0 +1,177 @@
+"""
+Slow-query log, with sampled driver-side tracing.
+
+Example settings:
+
+    PCASSANDRA_SLOW_QUERY_LOG = {
+        'THRESHOLD': 0.5,
+        'TRACE_SAMPLE_RATE': 0.001,
+        'REDACT_PARAMETERS': True,
+        'TRACE_MAX_WAIT': 0.5,
+    }
+
+* THRESHOLD: queries that take longer than this (in seconds) are logged
+  (with level WARNING) with the statement, parameters, consistency level,
+  coordinator and duration
+* TRACE_SAMPLE_RATE: fraction of the synchronous queries executed with
+  tracing enabled. The events of the trace (tombstones scanned, replicas
+  contacted, etc.) are logged with level INFO
+* TRACE_MAX_WAIT: maximum time (in seconds) to wait for the trace of a
+  sampled query to be available in `system_traces`. The trace is read
+  in the thread that executed the query, so keep it short: if it's not
+  available in time, it's not logged
+* REDACT_PARAMETERS: if True (the default), only the type and length of
+  the parameters are logged
+
+When the setting is present, `connection.setup_connection()` replaces the
+driver's Session used by cqlengine with an InstrumentedSession, so all the
+queries (of cqlengine models and of pcassandra) are measured.
+The messages are logged to the 'pcassandra.querylog' logger.
+"""
+
+import logging
+import random
+import time
+
+from cassandra import ConsistencyLevel
+from cassandra.query import BatchStatement, BoundStatement, SimpleStatement, Statement
+from cassandra.query import TraceUnavailable
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLD = 0.5
+DEFAULT_TRACE_MAX_WAIT = 0.5
+
+_NOT_SET = object()
+
+
+def get_config():
+    """Returns the PCASSANDRA_SLOW_QUERY_LOG setting, or None if not set"""
+    return getattr(settings, 'PCASSANDRA_SLOW_QUERY_LOG', None)
+
+
+def get_query_string(query):
+    if isinstance(query, BoundStatement):
+        return query.prepared_statement.query_string
+    if isinstance(query, SimpleStatement):
+        return query.query_string
+    if isinstance(query, BatchStatement):
+        return 'BATCH'
+    return str(query)
+
+
+def redact_parameters(parameters):
+    """Returns a representation of the parameters, without the values"""
+    if parameters is None:
+        return None
+
+    def redact(value):
+        if value is None:
+            return 'None'
+        try:
+            return '<{}:{}>'.format(type(value).__name__, len(value))
+        except TypeError:
+            return '<{}>'.format(type(value).__name__)
+
+    if isinstance(parameters, dict):
+        return dict((key, redact(value)) for key, value in parameters.items())
+    return [redact(value) for value in parameters]
+
+
+class InstrumentedSession:
+    """
+    Wraps the driver's Session, measuring the duration of `execute()` and
+    `execute_async()`. Everything else is delegated to the wrapped session.
+    """
+
+    def __init__(self, session, threshold=DEFAULT_THRESHOLD, trace_sample_rate=0.0,
+                 redact=True, trace_max_wait=DEFAULT_TRACE_MAX_WAIT):
+        self._session = session
+        self.threshold = threshold
+        self.trace_sample_rate = trace_sample_rate
+        self.trace_max_wait = trace_max_wait
+        self.redact = redact
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+    def _should_trace(self):
+        return self.trace_sample_rate > 0 and random.random() < self.trace_sample_rate
+
+    def _describe(self, query, parameters, future, duration):
+        consistency_level = getattr(query, 'consistency_level', None)
+        if consistency_level is None:
+            consistency_level = self._session.default_consistency_level
+        return "{:.1f} ms, consistency={}, coordinator={}, query={!r}, parameters={}".format(
+            duration * 1000.0,
+            ConsistencyLevel.value_to_name.get(consistency_level, consistency_level),
+            getattr(future, '_current_host', None),
+            get_query_string(query),
+            redact_parameters(parameters) if self.redact else parameters)
+
+    def _log_if_slow(self, query, parameters, future, duration):
+        if duration >= self.threshold:
+            logger.warning("Slow query: %s", self._describe(query, parameters, future, duration))
+
+    def _log_trace(self, query, parameters, future, duration):
+        try:
+            # Without `max_wait`, the driver polls system_traces until the trace is complete
+            trace = future.get_query_trace(max_wait=self.trace_max_wait)
+        except TraceUnavailable as e:
+            logger.info("Trace of the query not available after %s seconds: %s",
+                        self.trace_max_wait, e)
+            return
+        except Exception as e:
+            logger.info("Couldn't fetch the trace of the query: %s", e)
+            return
+        lines = ["Trace of query ({}): {}".format(
+            trace.trace_id, self._describe(query, parameters, future, duration))]
+        for event in trace.events:
+            lines.append("  {:>10} us | {} | {}".format(
+                event.source_elapsed.microseconds + event.source_elapsed.seconds * 1000000
+                if event.source_elapsed is not None else '-',
+                event.source,
+                event.description))
+        logger.info('\n'.join(lines))
+
+    def execute(self, query, parameters=None, timeout=_NOT_SET, trace=False):
+        if timeout is _NOT_SET:
+            timeout = self._session.default_timeout
+        if not trace and self._should_trace():
+            trace = True
+            if not isinstance(query, Statement):
+                query = SimpleStatement(query)
+        start = time.time()
+        future = self._session.execute_async(query, parameters, trace)
+        try:
+            result = future.result(timeout)
+        finally:
+            duration = time.time() - start
+            self._log_if_slow(query, parameters, future, duration)
+        if trace:
+            self._log_trace(query, parameters, future, duration)
+        return result
+
+    def execute_async(self, query, parameters=None, trace=False):
+        start = time.time()
+        future = self._session.execute_async(query, parameters, trace)
+
+        def done(result_or_error):
+            self._log_if_slow(query, parameters, future, time.time() - start)
+
+        future.add_callbacks(callback=done, errback=done)
+        return future
+
+
+def instrument_session(session):
+    """Returns the session wrapped with InstrumentedSession, if the slow-query log is enabled"""
+    config = get_config()
+    if not config:
+        return session
+    return InstrumentedSession(session,
+                               threshold=config.get('THRESHOLD', DEFAULT_THRESHOLD),
+                               trace_sample_rate=config.get('TRACE_SAMPLE_RATE', 0.0),
+                               redact=config.get('REDACT_PARAMETERS', True),
+                               trace_max_wait=config.get('TRACE_MAX_WAIT',
+                                                         DEFAULT_TRACE_MAX_WAIT))
@@ -0,0 +1,101 @@
+"""
+Registry of the cqlengine models whose tables are managed by pcassandra
+(created and altered by `pcassandra_sync_tables`, synced by tests_utils).
+
+The registry includes:
+
+* the models of pcassandra: the configured user model, sessions, cache,
+  messages, login throttling and the user search index
+* the models declared in the PCASSANDRA_MODELS setting (full paths)
+* the models registered with `register()`
+* the (non abstract) cqlengine models defined in the `models` or
+  `cassandra_models` modules of the installed apps
+
+Example settings:
+
+    PCASSANDRA_MODELS = [
+        'myapp.documents.Document',
+    ]
+
+Models can be registered with a decorator too:
+
+    from pcassandra import registry
+
+    @registry.register
+    class Document(cassandra_models.Model):
+        ...
+"""
+
+import importlib
+import logging
+
+from cassandra.cqlengine import models as cassandra_models
+from django.apps import apps
+from django.conf import settings
+from django.utils.module_loading import import_string, module_has_submodule
+
+from pcassandra import utils
+
+logger = logging.getLogger(__name__)
+
+# Modules of the installed apps where cqlengine models are looked up
+DISCOVERY_MODULES = ('models', 'cassandra_models')
+
+_registered_models = []
+
+
+def register(model_class):
+    """Registers `model_class` (can be used as class decorator)"""
+    if model_class not in _registered_models:
+        _registered_models.append(model_class)
+    return model_class
+
+
+def is_cqlengine_model(value):
+    return isinstance(value, type) and issubclass(value, cassandra_models.Model) and \
+        not getattr(value, '__abstract__', False)
+
+
+def get_pcassandra_models():
+    """Returns the models of pcassandra"""
+    from pcassandra.dj18 import cache
+    from pcassandra.dj18.auth import search
+    from pcassandra.dj18.auth import throttle
+    from pcassandra.dj18.messages import models as messages_models
+    from pcassandra.dj18.session import models as session_models
+    return [
+        utils.get_cassandra_user_model(),
+        session_models.CassandraSession,
+        cache.CassandraCacheEntry,
+        messages_models.CassandraMessage,
+        throttle.LoginAttemptCounter,
+        search.CassandraUserSearchIndex,
+    ]
+
+
+def discover_app_models():
+    """Returns the cqlengine models defined in the installed apps"""
+    models = []
+    for app_config in apps.get_app_configs():
+        for module_name in DISCOVERY_MODULES:
+            if not module_has_submodule(app_config.module, module_name):
+                continue
+            module = importlib.import_module('{}.{}'.format(app_config.name, module_name))
+            for value in vars(module).values():
+                # Only the models defined in the module, not the imported ones
+                if is_cqlengine_model(value) and value.__module__ == module.__name__:
+                    models.append(value)
+    return sorted(models, key=lambda model_class: (model_class.__module__,
+                                                   model_class.__name__))
+
+
+def get_models():
+    """Returns all the models of the registry (without duplicates)"""
+    models = []
+    for model_class in get_pcassandra_models() + \
+            [import_string(path) for path in getattr(settings, 'PCASSANDRA_MODELS', [])] + \
+            _registered_models + \
+            discover_app_models():
+        if model_class not in models:
+            models.append(model_class)
+    return models
@@ -0,0 +1,232 @@
+"""
+Management of the options of the tables (compaction, caching, etc.)
+
+The options are declared in the settings, for each model, using the
+full path of the model class:
+
+    PCASSANDRA_TABLE_OPTIONS = {
+        'pcassandra.dj18.session.models.CassandraSession': {
+            'compaction': {
+                'class': 'LeveledCompactionStrategy',
+                'sstable_size_in_mb': 160,
+            },
+            'gc_grace_seconds': 3600,
+            'caching': {'keys': 'ALL', 'rows_per_partition': 'NONE'},
+            'bloom_filter_fp_chance': 0.01,
+        },
+        'pcassandra.dj18.auth.models.CassandraUser': {
+            'caching': {'keys': 'ALL', 'rows_per_partition': '1'},
+        },
+    }
+
+Only the options declared here are checked: `pcassandra_sync_tables`
+compares them with the options of the existing tables, and issues
+an ALTER TABLE when they differ.
+
+`sync_tables()` syncs the tables one by one, unless `max_workers` is
+greater than 1 (`pcassandra_sync_tables --workers N`). Keep in mind that
+concurrent DDL is not recommended by cqlengine (concurrent schema changes
+can leave the nodes in schema disagreement), and that, since the driver
+waits for schema agreement after each DDL statement, this wait is
+disabled *in the whole cluster object* while the tables are synced, and
+done once at the end: other threads of the process running DDL at the
+same time would not wait for schema agreement. Use `max_workers` > 1
+only from a process that does nothing else, like the management command.
+"""
+
+import collections
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from cassandra.cqlengine import management
+from django.conf import settings
+
+from pcassandra import connection
+
+logger = logging.getLogger(__name__)
+
+
+def get_model_path(model_class):
+    """Returns the full path of `model_class`, as used in the settings"""
+    return '{}.{}'.format(model_class.__module__, model_class.__name__)
+
+
+def get_keyspace_and_table(model_class):
+    """Returns a tuple (keyspace, table) of `model_class`"""
+    return model_class._get_keyspace(), model_class._raw_column_family_name()
+
+
+def get_table_metadata(model_class):
+    """Returns the driver's TableMetadata of `model_class`, or None if the table doesn't exists"""
+    keyspace, table = get_keyspace_and_table(model_class)
+    keyspace_metadata = connection.get_cluster().metadata.keyspaces.get(keyspace)
+    if keyspace_metadata is None:
+        return None
+    return keyspace_metadata.tables.get(table)
+
+
+def get_desired_table_options(model_class):
+    """Returns the options declared in PCASSANDRA_TABLE_OPTIONS for `model_class`"""
+    all_options = getattr(settings, 'PCASSANDRA_TABLE_OPTIONS', {})
+    return all_options.get(get_model_path(model_class), {})
+
+
+def _load_json_if_str(value):
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value
+
+
+def get_current_table_options(table_metadata):
+    """
+    Returns the options of the table, normalized to the format used
+    in PCASSANDRA_TABLE_OPTIONS. Works with the schema tables of
+    Cassandra 2.x (compaction_strategy_class, JSON encoded caching)
+    and 3.x (compaction and caching as maps).
+    """
+    options = dict(table_metadata.options)
+
+    if 'compaction' in options:
+        options['compaction'] = dict(_load_json_if_str(options['compaction']))
+    elif 'compaction_strategy_class' in options:
+        compaction = {'class': options['compaction_strategy_class']}
+        compaction.update(_load_json_if_str(options.get('compaction_strategy_options')) or {})
+        options['compaction'] = compaction
+
+    if 'caching' in options:
+        options['caching'] = _load_json_if_str(options['caching'])
+
+    return options
+
+
+def _option_value_matches(name, current, desired):
+    if isinstance(desired, dict):
+        if not isinstance(current, dict):
+            return False
+        for key, value in desired.items():
+            if not _option_value_matches(key, current.get(key), value):
+                return False
+        return True
+    if name == 'class':
+        # 'LeveledCompactionStrategy' matches
+        #  'org.apache.cassandra.db.compaction.LeveledCompactionStrategy'
+        return str(current).split('.')[-1] == str(desired).split('.')[-1]
+    if isinstance(desired, float) and current is not None:
+        try:
+            return abs(float(current) - desired) < 1e-9
+        except (TypeError, ValueError):
+            return False
+    return str(current) == str(desired)
+
+
+def diff_table_options(model_class, table_metadata=None):
+    """
+    Returns a list of tuples (option_name, current_value, desired_value)
+    of the declared options that differ from the options of the table.
+    """
+    desired_options = get_desired_table_options(model_class)
+    if not desired_options:
+        return []
+    if table_metadata is None:
+        table_metadata = get_table_metadata(model_class)
+    current_options = get_current_table_options(table_metadata)
+    diff = []
+    for name in sorted(desired_options):
+        desired = desired_options[name]
+        current = current_options.get(name)
+        if not _option_value_matches(name, current, desired):
+            diff.append((name, current, desired))
+    return diff
+
+
+def format_cql_value(value):
+    """Returns the CQL literal of `value` (used in the WITH clause of ALTER TABLE)"""
+    if isinstance(value, dict):
+        return '{' + ', '.join('{}: {}'.format(format_cql_value(str(k)), format_cql_value(v))
+                               for k, v in sorted(value.items())) + '}'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def get_alter_table_statement(model_class, options):
+    """Returns the ALTER TABLE statement that sets `options` (a dict)"""
+    return "ALTER TABLE {} WITH {}".format(
+        model_class.column_family_name(),
+        ' AND '.join('{} = {}'.format(name, format_cql_value(value))
+                     for name, value in sorted(options.items())))
+
+
+def alter_table_options(model_class, diff):
+    """Applies the options returned by `diff_table_options()`"""
+    if not diff:
+        return
+    statement = get_alter_table_statement(model_class,
+                                          dict((name, desired) for name, _, desired in diff))
+    logger.info("alter_table_options(): %s", statement)
+    connection.get_session().execute(statement)
+
+
+def get_schema_drift(model_class):
+    """
+    Returns a list of descriptions of the differences between `model_class`
+    and its table (missing table, missing columns and table options).
+    Returns an empty list if there are no differences.
+    """
+    table_metadata = get_table_metadata(model_class)
+    if table_metadata is None:
+        return ['table {} does not exists'.format(model_class.column_family_name())]
+    drift = ['column {} does not exists'.format(column.db_field_name)
+             for column in model_class._columns.values()
+             if column.db_field_name not in table_metadata.columns]
+    drift.extend('option {}: {!r} -> {!r}'.format(name, current, desired)
+                 for name, current, desired in diff_table_options(model_class, table_metadata))
+    return drift
+
+
+def sync_table(model_class):
+    """
+    Creates (or adds the new columns to) the table of `model_class`, and
+    applies the declared options. Returns the diff of the options applied.
+    """
+    management.sync_table(model_class)
+    diff = diff_table_options(model_class)
+    alter_table_options(model_class, diff)
+    return diff
+
+
+def sync_tables(models, max_workers=1):
+    """
+    Syncs the tables of `models`. Returns an OrderedDict {model: diff},
+    with the diff of the options applied to each table.
+
+    If `max_workers` is greater than 1, the tables are synced concurrently,
+    waiting for schema agreement once, at the end (see the notes at the
+    top of this module).
+    """
+    if max_workers <= 1:
+        return collections.OrderedDict((model_class, sync_table(model_class))
+                                       for model_class in models)
+
+    cluster = connection.get_cluster()
+    max_schema_agreement_wait = cluster.max_schema_agreement_wait
+    cluster.max_schema_agreement_wait = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [(model_class, executor.submit(sync_table, model_class))
+                       for model_class in models]
+        results = collections.OrderedDict((model_class, future.result())
+                                          for model_class, future in futures)
+    finally:
+        cluster.max_schema_agreement_wait = max_schema_agreement_wait
+
+    if not cluster.control_connection.wait_for_schema_agreement():
+        logger.warning("sync_tables(): schema agreement not reached after %s seconds",
+                       max_schema_agreement_wait)
+    return results
@@ -0,0 +1,336 @@
+"""
+Cache shared by all the processes of a host, in a memory-mapped file.
+
+With N worker processes (gunicorn, uWSGI, etc.), a local cache is filled
+N times, reading the same rows N times from Cassandra. This cache lives
+in a memory-mapped file (by default in /dev/shm), so a value stored by
+one worker is served to the rest from shared memory.
+
+Example settings:
+
+    PCASSANDRA_SHARED_CACHE = {
+        'PATH': '/dev/shm/pcassandra-users',
+        'SLOTS': 65536,
+        'SLOT_SIZE': 512,
+        'TTL': 60,
+    }
+
+* PATH: prefix of the file, created (with mode 0600) if it doesn't exists.
+  The name of the file ends with the layout (ex: 'pcassandra-users.65536x512').
+  All the processes using the same file share the cache. The file is refused
+  (and the cache disabled) if it's a symlink, if it's owned by another user,
+  or if it's accessible by the group or by other users
+* SLOTS / SLOT_SIZE: the file is a fixed-size hash table of SLOTS slots
+  of SLOT_SIZE bytes. Each key maps to one slot: a new key replaces the
+  entry with the same slot. Values that don't fit in a slot are not cached
+* TTL: seconds before the entries expire
+
+Values are stored as JSON, not pickled (loading a pickle can run code), so
+only str, int, float, bool, None, lists, dicts, sets and datetimes can be
+cached.
+
+Each slot has a version stamp, used as a sequence lock: writers lock the
+slot (fcntl byte-range lock), make the version odd while they modify the
+slot, and even again when done. Readers don't lock: they read the version
+before and after reading the slot, and ignore the slot if it was being
+written, or if it was modified while reading it.
+
+A file in use is never truncated: other processes have it mapped, and
+would be killed (SIGBUS) on their next access. Since the layout is part
+of the name of the file, changing SLOTS or SLOT_SIZE (ex: in a rolling
+deploy) creates a new file, and the processes still running the old
+settings keep using the old one (remove it once they are gone). If a
+file exists with another layout, the cache is disabled, and an error is
+logged.
+"""
+
+import datetime
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import stat
+import struct
+import threading
+import time
+
+from django.conf import settings
+
+from pcassandra import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SLOTS = 65536
+DEFAULT_SLOT_SIZE = 512
+DEFAULT_TTL = 60
+
+MAGIC = b'PCSHM001'
+
+# magic, slots, slot_size
+FILE_HEADER = struct.Struct('<8sII')
+
+# key hash, version, expires, payload length
+SLOT_HEADER = struct.Struct('<QQdI')
+
+VERSION = struct.Struct('<Q')
+VERSION_OFFSET = 8
+
+_user_cache = None
+_user_cache_configured = False
+_user_cache_lock = threading.Lock()
+
+
+class SharedMemoryCacheError(Exception):
+    """Raised when the file exists, but can't be used with the requested layout"""
+    pass
+
+
+def _encode_value(value):
+    """`default` of json.dumps(): encodes the sets and datetimes"""
+    if isinstance(value, (set, frozenset)):
+        return {'$set': sorted(value)}
+    if isinstance(value, datetime.datetime):
+        offset = value.utcoffset()
+        return {'$datetime': [value.year, value.month, value.day, value.hour, value.minute,
+                              value.second, value.microsecond,
+                              None if offset is None else int(offset.total_seconds())]}
+    raise TypeError("{!r} can't be stored in the shared memory cache".format(value))
+
+
+def _decode_value(obj):
+    """`object_hook` of json.loads(): decodes the values encoded by _encode_value()"""
+    if '$set' in obj:
+        return set(obj['$set'])
+    if '$datetime' in obj:
+        values = obj['$datetime']
+        tzinfo = None
+        if values[7] is not None:
+            tzinfo = datetime.timezone(datetime.timedelta(seconds=values[7]))
+        return datetime.datetime(*values[:7], tzinfo=tzinfo)
+    return obj
+
+
+def dumps(value):
+    return json.dumps(value, default=_encode_value, separators=(',', ':')).encode('utf-8')
+
+
+def loads(payload):
+    return json.loads(payload.decode('utf-8'), object_hook=_decode_value)
+
+
+def _hash_key(key):
+    """Hash of the key, stable across processes (unlike hash())"""
+    return struct.unpack('<Q', hashlib.md5(key.encode('utf-8')).digest()[:8])[0]
+
+
+class SharedMemoryCache:
+    """Fixed-size hash table with TTL, in a memory-mapped file"""
+
+    def __init__(self, path, slots=DEFAULT_SLOTS, slot_size=DEFAULT_SLOT_SIZE, ttl=DEFAULT_TTL,
+                 name='shmcache'):
+        assert slot_size > SLOT_HEADER.size, "SLOT_SIZE must be greater than {}".format(
+            SLOT_HEADER.size)
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.ttl = ttl
+        self.name = name
+        self._size = FILE_HEADER.size + slots * slot_size
+        # fcntl locks are per process: the threads of the process use this lock
+        self._lock = threading.Lock()
+        try:
+            # O_NOFOLLOW: a symlink planted in the path could point to any file
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        except OSError as e:
+            raise SharedMemoryCacheError(
+                "Shared memory cache '{}' can't be opened: {}".format(path, e)) from e
+        try:
+            self._check_file()
+            self._init_file()
+            self._mmap = mmap.mmap(self._fd, self._size)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def _check_file(self):
+        """
+        Raises SharedMemoryCacheError unless the file is a regular file owned
+        by this user, and not accessible by the group or by other users:
+        any process that can write it can change the cached users.
+        """
+        file_stat = os.fstat(self._fd)
+        if not stat.S_ISREG(file_stat.st_mode):
+            raise SharedMemoryCacheError("'{}' is not a regular file".format(self.path))
+        if file_stat.st_uid != os.getuid():
+            raise SharedMemoryCacheError(
+                "Shared memory cache '{}' is owned by another user (uid {})".format(
+                    self.path, file_stat.st_uid))
+        if file_stat.st_mode & 0o077:
+            raise SharedMemoryCacheError(
+                "Shared memory cache '{}' is accessible by other users (mode {:o})".format(
+                    self.path, stat.S_IMODE(file_stat.st_mode)))
+
+    def _init_file(self):
+        """
+        Creates the table if the file is new. Raises SharedMemoryCacheError if
+        the file has another layout: it's never shrunk or re-created, since
+        other processes may have it mapped.
+        """
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, FILE_HEADER.size, 0)
+        try:
+            header = os.pread(self._fd, FILE_HEADER.size, 0)
+            file_size = os.fstat(self._fd).st_size
+            if len(header) == FILE_HEADER.size and header[:len(MAGIC)] == MAGIC:
+                if FILE_HEADER.unpack(header) == (MAGIC, self.slots, self.slot_size) and \
+                        file_size >= self._size:
+                    return
+                raise SharedMemoryCacheError(
+                    "Shared memory cache '{}' was created with another layout "
+                    "(slots, slot size): {}".format(self.path, FILE_HEADER.unpack(header)[1:]))
+            if file_size > self._size:
+                raise SharedMemoryCacheError(
+                    "'{}' is not a shared memory cache".format(self.path))
+            logger.info("Initializing shared memory cache '%s' (%s slots of %s bytes)",
+                        self.path, self.slots, self.slot_size)
+            # New file (or not initialized): only grown
+            os.ftruncate(self._fd, self._size)
+            os.pwrite(self._fd, FILE_HEADER.pack(MAGIC, self.slots, self.slot_size), 0)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, FILE_HEADER.size, 0)
+
+    def _get_offset(self, key_hash):
+        return FILE_HEADER.size + (key_hash % self.slots) * self.slot_size
+
+    def _read_version(self, offset):
+        return VERSION.unpack_from(self._mmap, offset + VERSION_OFFSET)[0]
+
+    def _write_version(self, offset, version):
+        VERSION.pack_into(self._mmap, offset + VERSION_OFFSET, version)
+
+    def get(self, key, default=None):
+        key_hash = _hash_key(key)
+        offset = self._get_offset(key_hash)
+        version = self._read_version(offset)
+        if version % 2:
+            # Being written
+            metrics.incr('{}.misses'.format(self.name))
+            return default
+        slot_hash, _, expires, length = SLOT_HEADER.unpack_from(self._mmap, offset)
+        if slot_hash != key_hash or expires < time.time() or length == 0:
+            metrics.incr('{}.misses'.format(self.name))
+            return default
+        start = offset + SLOT_HEADER.size
+        payload = self._mmap[start:start + length]
+        if self._read_version(offset) != version:
+            # Modified while reading it
+            metrics.incr('{}.misses'.format(self.name))
+            return default
+        try:
+            slot_key, value = loads(payload)
+        except Exception as e:
+            logger.warning("Invalid entry in shared memory cache '%s': %s", self.path, e)
+            metrics.incr('{}.misses'.format(self.name))
+            return default
+        if slot_key != key:
+            # Collision of the hashes
+            metrics.incr('{}.misses'.format(self.name))
+            return default
+        metrics.incr('{}.hits'.format(self.name))
+        return value
+
+    def _write_slot(self, key_hash, expires, payload):
+        offset = self._get_offset(key_hash)
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.slot_size, offset)
+            try:
+                self._write_slot_locked(offset, key_hash, expires, payload)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.slot_size, offset)
+
+    def _write_slot_locked(self, offset, key_hash, expires, payload):
+        version = self._read_version(offset)
+        if version % 2:
+            # A writer died in the middle of the write
+            version += 1
+        self._write_version(offset, version + 1)
+        start = offset + SLOT_HEADER.size
+        self._mmap[start:start + len(payload)] = payload
+        SLOT_HEADER.pack_into(self._mmap, offset, key_hash, version + 1, expires, len(payload))
+        self._write_version(offset, version + 2)
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores the value. Returns False if the value is too large to be
+        stored, or if it can't be serialized to JSON
+        """
+        try:
+            payload = dumps([key, value])
+        except (TypeError, ValueError) as e:
+            logger.warning("Value of '%s' not stored in shared memory cache '%s': %s",
+                           key, self.path, e)
+            metrics.incr('{}.not_serializable'.format(self.name))
+            return False
+        if len(payload) > self.slot_size - SLOT_HEADER.size:
+            metrics.incr('{}.too_large'.format(self.name))
+            return False
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        self._write_slot(_hash_key(key), expires, payload)
+        metrics.incr('{}.stores'.format(self.name))
+        return True
+
+    def delete(self, key):
+        key_hash = _hash_key(key)
+        offset = self._get_offset(key_hash)
+        if SLOT_HEADER.unpack_from(self._mmap, offset)[0] == key_hash:
+            self._write_slot(key_hash, 0, b'')
+
+    def clear(self):
+        for slot in range(self.slots):
+            offset = FILE_HEADER.size + slot * self.slot_size
+            key_hash, _, _, length = SLOT_HEADER.unpack_from(self._mmap, offset)
+            if length:
+                self._write_slot(key_hash, 0, b'')
+
+    def close(self):
+        self._mmap.close()
+        os.close(self._fd)
+
+
+def create_cache_from_settings(name='shmcache'):
+    """
+    Returns a SharedMemoryCache configured with PCASSANDRA_SHARED_CACHE,
+    or None if the setting is not set (or the file can't be used).
+    """
+    config = getattr(settings, 'PCASSANDRA_SHARED_CACHE', None)
+    if not config:
+        return None
+    slots = config.get('SLOTS', DEFAULT_SLOTS)
+    slot_size = config.get('SLOT_SIZE', DEFAULT_SLOT_SIZE)
+    try:
+        return SharedMemoryCache(get_path(config['PATH'], slots, slot_size),
+                                 slots=slots,
+                                 slot_size=slot_size,
+                                 ttl=config.get('TTL', DEFAULT_TTL),
+                                 name=name)
+    except SharedMemoryCacheError as e:
+        logger.error("Shared memory cache disabled: %s", e)
+        return None
+
+
+def get_path(path, slots, slot_size):
+    """Returns the path of the file for the layout"""
+    return '{}.{}x{}'.format(path, slots, slot_size)
+
+
+def get_user_cache():
+    """Returns the shared cache of user snapshots, or None if not configured"""
+    global _user_cache, _user_cache_configured
+    if not _user_cache_configured:
+        # Two threads could otherwise map the file twice, and leak one mapping
+        with _user_cache_lock:
+            if not _user_cache_configured:
+                _user_cache = create_cache_from_settings(name='shmcache.users')
+                _user_cache_configured = True
+    return _user_cache
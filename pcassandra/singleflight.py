@@ -0,0 +1,99 @@
+"""
+Collapsing of concurrent reads of the same row: when several threads
+of the process look up the same key at the same time, only the first
+one (the leader) reads Cassandra, and the others wait for its result
+(or its exception), instead of sending the same query.
+
+This flattens the spikes of identical queries to a hot partition, ex:
+many concurrent requests of the same user when its cached copies
+expire, or while the process warms up after a deploy.
+
+Only reads that started while the leader's read was in flight are
+collapsed; the result isn't cached afterwards. The loaders must return
+objects that can be shared between threads (ex: rows or snapshots,
+not cqlengine instances that could be modified).
+
+The threads that wait for the leader (followers) wait at most their own
+`timeout` (their latency budget), and then raise OperationTimedOut. If
+the leader fails, each follower raises its own copy of the exception
+(chained to the original one): an exception object can't be raised in
+several threads, since raising it modifies its traceback.
+
+The number of collapsed reads is counted in 'singleflight.<kind>.collapsed'
+(the reads sent to Cassandra in 'singleflight.<kind>.leaders', and the
+followers that timed out in 'singleflight.<kind>.timeouts').
+"""
+
+import copy
+import threading
+
+from cassandra import OperationTimedOut
+
+from pcassandra import metrics
+
+
+class _Call:
+    """A read in flight"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_lock = threading.Lock()
+
+_calls = {}
+
+
+class SingleFlightError(Exception):
+    """Raised by the followers when the exception of the leader can't be copied"""
+    pass
+
+
+def _copy_error(error):
+    try:
+        return copy.copy(error)
+    except Exception:
+        return SingleFlightError("The in-flight call failed: {!r}".format(error))
+
+
+def do(kind, key, loader, timeout=None):
+    """
+    Returns `loader()`. If a call with the same `kind` and `key` is in
+    flight in other thread, waits for it (at most `timeout` seconds)
+    and returns its result instead.
+    """
+    with _lock:
+        call = _calls.get((kind, key))
+        is_leader = call is None
+        if is_leader:
+            call = _calls[(kind, key)] = _Call()
+
+    if not is_leader:
+        metrics.incr('singleflight.{}.collapsed'.format(kind))
+        if not call.done.wait(timeout):
+            metrics.incr('singleflight.{}.timeouts'.format(kind))
+            raise OperationTimedOut("Timed out after {} seconds waiting for the in-flight "
+                                    "read of the {}".format(timeout, kind))
+        if call.error is not None:
+            raise _copy_error(call.error) from call.error
+        return call.result
+
+    metrics.incr('singleflight.{}.leaders'.format(kind))
+    try:
+        call.result = loader()
+        return call.result
+    except BaseException as e:
+        call.error = e
+        raise
+    finally:
+        with _lock:
+            del _calls[(kind, key)]
+        call.done.set()
+
+
+def in_flight():
+    """Returns the number of calls in flight"""
+    with _lock:
+        return len(_calls)
@@ -1,16 +1,76 @@
+import datetime
+import io
+import json
+import os
+import tempfile
+import threading
+import time
 import uuid
 
+from cassandra import OperationTimedOut
+from cassandra.cqlengine import columns as cassandra_columns
+from cassandra.cqlengine import models as cassandra_models
+from cassandra.cqlengine.query import LWTException
+from cassandra.query import TraceUnavailable
 from django import test
+from django.contrib import admin
 from django.contrib import auth
+from django.contrib.auth.hashers import make_password
+from django.contrib import messages as django_messages
+from django.contrib.sessions.backends import db as db_session_backend
+from django.contrib.sessions.models import Session
+from django.conf import settings
+from django.core import management
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import CommandError
 from django.test.utils import override_settings
+from django.utils import timezone
 
+from pcassandra import circuitbreaker
+from pcassandra import connection
+from pcassandra import exporters
+from pcassandra import identitymap
+from pcassandra import localcache
+from pcassandra import metrics
+from pcassandra import querylog
+from pcassandra import registry
+from pcassandra import schema
+from pcassandra import shmcache
+from pcassandra import singleflight
+from pcassandra import utils
 from pcassandra import tests_utils
+from pcassandra.dj18 import cache
+from pcassandra.dj18.auth import credential_cache
 from pcassandra.dj18.auth import models
+from pcassandra.dj18.auth import search
+from pcassandra.dj18.auth import session_hash
+from pcassandra.dj18.auth import throttle
+from pcassandra.dj18.auth.admin import CassandraUserAdmin
+from pcassandra.dj18.auth.backend import ModelBackend
+from pcassandra.dj18.auth.django_models import DjangoUserProxy
+from pcassandra.dj18.auth.snapshot import CassandraUserSnapshot
+from pcassandra.dj18.messages import storage as message_storage
+from pcassandra.dj18.messages.storage import CassandraStorage
+from pcassandra.dj18.session import backend as session_backend
+from pcassandra.dj18.session import dualread_backend
+from pcassandra.dj18.session import hybrid_backend
+from pcassandra.dj18.session import models as session_models
+from pcassandra.management.commands import pcassandra_loadtest as loadtest
 
 
 PCASSANDRA_AUTH_USER_MODEL = 'pcassandra.dj18.auth.models.CassandraUser'
 
 
+class SyncedModel(cassandra_models.Model):
+    """Model used to test the sync of the tables"""
+    key = cassandra_columns.Text(primary_key=True)
+
+
+class NotSyncedModel(cassandra_models.Model):
+    """Model whose table is never created"""
+    key = cassandra_columns.Text(primary_key=True)
+
+
 class PCassandraBaseTest(test.TestCase, tests_utils.PCassandraTestUtilsMixin):
     @classmethod
     @override_settings(PCASSANDRA_AUTH_USER_MODEL=PCASSANDRA_AUTH_USER_MODEL)
@@ -18,6 +78,10 @@ class PCassandraBaseTest(test.TestCase, tests_utils.PCassandraTestUtilsMixin):
         test.TestCase.setUpClass()
         tests_utils.setup()
 
+    def setUp(self):
+        super(PCassandraBaseTest, self).setUp()
+        self._truncate_tables()
+
 
 class TestCassandraUserCreation(PCassandraBaseTest):
     @override_settings(PCASSANDRA_AUTH_USER_MODEL=PCASSANDRA_AUTH_USER_MODEL)
@@ -35,6 +99,21 @@ class TestCassandraUserCreation(PCassandraBaseTest):
         all_usernames = [_.username for _ in all_users]
         self.assertIn(username, all_usernames)
 
+    @override_settings(PCASSANDRA_AUTH_USER_MODEL=PCASSANDRA_AUTH_USER_MODEL)
+    def test_create_is_unique_and_save_updates(self):
+        cassandra_user = self._create_user(first_name='John')
+
+        with self.assertRaises(LWTException):
+            models.CassandraUser(username=cassandra_user.username).save()
+
+        cassandra_user.last_name = 'Doe'
+        self.assertEquals(cassandra_user.get_changed_columns(), ['last_name'])
+        cassandra_user.save()
+        self.assertEquals(cassandra_user.get_changed_columns(), [])
+
+        reloaded = models.CassandraUser.objects.get(username=cassandra_user.username)
+        self.assertEquals((reloaded.first_name, reloaded.last_name), ('John', 'Doe'))
+
 
 class TestAuthentication(PCassandraBaseTest):
     @override_settings(PCASSANDRA_AUTH_USER_MODEL=PCASSANDRA_AUTH_USER_MODEL)
@@ -56,3 +135,849 @@ class TestAuthentication(PCassandraBaseTest):
         self.assertIsNotNone(auth_user)
         self.assertEquals(auth_user.username,
                           cassandra_user.username)
+
+    @override_settings(PCASSANDRA_AUTH_USER_MODEL=PCASSANDRA_AUTH_USER_MODEL)
+    def test_authenticate_after_get_user_reads_password(self):
+        cassandra_user = self._create_user()
+        cassandra_user.set_password('old-password')
+        cassandra_user.save()
+        backend = ModelBackend()
+
+        identitymap.begin()
+        try:
+            self.assertIsNotNone(backend.get_user(cassandra_user.username))
+            # Changed by other process: the copy in the identity map is stale
+            models.CassandraUser.objects(username=cassandra_user.username).update(
+                password=make_password('new-password'))
+
+            self.assertIsNone(backend.authenticate(username=cassandra_user.username,
+                                                   password='old-password'))
+            self.assertIsNotNone(backend.authenticate(username=cassandra_user.username,
+                                                      password='new-password'))
+        finally:
+            identitymap.end()
+
+
+class TestBulkUserFetch(PCassandraBaseTest):
+    @override_settings(PCASSANDRA_AUTH_USER_MODEL=PCASSANDRA_AUTH_USER_MODEL)
+    def test_get_users_and_hydrate_proxies(self):
+        cassandra_users = [self._create_user(auto_first_last_email=True) for _ in range(3)]
+        usernames = [_.username for _ in cassandra_users]
+
+        user_snapshots = utils.get_users(usernames + ['user-does-not-exists'])
+        self.assertEquals(sorted(user_snapshots), sorted(usernames))
+
+        for username in usernames:
+            DjangoUserProxy.objects.create(username=username)
+        dj_users = list(DjangoUserProxy.objects.filter(
+            username__in=usernames).with_cassandra_users())
+        self.assertEquals(len(dj_users), 3)
+        for dj_user in dj_users:
+            self.assertTrue(dj_user.is_hydrated())
+            self.assertEquals(dj_user.first_name, "John '{}'".format(dj_user.username))
+
+    @override_settings(PCASSANDRA_AUTH_USER_MODEL=PCASSANDRA_AUTH_USER_MODEL)
+    def test_snapshot_lazy_loads_not_auth_columns(self):
+        cassandra_user = self._create_user(auto_first_last_email=True)
+        snapshot = CassandraUserSnapshot.fetch(models.CassandraUser, cassandra_user.username)
+        self.assertTrue(snapshot._is_loaded('password'))
+        self.assertFalse(snapshot._is_loaded('email'))
+
+        self.assertEquals(snapshot.email, cassandra_user.email)
+        self.assertTrue(snapshot._is_loaded('first_name'))
+        self.assertEquals(snapshot.as_tuple(),
+                          CassandraUserSnapshot.from_cassandra_user(cassandra_user).as_tuple())
+
+
+class TestUserSearch(PCassandraBaseTest):
+    @override_settings(PCASSANDRA_AUTH_USER_MODEL=PCASSANDRA_AUTH_USER_MODEL,
+                       PCASSANDRA_USER_SEARCH_INDEX=True)
+    def test_search_follows_saves_and_deletes(self):
+        cassandra_users = [self._create_user(last_name='Smith-{}'.format(i)) for i in range(3)]
+        usernames = sorted(_.username for _ in cassandra_users)
+
+        page = search.search('last_name', 'smith', limit=2)
+        self.assertEquals(len(page), 2)
+        page += search.search('last_name', 'smith', after=page[-1])
+        self.assertEquals(sorted(username for _, username in page), usernames)
+
+        cassandra_users[0].last_name = 'Jones'
+        cassandra_users[0].save()
+        cassandra_users[1].delete()
+        self.assertEquals(search.search('last_name', 'smith'),
+                          [('smith-2', cassandra_users[2].username)])
+        self.assertEquals(search.search('last_name', 'jon'),
+                          [('jones', cassandra_users[0].username)])
+
+        listed = search.list_users(models.CassandraUser, limit=1)
+        listed += search.list_users(models.CassandraUser, after=listed[-1]['username'])
+        self.assertEquals(len(listed), 2)
+
+        cassandra_users[2].username = 'renamed'
+        with self.assertRaises(ValueError):
+            cassandra_users[2].save()
+
+    @override_settings(PCASSANDRA_AUTH_USER_MODEL=PCASSANDRA_AUTH_USER_MODEL,
+                       PCASSANDRA_USER_SEARCH_INDEX=True)
+    def test_rebuild_removes_stale_entries(self):
+        cassandra_user = self._create_user(last_name='Smith')
+        search.update_index('deleted-user', {}, {'last_name': 'Smithson'})
+        search.update_index(cassandra_user.username, {}, {'last_name': 'Smyth'})
+
+        management.call_command('pcassandra_rebuild_search_index', stdout=io.StringIO())
+        self.assertEquals(search.search('last_name', 'smi'),
+                          [('smith', cassandra_user.username)])
+        self.assertEquals(search.search('last_name', 'smy'), [])
+
+    @override_settings(PCASSANDRA_AUTH_USER_MODEL=PCASSANDRA_AUTH_USER_MODEL)
+    def test_admin_creates_proxy_only_on_post(self):
+        cassandra_user = self._create_user()
+        user_admin = CassandraUserAdmin(DjangoUserProxy, admin.site)
+        request_factory = test.RequestFactory()
+
+        obj = user_admin.get_object(request_factory.get('/'), cassandra_user.username)
+        self.assertEquals(obj.username, cassandra_user.username)
+        self.assertFalse(DjangoUserProxy.objects.filter(username=cassandra_user.username))
+
+        user_admin.get_object(request_factory.post('/'), cassandra_user.username)
+        self.assertTrue(DjangoUserProxy.objects.filter(username=cassandra_user.username))
+
+
+@override_settings(PCASSANDRA_SESSION_ASYNC_WRITES=True,
+                   PCASSANDRA_SESSION_ASYNC_MAX_IN_FLIGHT=1)
+class TestSessionAsyncWrites(PCassandraBaseTest):
+    def setUp(self):
+        super(TestSessionAsyncWrites, self).setUp()
+        # The semaphore is created from the settings on first use
+        session_backend._async_writes_semaphore = None
+        self.addCleanup(setattr, session_backend, '_async_writes_semaphore', None)
+
+    def _wait_for_metric(self, name, value):
+        deadline = time.time() + 5
+        while metrics.get(name) < value and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertGreaterEqual(metrics.get(name), value)
+
+    def test_create_is_synchronous_and_updates_are_async(self):
+        sent = metrics.get('session.save.async.sent')
+        completed = metrics.get('session.save.async.completed')
+        session = session_backend.SessionStore()
+        session['lang'] = 'en'
+        session.save()
+        self.assertEquals(metrics.get('session.save.async.sent'), sent)
+        self.assertEquals(session_backend.SessionStore(session.session_key).load(),
+                          {'lang': 'en'})
+
+        session['lang'] = 'es'
+        session.save()
+        self.assertEquals(metrics.get('session.save.async.sent'), sent + 1)
+        self._wait_for_metric('session.save.async.completed', completed + 1)
+        self.assertEquals(session_backend.SessionStore(session.session_key).load(),
+                          {'lang': 'es'})
+        # Released by the callback
+        self.assertTrue(session_backend._get_async_writes_semaphore().acquire(False))
+
+    def test_synchronous_when_the_limit_is_reached(self):
+        session = session_backend.SessionStore()
+        session.save()
+        semaphore = session_backend._get_async_writes_semaphore()
+        self.assertTrue(semaphore.acquire(False))
+        self.addCleanup(semaphore.release)
+
+        fallback_sync = metrics.get('session.save.async.fallback_sync')
+        session['lang'] = 'en'
+        session.save()
+        self.assertEquals(metrics.get('session.save.async.fallback_sync'), fallback_sync + 1)
+        self.assertEquals(session_backend.SessionStore(session.session_key).load(),
+                          {'lang': 'en'})
+
+    def test_errback_releases_the_semaphore(self):
+        semaphore = session_backend._get_async_writes_semaphore()
+        self.assertTrue(semaphore.acquire(False))
+        errors = metrics.get('session.save.async.errors')
+        session_backend._async_write_failed(Exception('timeout'), semaphore, 'session-key')
+        self.assertEquals(metrics.get('session.save.async.errors'), errors + 1)
+        self.assertTrue(semaphore.acquire(False))
+        semaphore.release()
+
+
+class TestDualReadSession(PCassandraBaseTest):
+    def _create_db_session(self):
+        db_session = db_session_backend.SessionStore()
+        db_session['lang'] = 'en'
+        db_session.save()
+        return db_session.session_key
+
+    def test_sessions_are_copied_and_deleted_from_both(self):
+        session_key = self._create_db_session()
+        self.assertEquals(dualread_backend.SessionStore(session_key).load(), {'lang': 'en'})
+        # Copied to Cassandra, readable after switching to the Cassandra engine
+        self.assertEquals(session_backend.SessionStore(session_key).load(), {'lang': 'en'})
+
+        dualread_backend.SessionStore(session_key).delete()
+        self.assertFalse(Session.objects.filter(session_key=session_key).exists())
+        session = dualread_backend.SessionStore(session_key)
+        self.assertEquals(session.load(), {})
+        self.assertIsNone(session.session_key)
+
+    def test_copy_sessions_command(self):
+        session_key = self._create_db_session()
+        management.call_command('pcassandra_copy_sessions', stdout=io.StringIO())
+        self.assertEquals(session_backend.SessionStore(session_key).load(), {'lang': 'en'})
+
+        # Sessions already in Cassandra are not counted as copied
+        stdout = io.StringIO()
+        management.call_command('pcassandra_copy_sessions', stdout=stdout)
+        self.assertIn('Done: 0 sessions copied, 1 already in Cassandra', stdout.getvalue())
+
+
+class TestLoadTestUsers(PCassandraBaseTest):
+    @override_settings(PCASSANDRA_AUTH_USER_MODEL=PCASSANDRA_AUTH_USER_MODEL)
+    def test_users_are_never_reused_and_are_deleted(self):
+        existing_user = self._create_user('loadtest-x-1')
+        command = loadtest.Command()
+        with self.assertRaises(CommandError):
+            command.create_users(2, 'loadtest-x-', 'password')
+        # The users created before the conflict are deleted, the existing one is not modified
+        self.assertFalse(models.CassandraUser.objects.filter(username='loadtest-x-0'))
+        self.assertEquals(models.CassandraUser.objects.get(username='loadtest-x-1').password,
+                          existing_user.password)
+
+        usernames = command.create_users(2, 'loadtest-y-', 'password')
+        command.delete_users(usernames)
+        self.assertFalse(models.CassandraUser.objects.filter(username__in=usernames))
+
+    @override_settings(PCASSANDRA_AUTH_USER_MODEL=PCASSANDRA_AUTH_USER_MODEL)
+    def test_sessions_are_deleted(self):
+        usernames = loadtest.Command().create_users(1, 'loadtest-z-', 'password')
+        self.addCleanup(loadtest.Command().delete_users, usernames)
+        client = loadtest.VirtualClient(session_backend.SessionStore, ModelBackend(),
+                                        usernames, 'password')
+        client.anonymous()
+        client.login()
+        client.page_view()
+        session_keys = list(client.session_keys)
+        self.assertEquals(len(session_keys), 1)
+
+        client.delete_sessions()
+        self.assertFalse(session_backend.SessionStore().exists(session_keys[0]))
+        self.assertEquals(client.session_keys, set())
+
+
+class TestCassandraCache(PCassandraBaseTest):
+    def test_many_keys_with_bounded_concurrency(self):
+        cassandra_cache = cache.CassandraCache('', {'OPTIONS': {'CONCURRENCY': 5}})
+        values = dict(('key-{}'.format(i), i) for i in range(50))
+        cassandra_cache.set_many(values)
+        self.assertEquals(cassandra_cache.get_many(list(values) + ['missing']), values)
+        cassandra_cache.delete_many(list(values))
+        self.assertEquals(cassandra_cache.get_many(list(values)), {})
+
+
+class TestCassandraMessageStorage(PCassandraBaseTest):
+    def setUp(self):
+        super(TestCassandraMessageStorage, self).setUp()
+        self.request = test.RequestFactory().get('/')
+        self.request.session = session_backend.SessionStore()
+
+    def _add(self, *texts):
+        storage = CassandraStorage(self.request)
+        for text in texts:
+            storage.add(django_messages.INFO, text)
+        storage.update(None)
+
+    def _read(self):
+        storage = CassandraStorage(self.request)
+        texts = sorted(message.message for message in storage)
+        storage.update(None)
+        return texts
+
+    def test_messages_are_removed_once_read(self):
+        self._add('first', 'second')
+        self.assertIn(message_storage.STORAGE_KEY_SESSION_KEY, self.request.session)
+        self._add('third')
+        self.assertEquals(self._read(), ['first', 'second', 'third'])
+        self.assertEquals(self._read(), [])
+
+    def test_messages_survive_login(self):
+        self._add('before login')
+        self.request.session.save()
+        session_key = self.request.session.session_key
+        # Like auth.login()
+        self.request.session.cycle_key()
+        self.assertNotEquals(self.request.session.session_key, session_key)
+        self.assertEquals(self._read(), ['before login'])
+
+    def test_messages_of_hybrid_sessions(self):
+        self.request.session = hybrid_backend.SessionStore()
+        self._add('in cookie session')
+        self.request.session.save()
+        # The key of the sessions stored in the cookie changes on every save
+        self.request.session = hybrid_backend.SessionStore(self.request.session.session_key)
+        self.request.session['visits'] = 1
+        self.request.session.save()
+        self.request.session = hybrid_backend.SessionStore(self.request.session.session_key)
+        self.assertEquals(self._read(), ['in cookie session'])
+
+    @override_settings(PCASSANDRA_MESSAGES_TTL=1)
+    def test_messages_expire(self):
+        self._add('expires')
+        time.sleep(1.5)
+        self.assertEquals(self._read(), [])
+
+
+class TestSyncTables(PCassandraBaseTest):
+    def test_sync_tables_and_check(self):
+        cluster = connection.get_cluster()
+        max_schema_agreement_wait = cluster.max_schema_agreement_wait
+        results = schema.sync_tables([SyncedModel], max_workers=2)
+        self.assertEquals(list(results), [SyncedModel])
+        self.assertEquals(cluster.max_schema_agreement_wait, max_schema_agreement_wait)
+        self.assertEquals(schema.get_schema_drift(SyncedModel), [])
+
+        management.call_command('pcassandra_sync_tables', check=True, stdout=io.StringIO())
+        with self.settings(PCASSANDRA_MODELS=['pcassandra.tests.NotSyncedModel']):
+            with self.assertRaises(CommandError):
+                management.call_command('pcassandra_sync_tables', check=True,
+                                        stdout=io.StringIO())
+
+
+class TestDiagnose(PCassandraBaseTest):
+    def test_diagnose_reports_each_host(self):
+        stdout = io.StringIO()
+        management.call_command('pcassandra_diagnose', probes=3, json=True, stdout=stdout)
+        report = json.loads(stdout.getvalue())
+        self.assertTrue(report['hosts'])
+        for host in report['hosts'].values():
+            self.assertEquals(host['errors'], [])
+            self.assertEquals(host['probes'], 3)
+        self.assertTrue(report['schema']['agreement'])
+
+
+class TestHybridSession(PCassandraBaseTest):
+    @override_settings(PCASSANDRA_SESSION_COOKIE_MAX_SIZE=200)
+    def test_sessions_move_between_cookie_and_cassandra(self):
+        session = hybrid_backend.SessionStore()
+        session['lang'] = 'en'
+        session.save()
+        self.assertTrue(hybrid_backend.is_cookie_session_key(session.session_key))
+        self.assertEquals(hybrid_backend.SessionStore(session.session_key).load(),
+                          {'lang': 'en'})
+
+        session['data'] = uuid.uuid4().hex * 20
+        session.save()
+        session_key = session.session_key
+        self.assertTrue(hybrid_backend.is_cassandra_session_key(session_key))
+        self.assertEquals(hybrid_backend.SessionStore(session_key)['lang'], 'en')
+
+        del session['data']
+        session.save()
+        self.assertTrue(hybrid_backend.is_cookie_session_key(session.session_key))
+        self.assertFalse(session.exists(session_key))
+
+    def test_reads_sessions_of_cassandra_backend(self):
+        session = session_backend.SessionStore()
+        session['lang'] = 'en'
+        session.save()
+        self.assertEquals(hybrid_backend.SessionStore(session.session_key).load(),
+                          {'lang': 'en'})
+
+
+class TestCircuitBreaker(test.SimpleTestCase):
+    def test_opens_after_threshold_and_recovers(self):
+        breaker = circuitbreaker.CircuitBreaker('test', failure_threshold=2,
+                                                recovery_timeout=3600)
+        self.assertEquals(breaker.state, circuitbreaker.CLOSED)
+
+        breaker.record_failure()
+        self.assertEquals(breaker.state, circuitbreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEquals(breaker.state, circuitbreaker.OPEN)
+        self.assertFalse(breaker.allow_request())
+        with self.assertRaises(circuitbreaker.CircuitOpenError):
+            breaker.call(lambda: None)
+
+        breaker.recovery_timeout = 0
+        self.assertEquals(breaker.state, circuitbreaker.HALF_OPEN)
+        # Only one request is let through while half-open
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        breaker.end_trial()
+        self.assertEquals(breaker.call(lambda: 'ok'), 'ok')
+        self.assertEquals(breaker.state, circuitbreaker.CLOSED)
+        self.assertTrue(breaker.allow_request())
+        self.assertTrue(breaker.allow_request())
+
+    def test_missing_row_closes_half_open_breaker(self):
+        breaker = circuitbreaker.CircuitBreaker('test', failure_threshold=1,
+                                                recovery_timeout=0)
+        breaker.record_failure()
+        self.assertEquals(breaker.state, circuitbreaker.HALF_OPEN)
+
+        def get_missing_user():
+            raise models.CassandraUser.DoesNotExist()
+
+        with self.assertRaises(models.CassandraUser.DoesNotExist):
+            breaker.call(get_missing_user)
+        self.assertEquals(breaker.state, circuitbreaker.CLOSED)
+
+    def test_listeners_are_called_without_the_lock(self):
+        breaker = circuitbreaker.CircuitBreaker('test', failure_threshold=1,
+                                                recovery_timeout=3600)
+        locked = []
+
+        def listener(kind, name, value):
+            locked.append(breaker._lock.locked())
+
+        metrics.add_listener(listener)
+        self.addCleanup(metrics.remove_listener, listener)
+        breaker.record_failure()
+        breaker.record_success()
+        self.assertTrue(locked)
+        self.assertNotIn(True, locked)
+
+    def test_authenticate_does_not_use_fallback_by_default(self):
+        breaker = circuitbreaker.get_breaker('auth')
+        self.addCleanup(breaker.record_success)
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+
+        unavailable = metrics.get('auth.authenticate.unavailable')
+        self.assertIsNone(ModelBackend().authenticate(username='john', password='secret'))
+        self.assertEquals(metrics.get('auth.authenticate.unavailable'), unavailable + 1)
+
+
+class TestLocalCache(test.SimpleTestCase):
+    def test_lru_and_ttl(self):
+        cache = localcache.LocalCache(max_size=2, ttl=3600)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEquals(cache.get('a'), 1)
+
+        cache.set('d', 4, ttl=-1)
+        self.assertNotIn('d', cache)
+
+
+class TestSharedMemoryCache(test.SimpleTestCase):
+    def test_shared_between_instances(self):
+        path = os.path.join(tempfile.mkdtemp(), 'shmcache')
+        cache1 = shmcache.SharedMemoryCache(path, slots=16, slot_size=1024)
+        cache2 = shmcache.SharedMemoryCache(path, slots=16, slot_size=1024)
+        self.addCleanup(cache1.close)
+        self.addCleanup(cache2.close)
+
+        cassandra_user = models.CassandraUser(username='john', first_name='John')
+        snapshot = CassandraUserSnapshot.from_cassandra_user(cassandra_user)
+        self.assertTrue(cache1.set('john', snapshot.get_loaded_values()))
+        self.assertEquals(cache2.get('john'), snapshot.get_loaded_values())
+        self.assertEquals(
+            CassandraUserSnapshot.from_loaded_values(models.CassandraUser,
+                                                     cache2.get('john')).as_tuple(),
+            snapshot.as_tuple())
+        self.assertTrue(cache1.set('groups', {'staff'}))
+        self.assertEquals(cache2.get('groups'), {'staff'})
+        self.assertFalse(cache1.set('large', 'x' * 2000))
+        # Only JSON (plus sets and datetimes) is stored, never pickles
+        self.assertFalse(cache1.set('snapshot', snapshot))
+
+        cache2.delete('john')
+        self.assertIsNone(cache1.get('john'))
+        cache1.set('expired', 1, ttl=-1)
+        self.assertIsNone(cache2.get('expired'))
+
+    def test_file_with_other_layout_is_not_modified(self):
+        path = os.path.join(tempfile.mkdtemp(), 'shmcache')
+        cache = shmcache.SharedMemoryCache(path, slots=16, slot_size=1024)
+        self.addCleanup(cache.close)
+        cache.set('john', 1)
+
+        with self.assertRaises(shmcache.SharedMemoryCacheError):
+            shmcache.SharedMemoryCache(path, slots=32, slot_size=1024)
+        self.assertEquals(cache.get('john'), 1)
+
+        with self.settings(PCASSANDRA_SHARED_CACHE={'PATH': path, 'SLOTS': 32}):
+            other_cache = shmcache.create_cache_from_settings()
+            self.addCleanup(other_cache.close)
+            self.assertEquals(other_cache.path, path + '.32x512')
+
+    def test_file_writable_by_others_is_refused(self):
+        path = os.path.join(tempfile.mkdtemp(), 'shmcache')
+        cache = shmcache.SharedMemoryCache(path, slots=16, slot_size=1024)
+        cache.close()
+        os.chmod(path, 0o666)
+        with self.assertRaises(shmcache.SharedMemoryCacheError):
+            shmcache.SharedMemoryCache(path, slots=16, slot_size=1024)
+
+        os.chmod(path, 0o600)
+        symlink = os.path.join(os.path.dirname(path), 'symlink')
+        os.symlink(path, symlink)
+        with self.assertRaises(shmcache.SharedMemoryCacheError):
+            shmcache.SharedMemoryCache(symlink, slots=16, slot_size=1024)
+
+
+class TestLoginThrottle(test.SimpleTestCase):
+    def test_deny_list_by_username_and_ip(self):
+        login_throttle = throttle.LoginThrottle(max_attempts_per_username=3,
+                                                max_attempts_per_ip=5, flush_interval=3600)
+        for _ in range(3):
+            self.assertFalse(login_throttle.is_denied('john', '10.0.0.1'))
+            login_throttle.record_failure('john', '10.0.0.1')
+        self.assertTrue(login_throttle.is_denied('john', '10.0.0.2'))
+        self.assertFalse(login_throttle.is_denied('jane', '10.0.0.2'))
+
+        login_throttle.record_failure('jane', '10.0.0.1')
+        login_throttle.record_failure('jane', '10.0.0.1')
+        self.assertTrue(login_throttle.is_denied('bob', '10.0.0.1'))
+
+
+class TestCassandraUserSnapshot(test.SimpleTestCase):
+    def test_snapshot_is_immutable_copy(self):
+        cassandra_user = models.CassandraUser(username='john', first_name='John',
+                                              last_name='Doe', email='john@example.com')
+        cassandra_user.set_password('secret')
+        snapshot = CassandraUserSnapshot.from_cassandra_user(cassandra_user)
+
+        self.assertEquals(snapshot.get_full_name(), 'John Doe')
+        self.assertTrue(snapshot.check_password('secret'))
+        self.assertEquals(snapshot.get_session_auth_hash(),
+                          cassandra_user.get_session_auth_hash())
+        self.assertEquals(snapshot, CassandraUserSnapshot.from_row(snapshot.as_tuple()))
+
+        with self.assertRaises(AttributeError):
+            snapshot.is_superuser = True
+        with self.assertRaises(AttributeError):
+            snapshot.groups
+
+    def test_lazy_load_goes_through_circuit_breaker(self):
+        snapshot = CassandraUserSnapshot.from_loaded_values(
+            models.CassandraUser, {'username': 'john', 'password': 'x', 'is_active': True})
+        other = CassandraUserSnapshot.from_loaded_values(
+            models.CassandraUser, {'username': 'john', 'password': 'x'})
+        # Compared by username: no column is read from Cassandra
+        self.assertEquals(snapshot, other)
+        with self.assertRaises(ValueError):
+            snapshot.as_tuple()
+
+        breaker = circuitbreaker.get_breaker('auth')
+        self.addCleanup(breaker.record_success)
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        with self.assertRaises(circuitbreaker.CircuitOpenError):
+            snapshot.email
+        self.assertFalse(snapshot._is_loaded('email'))
+
+
+class TestCredentialCache(test.SimpleTestCase):
+    def test_verified_credentials_follow_hash_and_is_active(self):
+        snapshot = CassandraUserSnapshot.from_cassandra_user(
+            models.CassandraUser(username='john', password='hash-1', is_active=True))
+        verified_credentials = credential_cache.CredentialCache(ttl=30)
+        verified_credentials.set('john', 'secret', snapshot)
+
+        self.assertIs(verified_credentials.get('john', 'secret'), snapshot)
+        self.assertIsNone(verified_credentials.get('john', 'wrong'))
+        self.assertIsNone(verified_credentials.get('jane', 'secret'))
+
+        # A newer copy of the user, ex: deactivated by another process
+        identitymap.begin()
+        try:
+            deactivated = CassandraUserSnapshot.from_cassandra_user(
+                models.CassandraUser(username='john', password='hash-1', is_active=False))
+            identitymap.get('user_snapshot', 'john', lambda: deactivated)
+            self.assertIsNone(verified_credentials.get('john', 'secret'))
+        finally:
+            identitymap.end()
+        self.assertIsNone(verified_credentials.get('john', 'secret'))
+
+
+class TestTableOptions(test.SimpleTestCase):
+    @override_settings(PCASSANDRA_TABLE_OPTIONS={
+        'pcassandra.dj18.session.models.CassandraSession': {
+            'compaction': {'class': 'LeveledCompactionStrategy'},
+            'gc_grace_seconds': 3600,
+            'bloom_filter_fp_chance': 0.01,
+        }
+    })
+    def test_diff_cassandra_2_options(self):
+        class FakeTableMetadata:
+            options = {
+                'compaction_strategy_class':
+                    'org.apache.cassandra.db.compaction.LeveledCompactionStrategy',
+                'compaction_strategy_options': '{}',
+                'gc_grace_seconds': 864000,
+                'bloom_filter_fp_chance': 0.01,
+            }
+
+        diff = schema.diff_table_options(session_models.CassandraSession, FakeTableMetadata())
+        self.assertEquals(diff, [('gc_grace_seconds', 864000, 3600)])
+
+        statement = schema.get_alter_table_statement(
+            session_models.CassandraSession,
+            {'gc_grace_seconds': 3600, 'compaction': {'class': 'LeveledCompactionStrategy'}})
+        self.assertTrue(statement.endswith(
+            "WITH compaction = {'class': 'LeveledCompactionStrategy'} AND gc_grace_seconds = 3600"))
+
+
+class TestModelRegistry(test.SimpleTestCase):
+    @override_settings(PCASSANDRA_AUTH_USER_MODEL=PCASSANDRA_AUTH_USER_MODEL,
+                       PCASSANDRA_MODELS=['pcassandra.dj18.cache.CassandraCacheEntry'])
+    def test_get_models(self):
+        registered_models = registry.get_models()
+        self.assertEquals(registered_models[:2],
+                          [models.CassandraUser, session_models.CassandraSession])
+        self.assertIn(throttle.LoginAttemptCounter, registered_models)
+        self.assertEquals(len(registered_models), len(set(registered_models)))
+
+        self.assertTrue(registry.is_cqlengine_model(cache.CassandraCacheEntry))
+        self.assertFalse(registry.is_cqlengine_model(models.CassandraAbstractUser))
+
+
+class TestCassandraCacheSerialization(test.SimpleTestCase):
+    def test_serialize_and_ttl(self):
+        cassandra_cache = cache.CassandraCache('', {'TIMEOUT': 60,
+                                                    'OPTIONS': {'COMPRESS_MIN_LENGTH': 100}})
+        for value in (1, 'text', {'a': [1, 2]}, 'x' * 1000):
+            self.assertEquals(cassandra_cache._deserialize(cassandra_cache._serialize(value)),
+                              value)
+        self.assertTrue(cassandra_cache._serialize('x' * 1000).startswith(cache.FLAG_PICKLE_ZLIB))
+
+        self.assertEquals(cassandra_cache._get_ttl(), 60)
+        self.assertEquals(cassandra_cache._get_ttl(None), 0)
+        self.assertEquals(cassandra_cache._get_ttl(0.5), 1)
+        self.assertIsNone(cassandra_cache._get_ttl(0))
+
+
+class TestSessionAuthHash(test.SimpleTestCase):
+    def setUp(self):
+        self.addCleanup(session_hash.forget_session_auth_hash, 'jane')
+
+    def test_remembered_hash_is_used_without_reading_the_user(self):
+        cassandra_user = models.CassandraUser(username='jane')
+        cassandra_user.set_password('secret')
+        session_hash.remember_session_auth_hash('jane', cassandra_user.password)
+
+        self.assertEquals(session_hash.get_session_auth_hash(models.CassandraUser, 'jane'),
+                          cassandra_user.get_session_auth_hash())
+
+        dj_user = DjangoUserProxy(username='jane')
+        self.assertFalse(dj_user.is_hydrated())
+        self.assertEquals(dj_user.get_session_auth_hash(),
+                          cassandra_user.get_session_auth_hash())
+
+    def test_raises_if_not_available_and_not_cached(self):
+        breaker = circuitbreaker.get_breaker('auth')
+        self.addCleanup(breaker.record_success)
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+
+        with self.assertRaises(session_hash.SessionAuthHashUnavailable):
+            session_hash.get_session_auth_hash(models.CassandraUser, 'jane')
+
+
+class TestIdentityMap(test.SimpleTestCase):
+    def test_loads_once_per_request(self):
+        loads = []
+
+        def loader():
+            loads.append(1)
+            return 'row'
+
+        identitymap.get('test', 'key', loader)
+        identitymap.get('test', 'key', loader)
+        self.assertEquals(len(loads), 2)
+
+        identitymap.begin()
+        try:
+            self.assertEquals(identitymap.get('test', 'key', loader), 'row')
+            self.assertEquals(identitymap.get('test', 'key', loader), 'row')
+            self.assertEquals(len(loads), 3)
+            identitymap.discard('test', 'key')
+            identitymap.get('test', 'key', loader)
+            self.assertEquals(len(loads), 4)
+        finally:
+            identitymap.end()
+
+
+class TestSingleFlight(test.SimpleTestCase):
+    def test_concurrent_loads_are_collapsed(self):
+        release = threading.Event()
+        loads = []
+
+        def loader():
+            loads.append(1)
+            release.wait(5)
+            return 'row'
+
+        collapsed = metrics.get('singleflight.test.collapsed')
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(singleflight.do('test', 'key', loader)))
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        deadline = time.time() + 5
+        while metrics.get('singleflight.test.collapsed') < collapsed + 3 and \
+                time.time() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(len(loads), 1)
+        self.assertEquals(results, ['row'] * 4)
+        self.assertEquals(singleflight.in_flight(), 0)
+        self.assertEquals(singleflight.do('test', 'key', loader), 'row')
+        self.assertEquals(len(loads), 2)
+
+    def test_followers_timeout_and_get_their_own_exception(self):
+        started = threading.Event()
+        release = threading.Event()
+        error = KeyError('leader failed')
+
+        def loader():
+            started.set()
+            release.wait(5)
+            raise error
+
+        def leader():
+            with self.assertRaises(KeyError):
+                singleflight.do('test', 'key', loader)
+
+        leader_thread = threading.Thread(target=leader)
+        leader_thread.start()
+        started.wait(5)
+        with self.assertRaises(OperationTimedOut):
+            singleflight.do('test', 'key', loader, timeout=0.01)
+
+        errors = []
+
+        def follower():
+            try:
+                singleflight.do('test', 'key', loader, timeout=5)
+            except KeyError as e:
+                errors.append(e)
+
+        follower_thread = threading.Thread(target=follower)
+        follower_thread.start()
+        time.sleep(0.1)
+        release.set()
+        leader_thread.join()
+        follower_thread.join()
+        self.assertEquals(len(errors), 1)
+        self.assertIsNot(errors[0], error)
+        self.assertIs(errors[0].__cause__, error)
+
+
+class TestPercentiles(test.SimpleTestCase):
+    def test_nearest_rank(self):
+        self.assertEquals(metrics.percentiles([]), {})
+        self.assertEquals(metrics.percentiles(range(1, 101)), {50: 50, 90: 90, 99: 99})
+        self.assertEquals(metrics.percentiles([3, 1, 2], (0, 100)), {0: 1, 100: 3})
+
+
+class TestMetricsExporters(test.SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_prometheus_text_format(self):
+        metrics.incr('auth.authenticate.success', 2)
+        metrics.set_gauge('circuit_breaker.auth.state', 1)
+        metrics.observe('session.load', 0.003)
+        metrics.observe('session.load', 20)
+
+        lines = exporters.render_prometheus().splitlines()
+        self.assertIn('pcassandra_auth_authenticate_success 2', lines)
+        self.assertIn('# TYPE pcassandra_circuit_breaker_auth_state gauge', lines)
+        self.assertIn('pcassandra_session_load_seconds_bucket{le="0.0025"} 0', lines)
+        self.assertIn('pcassandra_session_load_seconds_bucket{le="0.005"} 1', lines)
+        self.assertIn('pcassandra_session_load_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn('pcassandra_session_load_seconds_count 2', lines)
+
+    def test_statsd_emitter(self):
+        emitter = exporters.StatsdEmitter(prefix='app')
+        self.assertEquals(emitter.format('counter', 'auth.proxy.created', 1),
+                          'app.auth.proxy.created:1|c')
+        self.assertEquals(emitter.format('histogram', 'session.save', 0.25),
+                          'app.session.save:250.000|ms')
+
+
+class TestLoadTest(test.SimpleTestCase):
+    def test_mix_and_report(self):
+        self.assertEquals(loadtest.parse_mix('login=1,page_view=3'),
+                          [('login', 1.0), ('page_view', 3.0)])
+        with self.assertRaises(CommandError):
+            loadtest.parse_mix('login=1,checkout=2')
+        self.assertEquals(loadtest.choose([('login', 0), ('logout', 1)]), 'logout')
+
+        results = loadtest.Results()
+        for latency in (0.01, 0.02, 0.03):
+            results.add_success('login', latency)
+        results.add_error('login', Exception('timeout'))
+        report = results.get_report(elapsed=2.0)
+        self.assertEquals(list(report), ['login'])
+        self.assertEquals(report['login']['requests'], 4)
+        self.assertEquals(report['login']['throughput'], 2.0)
+        self.assertEquals(report['login']['error_rate'], 0.25)
+        self.assertEquals(report['login']['latency_ms'], {50: 20.0, 90: 30.0, 99: 30.0})
+
+
+class TestSessionTtl(test.SimpleTestCase):
+    def test_ttl_from_expire_date(self):
+        now = timezone.now()
+        self.assertEquals(session_models.get_ttl(now - datetime.timedelta(seconds=10)), 0)
+        self.assertIn(session_models.get_ttl(now + datetime.timedelta(seconds=3600)),
+                      (3599, 3600))
+
+
+class TestSlowQueryLog(test.SimpleTestCase):
+    def test_parameters_are_redacted(self):
+        self.assertEquals(querylog.redact_parameters(['secret', 10, None]),
+                          ['<str:6>', '<int>', 'None'])
+        self.assertEquals(querylog.redact_parameters({'key': b'abc'}), {'key': '<bytes:3>'})
+
+    @override_settings(PCASSANDRA_SLOW_QUERY_LOG=None)
+    def test_session_not_instrumented_if_disabled(self):
+        session = object()
+        self.assertIs(querylog.instrument_session(session), session)
+
+    @override_settings(PCASSANDRA_SLOW_QUERY_LOG={'THRESHOLD': 0.1})
+    def test_session_instrumented_if_enabled(self):
+        session = querylog.instrument_session(object())
+        self.assertIsInstance(session, querylog.InstrumentedSession)
+        self.assertEquals(session.threshold, 0.1)
+
+    def test_trace_wait_is_bounded(self):
+        max_waits = []
+
+        class Future:
+            def get_query_trace(self, max_wait=None):
+                max_waits.append(max_wait)
+                raise TraceUnavailable("Trace not complete")
+
+        session = querylog.InstrumentedSession(object(), trace_max_wait=0.2)
+        session._log_trace('SELECT 1', None, Future(), 0.01)
+        self.assertEquals(max_waits, [0.2])
+
+
+class TestConnectionClass(test.SimpleTestCase):
+    def _cassandra_connection(self, connection_class):
+        cassandra_connection = dict(settings.CASSANDRA_CONNECTION)
+        cassandra_connection['CONNECTION_CLASS'] = connection_class
+        return cassandra_connection
+
+    def test_connection_class_by_name_or_path(self):
+        with override_settings(CASSANDRA_CONNECTION=self._cassandra_connection(None)):
+            self.assertIsNone(connection.get_connection_class())
+
+        from cassandra.io.asyncorereactor import AsyncoreConnection
+        for name in ('asyncore', 'cassandra.io.asyncorereactor.AsyncoreConnection'):
+            with override_settings(CASSANDRA_CONNECTION=self._cassandra_connection(name)):
+                self.assertIs(connection.get_connection_class(), AsyncoreConnection)
+
+        with override_settings(CASSANDRA_CONNECTION=self._cassandra_connection('nope')):
+            with self.assertRaises(ImproperlyConfigured):
+                connection.get_connection_class()
@@ -1,51 +1,139 @@
 """
 Utilities to facilitate the implementation of unittest, for
 pcassandra, and for pcassandra users too.
+
+Each test process (each worker, when tests are run in parallel) uses
+its own keyspace: the name of the configured keyspace plus a suffix
+identifying the worker. The keyspace and the tables are created once
+per process, the tables are truncated between tests (see
+PCassandraTestUtilsMixin), and the keyspace is dropped when the
+process exits.
 """
 
+import atexit
+import logging
+import os
 import uuid
 
-from cassandra.cqlengine import management
+from cassandra.cqlengine import models as cassandra_models
+from django.conf import settings
 
 from pcassandra import connection
+from pcassandra import registry
+from pcassandra import schema
 from pcassandra import utils
 
+logger = logging.getLogger(__name__)
+
+# Models synced by setup() in this process
+_synced_models = []
+
+# Name of the keyspace created for this process, None if not created yet
+_worker_keyspace = None
+
+
+def get_worker_id():
+    """
+    Returns an identifier of the current test worker: the worker id
+    assigned by Django's parallel test runner (when available), the
+    value of the PCASSANDRA_TEST_WORKER_ID environment variable,
+    or the PID of the process.
+    """
+    try:
+        from django.test import runner
+        worker_id = getattr(runner, '_worker_id', 0)
+    except ImportError:
+        worker_id = 0
+    if worker_id:
+        return str(worker_id)
+    return os.environ.get('PCASSANDRA_TEST_WORKER_ID', str(os.getpid()))
+
+
+def get_worker_keyspace(base_keyspace):
+    return '{}_w{}'.format(base_keyspace, get_worker_id())
+
+
+def _use_worker_keyspace():
+    """Updates the settings (and cqlengine) to use the keyspace of this worker"""
+    global _worker_keyspace
+    if _worker_keyspace is None:
+        _worker_keyspace = get_worker_keyspace(settings.CASSANDRA_CONNECTION['KEYSPACE'])
+        cassandra_connection = dict(settings.CASSANDRA_CONNECTION)
+        cassandra_connection['KEYSPACE'] = _worker_keyspace
+        settings.CASSANDRA_CONNECTION = cassandra_connection
+        cassandra_models.DEFAULT_KEYSPACE = _worker_keyspace
+        logger.info("Using keyspace '%s' for this test worker", _worker_keyspace)
+    return _worker_keyspace
+
 
 def setup_connection_and_create_keyspace():
     """
-    Setup connection and creates keyspace.
+    Setup connection and creates the keyspace of this worker.
     """
+    _use_worker_keyspace()
     # FIXME: self_or_cls=None... So hacky!
     connection.setup_connection_if_unset(set_default_keyspace=False)
     connection.create_keyspace()
     connection.set_session_default_keyspace()
 
 
-def setup():
+def setup(models=None):
     """
-    Setup connection, create keyspace and models.
+    Setup connection, create keyspace and models. Only the first call
+    (for each test worker) does the work, the next calls do nothing.
+
+    By default, all the models of the registry are synced (see registry.py).
 
     Use: call this in the 'setUpClass()' method of the base class of your unittests:
 
         class BaseTest(unittest.TestCase, tests_utils.PCassandraTestUtilsMixin):
 
-            cassandra_connection_done = False
-
             @classmethod
             def setUpClass(cls):
                 unittest.TestCase.setUpClass()
-                if not cls.cassandra_connection_done:
-                    tests_utils.PCassandraTestUtilsMixin._full_setup()
-                    cls.cassandra_connection_done = True
+                tests_utils.setup()
+
+            def setUp(self):
+                self._truncate_tables()
     """
+    if _synced_models:
+        return
+
+    if models is None:
+        models = registry.get_models()
+
     setup_connection_and_create_keyspace()
+    atexit.register(teardown)
 
-    ModelClass = utils.get_cassandra_user_model()
-    management.sync_table(ModelClass)
+    schema.sync_tables(models)
+    _synced_models.extend(models)
+
+
+def truncate_tables():
+    """Removes all the rows of the tables synced by setup()"""
+    for model_class in _synced_models:
+        connection.get_session().execute("TRUNCATE {}".format(
+            model_class.column_family_name()))
+
+
+def teardown():
+    """Drops the keyspace of this worker"""
+    if _worker_keyspace is None or not _synced_models:
+        return
+    logger.info("Dropping keyspace '%s'", _worker_keyspace)
+    try:
+        connection.get_session().execute("DROP KEYSPACE IF EXISTS {}".format(_worker_keyspace))
+    except Exception:
+        logger.exception("Couldn't drop keyspace '%s'", _worker_keyspace)
+    del _synced_models[:]
 
 
 class PCassandraTestUtilsMixin:
 
+    def _truncate_tables(self):
+        """Removes all the rows of the tables, call it in 'setUp()'"""
+        truncate_tables()
+
     def _create_user(self, username=None, auto_first_last_email=False, **kwargs):
         """
         Creates an user instance and inserts it in the database.
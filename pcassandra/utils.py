@@ -3,6 +3,7 @@ from django.core.exceptions import ImproperlyConfigured
 from django.utils.module_loading import import_string
 
 from pcassandra.dj18.auth.models import CassandraAbstractUser
+from pcassandra.dj18.auth.snapshot import CassandraUserSnapshot
 
 
 def get_cassandra_user_model():
@@ -26,3 +27,12 @@ def get_cassandra_user_model():
                                    "is not a subclass of CassandraAbstractUser")
 
     return clazz
+
+
+def get_users(usernames):
+    """
+    Returns a dict {username: CassandraUserSnapshot} with the users
+    of `usernames`. All the users are read concurrently.
+    Users that don't exist are not included in the returned dict.
+    """
+    return CassandraUserSnapshot.fetch_many(get_cassandra_user_model(), usernames)
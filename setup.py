@@ -14,6 +14,7 @@ setup(
         'pcassandra',
         'pcassandra.dj18',
         'pcassandra.dj18.auth',
+        'pcassandra.dj18.messages',
         'pcassandra.dj18.session',
         'pcassandra.management',
         'pcassandra.management.commands',